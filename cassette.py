@@ -0,0 +1,227 @@
+"""Cassettes: the API and page responses of a run, recorded to one file and played back to the crawler offline"""
+
+import collections
+import glob
+import json
+import os
+import struct
+import zlib
+
+import settings
+
+MAGIC = b'ROSIE-CASSETTE 1\n'
+# Last bytes of a cassette closed properly: offset of its index, and a marker
+TRAILER = struct.Struct('>Q8s')
+TRAILER_MARKER = b'CASSIDX\n'
+
+# A recorded response: status (None if the request raised), headers, body bytes, seconds the request took, and the
+# name of the exception it raised (e.g. 'TimeoutError'), None if it got an answer
+Recording = collections.namedtuple('Recording', ['status', 'headers', 'body', 'seconds', 'error'])
+
+
+class Headers(dict):
+    """
+    Response headers read back from a cassette. Case-insensitive, like those of an aiohttp response; a header
+    that came several times keeps its first value.
+    """
+
+    def __init__(self, pairs=()):
+        super().__init__()
+        for name, value in pairs:
+            self.setdefault(name.lower(), value)
+
+    def get(self, name, default=None):
+        return super().get(name.lower(), default)
+
+    def __getitem__(self, name):
+        return super().__getitem__(name.lower())
+
+    def __contains__(self, name):
+        return super().__contains__(name.lower())
+
+
+class CassetteRecorder:
+    """
+    Writes responses to a cassette file as they come. The file is a header line, then one record per response
+    (a JSON line with the url, status, headers, seconds and body size, then the zlib-compressed body), then at
+    close() an index of the records by url. A cassette that was not closed (the run crashed) has no index, and
+    is still readable: CassettePlayer then scans the records.
+    """
+
+    replaying = False
+
+    def __init__(self, filename, level=settings.CASSETTE_COMPRESSION_LEVEL):
+        """
+        :param filename: file of the cassette, overwritten
+        :param level: zlib compression level of the bodies
+        """
+        self.filename = filename
+        self.level = level
+        self.stats = collections.Counter()
+        self._index = {}  # {url: [offset of each record, in order]}
+        # Unbuffered, so a forked shard process inherits no pending bytes of the parent
+        self._file = open(filename, 'wb', buffering=0)
+        self._file.write(MAGIC)
+        self._offset = len(MAGIC)
+        self._pid = os.getpid()
+
+    def record(self, url, status, headers=(), body=b'', seconds=0.0, error=None):
+        """
+        :param url: url that was requested
+        :param status: HTTP status of the response, None if the request raised
+        :param headers: headers of the response
+        :param body: body bytes of the response
+        :param seconds: seconds the request took
+        :param error: name of the exception the request raised
+        """
+        compressed = zlib.compress(body, self.level) if body else b''
+        entry = {'url': url, 'status': status, 'headers': list(headers.items()) if headers else [],
+                 'seconds': round(seconds, 4), 'error': error, 'size': len(compressed)}
+        record = json.dumps(entry).encode('utf-8') + b'\n' + compressed
+        self._file.write(record)
+        self._index.setdefault(url, []).append(self._offset)
+        self._offset += len(record)
+        self.stats['recorded'] += 1
+        self.stats['bytes'] += len(body)
+
+    def close(self):
+        """
+        Writes the index. Does nothing in a process that inherited the recorder from the one that opened it.
+        """
+        if self._file is None or self._pid != os.getpid():
+            return
+        self._file.write(json.dumps(self._index).encode('utf-8') + TRAILER.pack(self._offset, TRAILER_MARKER))
+        self._file.close()
+        self._file = None
+
+
+class CassettePlayer:
+    """
+    Plays the responses of a cassette back, by url: the n-th request for a url gets the n-th response recorded for
+    it (so retries play out as they did), and the last one once they are used up. A url that was never recorded
+    gets an empty 404. Bodies are read when played, with pread(), so shard processes can share the player.
+    The cassette of a sharded run (cli.py --workers) is one file per shard, they are all read.
+    """
+
+    replaying = True
+
+    def __init__(self, filename, latency_scale=settings.CASSETTE_LATENCY_SCALE):
+        """
+        :param filename: file of the cassette
+        :param latency_scale: how long a played response takes, relative to the recorded request: 0 for no delay,
+                              1 for the recorded latency
+        """
+        self.filename = filename
+        self.latency_scale = latency_scale
+        self.stats = collections.Counter()
+        self._index = {}  # {url: [(file descriptor, offset), ...]}
+        self._played = collections.Counter()
+        self._fds = []
+        root, extension = os.path.splitext(filename)
+        for path in [filename] + sorted(glob.glob(glob.escape(root) + '.shard*of*' + glob.escape(extension))):
+            self._load(path)
+
+    def _load(self, path):
+        fd = os.open(path, os.O_RDONLY)
+        self._fds.append(fd)
+        size = os.fstat(fd).st_size
+        if os.pread(fd, len(MAGIC), 0) != MAGIC:
+            raise ValueError("{} is not a cassette".format(path))
+        index = None
+        if size >= len(MAGIC) + TRAILER.size:
+            index_offset, marker = TRAILER.unpack(os.pread(fd, TRAILER.size, size - TRAILER.size))
+            if marker == TRAILER_MARKER:
+                index = json.loads(os.pread(fd, size - TRAILER.size - index_offset, index_offset).decode('utf-8'))
+        if index is None:
+            index = self._scan(fd, size)
+        for url, offsets in index.items():
+            self._index.setdefault(url, []).extend((fd, offset) for offset in offsets)
+
+    @staticmethod
+    def _scan(fd, size):
+        """
+        Index of a cassette without one, up to its last complete record.
+        """
+        index = {}
+        with os.fdopen(os.dup(fd), 'rb') as file:
+            file.seek(len(MAGIC))
+            while True:
+                offset = file.tell()
+                line = file.readline()
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    entry = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    break
+                if file.tell() + entry['size'] > size:
+                    break
+                file.seek(entry['size'], os.SEEK_CUR)
+                index.setdefault(entry['url'], []).append(offset)
+        return index
+
+    def __len__(self):
+        return sum(len(records) for records in self._index.values())
+
+    def play(self, url):
+        """
+        :return: the next Recording for url
+        """
+        records = self._index.get(url)
+        if not records:
+            self.stats['missed'] += 1
+            return Recording(404, Headers(), b'', 0.0, None)
+        fd, offset = records[min(self._played[url], len(records) - 1)]
+        self._played[url] += 1
+        self.stats['played'] += 1
+        head = b''
+        while b'\n' not in head:
+            head += os.pread(fd, 65536, offset + len(head))
+        line, rest = head.split(b'\n', 1)
+        entry = json.loads(line.decode('utf-8'))
+        compressed = rest[:entry['size']]
+        if len(compressed) < entry['size']:
+            compressed = os.pread(fd, entry['size'], offset + len(line) + 1)
+        body = zlib.decompress(compressed) if compressed else b''
+        return Recording(entry['status'], Headers(entry['headers']), body, entry['seconds'] * self.latency_scale,
+                         entry['error'])
+
+    def close(self):
+        for fd in self._fds:
+            os.close(fd)
+        self._fds = []
+
+
+# Cassette of this process, see start()
+_cassette = None
+
+
+def start(record=None, replay=None, latency_scale=settings.CASSETTE_LATENCY_SCALE):
+    """
+    Starts recording the responses of the crawlers of this process to a cassette, or playing one back to them
+    (see Crawler._get), until stop().
+    :param record: file to record to
+    :param replay: file to play back, instead of requesting the OSF
+    :param latency_scale: see CassettePlayer
+    :return: the CassetteRecorder or CassettePlayer, None if neither file is given
+    """
+    global _cassette
+    if replay is not None:
+        _cassette = CassettePlayer(replay, latency_scale)
+    elif record is not None:
+        _cassette = CassetteRecorder(record)
+    return _cassette
+
+
+def current():
+    """
+    :return: the cassette of this process, None if there is none
+    """
+    return _cassette
+
+
+def stop():
+    global _cassette
+    if _cassette is not None:
+        _cassette.close()
+        _cassette = None
@@ -1,12 +1,27 @@
+import asyncio
+import atexit
+import cassette
 import click
+import compressor
 import datetime
+import completion
 import crawler
+import journal
+import shards
 import json
 import codecs
+import logs
+import metrics
 import verifier
 import deleter
 import indexer
+import os
+import settings
 import shutil
+import socket
+import time
+import workqueue
+import writer
 
 # Endpoint for using the ROSIEBot module via command line.
 
@@ -22,10 +37,41 @@ import shutil
 @click.option('--delete', is_flag=True, help="Delete nodes from the mirror that have been deleted by users. Requires "
                                              "compile_active-produced active-node taskfile")
 @click.option('--index', is_flag=True, help="Make an index file and set up search engine")
+@click.option('--worker', is_flag=True, help="Scrape pages from the work queue of a distributed scrape, need --queue")
 # Specify parameters for other needed values
 @click.option('--dm', default=None, type=click.STRING, help="Date marker needed for normal scrape")
 @click.option('--tf', default=None, type=click.STRING, help="filename of the task file")
 @click.option('--rn', default=3, type=click.INT, help="Number of times to retry")
+@click.option('--pipeline', is_flag=True, help="With --scrape, start scraping pages while the API is still being "
+                                               "crawled")
+@click.option('--workers', default=1, type=click.INT, help="With --scrape or --resume, scrape the pages in this many "
+                                                           "processes")
+@click.option('--queue', default=None, type=click.STRING,
+              help="With --scrape or --resume, coordinate a distributed scrape: put the pages on this work queue, "
+                   "e.g. sqlite:///var/rosie/queue.db, and wait for --worker processes to scrape them")
+@click.option('--worker-id', default=None, type=click.STRING, help="With --worker, name of the worker in the queue, "
+                                                                   "host-pid by default")
+@click.option('--metrics-port', default=None, type=click.INT, help="Serve metrics in the Prometheus text format "
+                                                                   "on this local port")
+@click.option('--metrics-file', default=None, type=click.STRING, help="Write a JSON snapshot of the metrics to this "
+                                                                      "file every METRICS_INTERVAL seconds")
+@click.option('--log-level', default=None, type=click.Choice(['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']),
+              help="Lowest level written to the debug log, LOG_LEVEL of settings.py by default")
+@click.option('--verify-workers', default=settings.VERIFY_WORKERS, type=click.INT,
+              help="With --verify or --resume_verify, spot check the pages in this many processes, one per CPU by "
+                   "default")
+@click.option('--record', default=None, type=click.STRING, help="Record the API and page responses to this "
+                                                                "cassette file")
+@click.option('--replay', default=None, type=click.STRING, help="Play the responses of a recorded cassette back "
+                                                                "instead of requesting the OSF")
+@click.option('--replay-latency', default=settings.CASSETTE_LATENCY_SCALE, type=click.FLOAT,
+              help="With --replay, played responses take this times their recorded latency, e.g. 1 for the "
+                   "recorded timing, 0 (the default) for none")
+@click.option('--validate', is_flag=True, help="With --scrape, --resume or --worker, check every page with the "
+                                               "verifier's rules before saving it, and retry it if it fails")
+@click.option('--compress', type=click.Choice(sorted(compressor.ENCODINGS)), multiple=True,
+              help="With --scrape, --resume or --index, also write compressed copies (.gz, .br) of the saved files, "
+                   "e.g. --compress gzip --compress brotli")
 @click.option('--ctf', default=None, type=click.STRING, help="json file generated from compile_active of currently "
                                                              "active nodes")
 # Specify areas of scraping
@@ -40,11 +86,13 @@ import shutil
 @click.option('-a', is_flag=True, help="Add this flag if you want to include analytics page for nodes")
 @click.option('-r', is_flag=True, help="Add this flag if you want to include registrations page for nodes")
 @click.option('-k', is_flag=True, help="Add this flag if you want to include forks page for nodes")
-def cli_entry_point(scrape, resume, verify, resume_verify, compile_active, delete, index, dm, tf, rn, ctf, registrations,
-                    users, institutions, nodes, d, f, w, a, r, k):
+def cli_entry_point(scrape, resume, verify, resume_verify, compile_active, delete, index, worker, dm, tf, rn,
+                    pipeline, workers, queue, worker_id, metrics_port, metrics_file, log_level, verify_workers,
+                    record, replay, replay_latency, validate, compress, ctf, registrations, users, institutions, nodes,
+                    d, f, w, a, r, k):
 
     # Check to see if more than one option is chosen.
-    if sum(map(bool, [scrape, resume, verify, resume_verify, compile_active, delete, index])) != 1:
+    if sum(map(bool, [scrape, resume, verify, resume_verify, compile_active, delete, index, worker])) != 1:
         click.echo("Invalid options. Please select one mode.")
         return
 
@@ -52,6 +100,46 @@ def cli_entry_point(scrape, resume, verify, resume_verify, compile_active, delet
         click.echo("This mode requires a task file in the form: --tf=<FILENAME>")
         return
 
+    if workers < 1 or (workers > 1 and pipeline):
+        click.echo("--workers needs a positive number, and cannot be combined with --pipeline")
+        return
+
+    if queue is not None and (workers > 1 or pipeline):
+        click.echo("--queue cannot be combined with --workers or --pipeline")
+        return
+
+    if worker and queue is None:
+        click.echo("This mode requires a work queue in the form: --queue=<URL>")
+        return
+
+    if verify_workers is not None and verify_workers < 1:
+        click.echo("--verify-workers needs a positive number")
+        return
+
+    if record is not None and replay is not None:
+        click.echo("--record and --replay cannot be combined")
+        return
+
+    try:
+        compressor.check_encodings(compress)
+        work_queue = workqueue.open_queue(queue) if queue is not None else None
+        if cassette.start(record=record, replay=replay, latency_scale=replay_latency) is not None:
+            atexit.register(stop_cassette)
+    except (ValueError, OSError) as e:
+        click.echo(str(e))
+        return
+
+    if log_level is not None:
+        logs.setup(level=log_level)
+
+    try:
+        exporter = metrics.start(metrics_port, metrics_file)
+    except OSError as e:
+        click.echo("Cannot serve the metrics: " + str(e))
+        return
+    if exporter is not None:
+        atexit.register(metrics.stop)
+
     if delete and ctf is None:
         click.echo("This mode requires a current-project file in the form: --ctf=<FILENAME>")
         click.echo("Run --compile_active to generate this file.")
@@ -63,7 +151,12 @@ def cli_entry_point(scrape, resume, verify, resume_verify, compile_active, delet
         filename = 'activelist-' + now.strftime('%Y%m%d%H%M' + '.json')
         click.echo('Creating a active node list file named : ' + filename)
         with open(filename, 'w') as file:
-            compile_active_list(file)
+            failures = compile_active_list(file)
+        if failures:
+            # Deleting against an incomplete list would remove pages that are still on the OSF
+            os.remove(filename)
+            click.echo("{} API pages failed, see the error log. No list was written.".format(len(failures)))
+            return
         click.echo("Finished compilation. Taskfile is: " + filename)
         click.echo("Use `python cli.py --delete --ctf={}` to remove former pages on the OSF.".format(filename))
         return
@@ -89,7 +182,8 @@ def cli_entry_point(scrape, resume, verify, resume_verify, compile_active, delet
         filename = now.strftime('%Y%m%d%H%M' + '.json')
         click.echo('Creating a task file named : ' + filename)
         with open(filename, 'w') as db:
-            begin_scrape(dm, registrations, users, institutions, nodes, d, f, w, a, r, k, db)
+            begin_scrape(dm, registrations, users, institutions, nodes, d, f, w, a, r, k, db, pipeline=pipeline,
+                         compress=compress, workers=workers, work_queue=work_queue, validate=validate)
         click.echo("Finished scrape. Taskfile is: " + filename)
         click.echo("Use `python cli.py --verify --tf={}` to fix any missing or incomplete pages".format(filename))
         return
@@ -98,21 +192,21 @@ def cli_entry_point(scrape, resume, verify, resume_verify, compile_active, delet
         click.echo('Resuming scrape with the task file : ' + tf)
         try:
             with codecs.open(tf, 'r', encoding='utf-8') as db:
-                resume_scrape(db, tf)
+                resume_scrape(db, tf, compress=compress, workers=workers, work_queue=work_queue, validate=validate)
         except FileNotFoundError:
             click.echo('File Not Found for the task.')
         return
 
     if verify:
         try:
-            verify_mirror(tf, rn)
+            verify_mirror(tf, rn, verify_workers)
         except FileNotFoundError:
             click.echo('File Not Found for the task.')
         return
 
     if resume_verify:
         try:
-            resume_verify_mirror(tf, rn)
+            resume_verify_mirror(tf, rn, verify_workers)
         except FileNotFoundError:
             click.echo('File Not Found for the task.')
         return
@@ -123,43 +217,87 @@ def cli_entry_point(scrape, resume, verify, resume_verify, compile_active, delet
         except FileNotFoundError:
             click.echo("The json file of currently active nodes was not found.")
 
+    if worker:
+        scrape_as_worker(work_queue, worker_id or '{}-{}'.format(socket.gethostname(), os.getpid()), compress,
+                         validate)
+        return
+
     if index:
         robocop = indexer.Indexer() # Who else?
         robocop.index_projects()
         robocop.index_registrations()
         robocop.index_profiles()
-        json.dump(robocop.index, open('archive/static/js/search-index.json', 'w+'), indent=4)
-        shutil.copy('search/js/search.js', 'archive/static/js/search.js')
-        shutil.copy('search/js/lunr.min.js', 'archive/static/js/lunr.min.js')
-        shutil.copy('search/search.html', 'archive/search.html')
+        set_up_search(robocop.index, compress)
         click.echo("Search is set up.")
     return
 
 
+def stop_cassette():
+    """
+    Closes the cassette of the run and tells how it was used.
+    """
+    tape = cassette.current()
+    if tape.replaying:
+        click.echo('Cassette: {} responses played, {} urls not in {}'.format(tape.stats['played'], tape.stats['missed'],
+                                                                           tape.filename))
+    else:
+        click.echo('Cassette: {} responses ({} bytes) recorded to {}'.format(tape.stats['recorded'],
+                                                                             tape.stats['bytes'], tape.filename))
+    cassette.stop()
+
+
+def set_up_search(index, compress=()):
+    """
+    Writes the search index and copies the search assets into the mirror. A file whose content did not change is
+    left untouched, so its compressed copies are only redone when it changed.
+    :param index: search index built by indexer.Indexer
+    :param compress: encodings of the compressed copies to write next to the files, e.g. ['gzip']
+    """
+    index_path = 'archive/static/js/search-index.json'
+    text = json.dumps(index, indent=4)
+    old_text = None
+    if os.path.exists(index_path):
+        with open(index_path, encoding='utf-8') as file:
+            old_text = file.read()
+    if text != old_text:
+        writer.write_atomic(index_path, text.encode('utf-8'))
+    # copy2 keeps the modification time of the sources, which tells the compressed copies whether they are stale
+    shutil.copy2('search/js/search.js', 'archive/static/js/search.js')
+    shutil.copy2('search/js/lunr.min.js', 'archive/static/js/lunr.min.js')
+    shutil.copy2('search/search.html', 'archive/search.html')
+    for path in [index_path, 'archive/static/js/search.js', 'archive/static/js/lunr.min.js', 'archive/search.html']:
+        writer.precompress_file(path, compress)
+
+
 # Crawl the API for all the currently-existing pages and produce a JSON taskfile
 def compile_active_list(file):
     """
     Compiles an list of active nodes, users and registrations for the purpose of deletion.
     :param file: The file descriptor to which the list is stored
+    :return: urls of the API pages that failed for good, in which case nothing is stored
     """
     dict = {}
     rosie = crawler.Crawler()
-    rosie.crawl_nodes_api()
-    list_of_active_nodes = [x[0].split('/')[4] for x in rosie.node_url_tuples]
+    # The three listings are streamed side by side, straight from the API pager
+    loop = asyncio.get_event_loop()
+    list_of_active_nodes, list_of_active_users, list_of_active_registrations = loop.run_until_complete(
+        asyncio.gather(rosie.list_api_ids('nodes/'),
+                       rosie.list_api_ids('users/'),
+                       rosie.list_api_ids('registrations/')))
     dict['list_of_active_nodes'] = list_of_active_nodes
-    rosie.crawl_users_api()
-    list_of_active_users = [x.split('/')[4] for x in rosie.user_urls]
     dict['list_of_active_users'] = list_of_active_users
-    rosie.crawl_registrations_api()
-    list_of_active_registrations = [x[0].split('/')[3] for x in rosie.registration_url_tuples]
     dict['list_of_active_registrations'] = list_of_active_registrations
+    rosie.close()
+    if rosie.api_failures:
+        return rosie.api_failures
     json.dump(dict, file, indent=4)
+    return []
 
 
 def begin_scrape(dm,
                   scrape_registrations, scrape_users, scrape_institutions, scrape_nodes,
                   include_dashboard, include_files, include_wiki, include_analytics, include_registrations,
-                  include_forks, db):
+                  include_forks, db, pipeline=False, compress=(), workers=1, work_queue=None, validate=False):
     """
     Do a normal scrape with specified parameters.
     :param dm: Date modified marker of the scrape. Only nodes that are modified after this marker would be scraped
@@ -174,6 +312,12 @@ def begin_scrape(dm,
     :param include_registrations: Whether to include registrations page for nodes
     :param include_forks: Whether to include forks page for nodes
     :param db: The dictionary object to which the task information is stored
+    :param pipeline: Whether to scrape pages while the API crawl is still running instead of after it
+    :param compress: Encodings of the compressed copies written next to every saved page, e.g. ['gzip']
+    :param workers: Number of processes scraping the pages, see shards.py
+    :param work_queue: Work queue of a distributed scrape, see workqueue.py: the pages are put on it for --worker
+                       processes to scrape, instead of being scraped here
+    :param validate: Whether to check the pages with the verifier's rules before saving them, see Crawler
     """
 
     date_marker = None
@@ -197,16 +341,27 @@ def begin_scrape(dm,
         'registrations_finished': False,
         'users_finished': False,
         'institutions_finished': False,
+        'crawl_finished': False,
         'scrape_finished': False,
         'node_urls': None,
         'registration_urls': None,
         'user_urls': None,
         'institution_urls': None,
         'error_list': None,
-        'milestone': None
+        'api_failures': None,
+        'attempts': None,
+        'completed': None,
+        'milestone': None,
+        'compress': list(compress),
+        'validate': validate,
+        'page_changes': None
     }
 
-    rosie = crawler.Crawler(date_modified=date_marker, db=db, dictionary=store)
+    rosie = crawler.Crawler(date_modified=date_marker, db=db, dictionary=store, compress=compress, validate=validate)
+
+    if pipeline:
+        pipeline_scrape(rosie, store, db)
+        return
 
     # Crawling the respective API for this scrape
     if scrape_nodes:
@@ -232,62 +387,228 @@ def begin_scrape(dm,
         rosie.crawl_institutions_api()
         store['institution_urls'] = rosie.institution_urls
 
-    json.dump(store, db, indent=4)
-    db.flush()
+    store['crawl_finished'] = True
+    rosie.compact_journal()
 
-    # Actual Scraping of the pages
-    if scrape_nodes:
+    # Actual Scraping of the pages, by the workers of a distributed scrape with --queue or in several processes
+    # with --workers
+    if work_queue is not None:
+        distributed_scrape(rosie, store, work_queue, fresh=True)
+    elif workers > 1 and not sharded_scrape(rosie, store, workers):
+        return
+
+    if scrape_nodes and not store['nodes_finished']:
         rosie.scrape_nodes(async=True)
         store['nodes_finished'] = True
-        db.seek(0)
-        db.truncate()
-        json.dump(store, db, indent=4)
-        db.flush()
+        rosie.compact_journal()
 
-    if scrape_registrations:
+    if scrape_registrations and not store['registrations_finished']:
         rosie.scrape_registrations(async=True)
         store['registrations_finished'] = True
-        db.seek(0)
-        db.truncate()
-        json.dump(store, db, indent=4)
-        db.flush()
+        rosie.compact_journal()
 
-    if scrape_users:
+    if scrape_users and not store['users_finished']:
         rosie.scrape_users()
         store['users_finished'] = True
-        db.seek(0)
-        db.truncate()
-        json.dump(store, db, indent=4)
-        db.flush()
+        rosie.compact_journal()
 
-    if scrape_institutions:
+    if scrape_institutions and not store['institutions_finished']:
         rosie.scrape_institutions()
         store['institutions_finished'] = True
-        db.seek(0)
-        db.truncate()
-        json.dump(store, db, indent=4)
-        db.flush()
+        rosie.compact_journal()
+
+    if work_queue is None:
+        rosie.scrape_general()
+
+    store['scrape_finished'] = True
+    rosie.compact_journal()
+    rosie.close()
+    report_timings(rosie)
+
+
+def sharded_scrape(rosie, store, workers):
+    """
+    Scrape the url lists of the phases that are not finished in several processes, see shards.scrape_in_shards().
+    :param rosie: Crawler of the task
+    :param store: The dictionary of task information
+    :param workers: Number of processes
+    :return: Whether every shard finished. If not, the crawler is closed and the task has to be resumed.
+    """
+    lists = {}
+    for list_name, scrape_flag, finished_flag in shards.PHASES:
+        if store[scrape_flag] and not store[finished_flag]:
+            lists[list_name] = getattr(rosie, list_name)
+    click.echo('Scraping {} pages in {} processes'.format(sum(len(urls) for urls in lists.values()), workers))
+    if shards.scrape_in_shards(rosie, store, lists, workers):
+        return True
+    rosie.close()
+    click.echo("Some shards did not finish, see the error log. Their progress is saved: use --resume to finish "
+               "the task")
+    return False
+
+
+def distributed_scrape(rosie, store, work_queue, fresh=False):
+    """
+    Coordinator of a distributed scrape: puts the pages of the phases that are not finished, and the general
+    pages, on a work queue, then waits for --worker processes (on this or other machines) to scrape them. Leases
+    that expire are put back on the queue. The results the workers report are then recorded in the task file as
+    if the pages had been scraped here, and the phases are marked as finished.
+    Urls already on the queue keep their state, so a coordinator that is run again with --resume carries on with
+    the progress the workers made. A new task (fresh) first clears the queue, whose urls were done for another one.
+    :param rosie: Crawler of the task
+    :param store: The dictionary of task information
+    :param work_queue: workqueue.WorkQueue shared with the workers
+    :param fresh: Whether the task is a new scrape rather than a resumed one
+    """
+    if fresh:
+        work_queue.clear()
+    items = []
+    for list_name, scrape_flag, finished_flag in shards.PHASES:
+        if store[scrape_flag] and not store[finished_flag]:
+            osf_type = workqueue.OSF_TYPES[list_name]
+            items.extend((url, osf_type, list_name) for url in getattr(rosie, list_name))
+    items.extend((url, '', None) for url in rosie.general_urls)
+    work_queue.put(items)
+    work_queue.mark_loaded()
+    click.echo('Queued {} pages, waiting for workers: python cli.py --worker --queue=<URL>'.format(len(items)))
+
+    while not work_queue.is_finished():
+        time.sleep(settings.QUEUE_POLL_INTERVAL)
+        requeued = work_queue.requeue_expired()
+        if requeued:
+            click.echo('{} expired leases queued again'.format(requeued))
+        rosie.debug_logger.info("Work queue : %s", work_queue.counts())
+
+    for url, list_name, state, status, attempts in work_queue.results():
+        if attempts > 1 or state == workqueue.FAILED:
+            rosie.attempts[url] = {'attempts': attempts, 'status': status}
+        if state == workqueue.DONE:
+            rosie.record_milestone(url)
+        else:
+            rosie.record_failure(url, status, attempts)
+    store['attempts'] = rosie.attempts
+    for list_name, scrape_flag, finished_flag in shards.PHASES:
+        if store[scrape_flag]:
+            store[finished_flag] = True
+    rosie.compact_journal()
+    work_queue.close()
+
+
+def scrape_as_worker(work_queue, worker_id, compress=(), validate=False):
+    """
+    Worker of a distributed scrape: scrapes pages from the work queue into this machine's mirror until the
+    coordinator's task is done, see Crawler.scrape_from_queue().
+    The digest store and validator cache are the worker's own, named after it.
+    :param work_queue: workqueue.WorkQueue filled by a coordinator (--scrape or --resume with --queue)
+    :param worker_id: name of the worker in the queue
+    :param compress: Encodings of the compressed copies written next to every saved page, e.g. ['gzip']
+    :param validate: Whether to check the pages with the verifier's rules before saving them, see Crawler
+    """
+    click.echo('Scraping from the work queue as ' + worker_id)
+    rosie = crawler.Crawler(compress=compress, validate=validate)
+    rosie.writer.digest_store.filename = '{}.{}'.format(settings.DIGEST_STORE_FILENAME, worker_id)
+    rosie.validators.filename = '{}.{}'.format(settings.VALIDATOR_CACHE_FILENAME, worker_id)
+    try:
+        rosie.scrape_from_queue(work_queue, worker_id)
+    finally:
+        rosie.close()
+        work_queue.close()
+    report_timings(rosie)
 
-    rosie.scrape_general()
 
+def pipeline_scrape(rosie, store, db):
+    """
+    Crawl the API and scrape the pages at the same time, see Crawler.pipeline_scrape().
+    The urls are journaled as they are found, so an interrupted task can still be resumed.
+    :param rosie: Crawler created by begin_scrape
+    :param store: The dictionary of task information
+    :param db: The task file
+    """
+    # The task file refers to the crawler's lists, which fill up while the pipeline runs
+    if store['scrape_nodes']:
+        store['node_urls'] = rosie.node_urls
+    if store['scrape_registrations']:
+        store['registration_urls'] = rosie.registration_urls
+    if store['scrape_users']:
+        store['user_urls'] = rosie.user_urls
+    if store['scrape_institutions']:
+        store['institution_urls'] = rosie.institution_urls
+    rosie.compact_journal()
+
+    rosie.pipeline_scrape(nodes=store['scrape_nodes'],
+                          registrations=store['scrape_registrations'],
+                          users=store['scrape_users'],
+                          institutions=store['scrape_institutions'],
+                          node_pages={
+                              'dashboard': store['include_dashboard'],
+                              'files': store['include_files'],
+                              'wiki': store['include_wiki'],
+                              'analytics': store['include_analytics'],
+                              'registrations': store['include_registrations'],
+                              'forks': store['include_forks'],
+                          })
+    store['crawl_finished'] = True
+    store['nodes_finished'] = True
+    store['registrations_finished'] = True
+    store['users_finished'] = True
+    store['institutions_finished'] = True
     store['scrape_finished'] = True
-    db.seek(0)
-    db.truncate()
-    json.dump(store, db, indent=4)
-    db.flush()
+    rosie.compact_journal()
+    rosie.close()
+    report_timings(rosie)
 
 
-def resume_scrape(db, tf):
+def report_timings(rosie):
+    """
+    Echo the time to the first saved page, the total wall-clock time of a scrape, how many saved pages were new,
+    changed or unchanged (the new and changed pages are listed in the <task>.changed file), how often
+    conditional requests found pages and wiki listings not modified, and the throughput of every page type.
+    :param rosie: Crawler that did the scrape
+    """
+    now = time.monotonic()
+    changes = rosie.writer.changes
+    click.echo('Pages new : {}, changed : {}, unchanged : {}'.format(changes['new'], changes['changed'],
+                                                                  changes['unchanged']))
+    for kind, pages, failed, seconds, throughput in rosie.page_stats.summary():
+        click.echo('{} : {} pages, {} failed, {:.2f}s per page, {} pages/s'.format(
+            kind, pages, failed, seconds, 'n/a' if throughput is None else '{:.1f}'.format(throughput)))
+    if rosie.page_validator is not None:
+        for kind, rule, pages in rosie.page_validator.summary():
+            click.echo('Invalid {} pages : {} failed "{}"'.format(kind, pages, rule))
+    for kind in ['pages', 'wikis']:
+        rates = rosie.validators.hit_rate(kind)
+        if rates is not None:
+            click.echo('Conditional requests for {} : {:.0%} not modified, {:.0%} of responses with '
+                       'validators'.format(kind, *rates))
+    if rosie.first_page_time is not None:
+        click.echo('Time to first page : {:.1f}s'.format(rosie.first_page_time - rosie.start_time))
+    click.echo('Total wall-clock time : {:.1f}s'.format(now - rosie.start_time))
+
+
+def resume_scrape(db, tf, compress=(), workers=1, work_queue=None, validate=False):
     """
     Resume a unfinished scrape. Need to import a task file
+    The progress journaled since the task file was last written is replayed onto it first, and the task file is
+    compacted right away. Only the pages that are not recorded as completed are scraped again.
     :param db: Dictionary object to which the task information is stored
     :param tf: File descriptor for the task file
+    :param compress: Encodings of the compressed copies written next to every saved page, those of the task file
+                     if not given
+    :param workers: Number of processes scraping the pages, see shards.py
+    :param work_queue: Work queue of a distributed scrape, see distributed_scrape()
+    :param validate: Whether to check the pages with the verifier's rules before saving them, those of the task
+                     file are checked if it says so
     """
-    store = json.load(db)
     db.close()
+    store = journal.load_task(tf)
+    if compress:
+        store['compress'] = list(compress)
+    if validate:
+        store['validate'] = True
 
     db = open(tf, 'w')
-    rosie = crawler.Crawler(db=db, dictionary=store)
+    rosie = crawler.Crawler(db=db, dictionary=store, compress=store.get('compress') or (),
+                            validate=store.get('validate', False))
     # Restore variables from persistent file
     try:
         scrape_nodes = store['scrape_nodes']
@@ -299,93 +620,115 @@ def resume_scrape(db, tf):
         users_finished = store['users_finished']
         institutions_finished = store['institutions_finished']
         scrape_finished = store['scrape_finished']
-        milestone_url = store['milestone']
         rosie.node_urls = store['node_urls']
         rosie.registration_urls = store['registration_urls']
         rosie.user_urls = store['user_urls']
         rosie.institution_urls = store['institution_urls']
         if store['error_list'] is not None:
             rosie.error_list = store['error_list']
+        if store.get('attempts') is not None:
+            rosie.attempts = store['attempts']
+        if store.get('api_failures') is not None:
+            rosie.api_failures = store['api_failures']
+        rosie.completed = completion.completed_urls(store)
     except KeyError:
         click.echo('Cannot restore variables from file')
         return
+    rosie.compact_journal()
+    journal.discard_shard_journals(tf)
 
     if scrape_finished:
         click.echo("The scrape to resume was already finished")
         return
 
+    if not store.get('crawl_finished', True):
+        click.echo("The API crawl of this task did not finish, only the pages found before it stopped are resumed")
+
+    if work_queue is not None or workers > 1:
+        for list_name, scrape_flag, finished_flag in shards.PHASES:
+            if store[scrape_flag] and not store[finished_flag]:
+                requeue_outstanding(rosie, list_name)
+        if work_queue is not None:
+            distributed_scrape(rosie, store, work_queue)
+        elif not sharded_scrape(rosie, store, workers):
+            return
+        nodes_finished = registrations_finished = users_finished = institutions_finished = True
+
     if scrape_nodes and not nodes_finished:
-        if milestone_url in rosie.node_urls:
-            rosie.node_urls = rosie.node_urls[rosie.node_urls.index(milestone_url):]
+        requeue_outstanding(rosie, 'node_urls')
         rosie.scrape_nodes(async=True)
         store['nodes_finished'] = True
-        db.seek(0)
-        db.truncate()
-        json.dump(store, db, indent=4)
-        db.flush()
+        rosie.compact_journal()
 
     if scrape_registrations and not registrations_finished:
-        if milestone_url in rosie.registration_urls:
-            rosie.registration_urls = rosie.registration_urls[rosie.registration_urls.index(milestone_url):]
+        requeue_outstanding(rosie, 'registration_urls')
         rosie.scrape_registrations(async=True)
         store['registrations_finished'] = True
-        db.seek(0)
-        db.truncate()
-        json.dump(store, db, indent=4)
-        db.flush()
+        rosie.compact_journal()
 
     if scrape_users and not users_finished:
-        if milestone_url in rosie.user_urls:
-            rosie.user_urls = \
-                rosie.user_urls[rosie.user_urls.index(milestone_url):]
+        requeue_outstanding(rosie, 'user_urls')
         rosie.scrape_users()
         store['users_finished'] = True
-        db.seek(0)
-        db.truncate()
-        json.dump(store, db, indent=4)
-        db.flush()
+        rosie.compact_journal()
 
     if scrape_institutions and not institutions_finished:
-        if milestone_url in rosie.institution_urls:
-            rosie.institution_urls = rosie.institution_urls[rosie.institution_urls.index(milestone_url):]
+        requeue_outstanding(rosie, 'institution_urls')
         rosie.scrape_institutions()
         store['institutions_finished'] = True
-        db.seek(0)
-        db.truncate()
-        json.dump(store, db, indent=4)
-        db.flush()
+        rosie.compact_journal()
 
     store['scrape_finished'] = True
-    db.seek(0)
-    db.truncate()
-    json.dump(store, db, indent=4)
-    db.flush()
+    rosie.compact_journal()
+    rosie.close()
+    report_timings(rosie)
 
 
-def verify_mirror(tf, rn):
+def requeue_outstanding(rosie, list_name):
+    """
+    Narrows one url list of a resumed crawler down to the pages not completed yet, and echoes how many pages are
+    skipped and re-queued. The list in the task file keeps every url, since the completion bitmaps refer to it.
+    Failed urls that are re-queued leave the error list until they fail again.
+    :param rosie: Crawler restored by resume_scrape
+    :param list_name: e.g. 'node_urls'
+    """
+    urls = getattr(rosie, list_name) or []
+    outstanding = completion.outstanding(urls, rosie.completed)
+    setattr(rosie, list_name, outstanding)
+    if rosie.error_list:
+        requeued = set(outstanding)
+        rosie.error_list = [url for url in rosie.error_list if url not in requeued]
+        rosie.dictionary['error_list'] = rosie.error_list
+    click.echo('{} : {} pages already scraped, {} re-queued'.format(list_name, len(urls) - len(outstanding),
+                                                                  len(outstanding)))
+
+
+def verify_mirror(tf, rn, workers=settings.VERIFY_WORKERS):
     """
     To verify a scraped mirror. Need to import task file.
     :param tf: File descriptor of the task file
     :param rn: Number of retry times
+    :param workers: Number of processes spot checking the pages, None for one per CPU
     """
     for i in range(rn):
-        verifier.main(tf, i)
+        verifier.main(tf, i, workers)
 
 
-def resume_verify_mirror(tf, rn):
+def resume_verify_mirror(tf, rn, workers=settings.VERIFY_WORKERS):
     """
     Resume the verifying and rescraping process, neeed to import task file
     :param tf: File descriptor of the task file
     :param rn: Number of times of rretry
+    :param workers: Number of processes spot checking the pages, None for one per CPU
     """
     with codecs.open(tf, mode='r', encoding='utf-8') as failure_file:
         run_info = json.load(failure_file)
     if run_info['1st_verification_finished']:
         for i in range(rn):
-            verifier.resume_verification(tf)
+            verifier.resume_verification(tf, workers)
     else:
         for i in range(rn):
-            verifier.main(tf, i)
+            verifier.main(tf, i, workers)
 
 
 def delete_nodes(ctf):
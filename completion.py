@@ -0,0 +1,70 @@
+"""Record of the completed pages of a scrape task, stored as bitmaps over the url lists of the task file"""
+
+import base64
+
+# Url lists of the task file the bitmaps are kept for
+URL_LISTS = ['node_urls', 'registration_urls', 'user_urls', 'institution_urls']
+
+
+def encode(urls, done):
+    """
+    Bitmap over the positions of a url list, bit i set if urls[i] is done, as a base64 string.
+    :param urls: url list of the task file
+    :param done: set of the completed urls
+    """
+    bits = bytearray((len(urls) + 7) // 8)
+    for i, url in enumerate(urls):
+        if url in done:
+            bits[i >> 3] |= 1 << (i & 7)
+    return base64.b64encode(bytes(bits)).decode('ascii')
+
+
+def decode(urls, data):
+    """
+    Urls of a url list whose bit is set in a bitmap made by encode(). Urls appended to the list after the bitmap
+    was made are not completed.
+    :param urls: url list of the task file
+    :param data: base64 string made by encode(), or None
+    :return: set of the completed urls
+    """
+    done = set()
+    if not data:
+        return done
+    bits = base64.b64decode(data)
+    for byte_index, byte in enumerate(bits):
+        if not byte:
+            continue
+        for bit in range(8):
+            i = (byte_index << 3) + bit
+            if byte & (1 << bit) and i < len(urls):
+                done.add(urls[i])
+    return done
+
+
+def completed_urls(store):
+    """
+    Set of all completed urls recorded in the dictionary of a task file, under its 'completed' key.
+    """
+    bitmaps = store.get('completed') or {}
+    done = set()
+    for list_name in URL_LISTS:
+        if store.get(list_name):
+            done |= decode(store[list_name], bitmaps.get(list_name))
+    return done
+
+
+def encode_store(store, done):
+    """
+    Bitmaps of every url list of the dictionary of a task file, to be stored under its 'completed' key.
+    :param store: dictionary of the task file
+    :param done: set of the completed urls
+    :return: {list name: base64 bitmap}
+    """
+    return {list_name: encode(store[list_name], done) for list_name in URL_LISTS if store.get(list_name)}
+
+
+def outstanding(urls, done):
+    """
+    The urls of a list that are not done yet, in order.
+    """
+    return [url for url in urls if url not in done]
@@ -0,0 +1,52 @@
+"""Precompressed siblings of mirror files (index.html.gz, index.html.br) for nginx gzip_static / brotli_static"""
+
+import gzip
+import io
+
+import settings
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Encodings that can be asked for, and the suffix of their sibling file
+ENCODINGS = {
+    'gzip': '.gz',
+    'brotli': '.br',
+}
+
+
+def check_encodings(encodings):
+    """
+    Raises ValueError if one of the encodings is unknown or its module is not installed.
+    :param encodings: e.g. ['gzip', 'brotli']
+    """
+    for encoding in encodings:
+        if encoding not in ENCODINGS:
+            raise ValueError("Unknown encoding: " + encoding)
+        if encoding == 'brotli' and brotli is None:
+            raise ValueError("brotli compression needs the brotli module: pip install brotli")
+
+
+def sibling_path(path, encoding):
+    """
+    File name of the compressed sibling of a file, e.g. index.html -> index.html.gz
+    """
+    return path + ENCODINGS[encoding]
+
+
+def compress(data, encoding):
+    """
+    :param data: bytes to compress
+    :param encoding: 'gzip' or 'brotli'
+    :return: compressed bytes. gzip output carries no timestamp, so the same page always compresses the same.
+    """
+    if encoding == 'gzip':
+        buffer = io.BytesIO()
+        with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=settings.GZIP_LEVEL, mtime=0) as file:
+            file.write(data)
+        return buffer.getvalue()
+    if encoding == 'brotli':
+        return brotli.compress(data, quality=settings.BROTLI_QUALITY)
+    raise ValueError("Unknown encoding: " + encoding)
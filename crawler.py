@@ -1,18 +1,40 @@
 import asyncio
 import aiohttp
+import cassette
+import cgi
+import concurrent.futures
 import json
 import datetime
+import heapq
 import os
-import sys
+import time
 import settings
-import requests
-import math
 import collections
+import completion
+import digests
 import logging
+import logs
+import metrics
 import tqdm
+import urllib.parse
+import verifier
 
 # Configure for testing in settings.py
 from settings import base_urls
+from httpcache import ValidatorCache
+from journal import Journal, journal_path
+from pager import ApiPager
+from retry import RetryPolicy
+from rewriter import Rewriter, Rule
+from scheduler import PageScheduler, PageStats, page_type
+from throttle import AdaptiveLimiter
+from writer import PageWriter
+
+# What _fetch() hands back: the response status, its headers and the raw body bytes
+FetchResult = collections.namedtuple('FetchResult', ['status', 'headers', 'body'])
+
+# Status of a page that came back 200 but failed validation (--validate), see verifier.PageValidator
+INVALID = 'invalid'
 
 
 class Crawler:
@@ -31,13 +53,18 @@ class Crawler:
         the urls stored in those lists.
     """
 
-    def __init__(self, date_modified=None, db=None, dictionary=None):
+    def __init__(self, date_modified=None, db=None, dictionary=None, retry_policy=None, compress=(), validate=False):
         """
         Constructor for the Crawler class
 
         :param date_modified: Cut off date for scraping. Nodes modified prior to this date is ignored during scraping
-        :param db: File descriptor for reading information from persistent file
+        :param db: File descriptor for reading information from persistent file. Progress is appended to a journal
+                   next to it (see journal.py) and folded into it by compact_journal()
         :param dictionary: A dictionary that stores copy of persistent file
+        :param retry_policy: RetryPolicy for page requests, defaults to the one configured in settings.py
+        :param compress: encodings of the compressed siblings written next to every saved page, e.g. ['gzip']
+        :param validate: whether to check every received page with the verifier's rules before saving it, see
+                         verifier.PageValidator. Pages that fail are retried on the spot and never saved
         """
         # Use this header in request to trigger Prerender
         self.headers = {
@@ -64,6 +91,13 @@ class Crawler:
         self.general_urls = [self.http_base, self.http_base + 'support/', self.http_base + 'explore/activity/']
         # List of 504s:
         self.error_list = []
+        # Pages of API listings that failed for good: their records are missing from the url lists
+        self.api_failures = []
+        # Urls of the pages saved so far, stored in the task file as bitmaps over the url lists (see completion.py)
+        self.completed = set()
+        # Retried or failed pages: {url: {'attempts': number of attempts, 'status': final status}}
+        self.attempts = {}
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
         # For sorting
         self.node_url_tuples = []
         self.registration_url_tuples = []
@@ -74,32 +108,163 @@ class Crawler:
 
         # Logging utils
         logging.basicConfig(level=logging.DEBUG)
-        # Logger for all debug infos
-        self.debug_logger = logging.getLogger('debug')
-        self.debug_logger.propagate = 0
-        # Console handler for debug logger
-        self.console_log_handler = logging.StreamHandler()
-        self.console_log_handler.setLevel(logging.CRITICAL)
-        # Debug file handler for debug logger
-        self.debug_log_handler = logging.FileHandler(settings.DEBUG_LOG_FILENAME, mode='w')
-        self.debug_log_handler.setLevel(logging.DEBUG)
-        # Error file handler for debug logger
-        self.error_log_handler = logging.FileHandler(settings.ERROR_LOG_FILENAME, mode='w')
-        self.error_log_handler.setLevel(logging.ERROR)
-        # Adding handlers to debug logger
-        self.debug_logger.addHandler(self.console_log_handler)
-        self.debug_logger.addHandler(self.debug_log_handler)
-        self.debug_logger.addHandler(self.error_log_handler)
+        # Logger for all debug infos, written to the debug and error logs by a background thread (see logs.py).
+        # Messages take their values as arguments ("Finished : %s", url), formatted only if the level is on
+        self.debug_logger = logs.setup()
 
         # File descriptor for persistent saving
         if db is None:
             self.database = None
         else:
             self.database = db
+        self.journal = Journal(journal_path(db.name)) if db is not None else None
 
         # Holds temporary copy of persistent file in memory
         self.dictionary = dictionary
 
+        # Wall-clock timings, reported by the CLI: when the crawler started and when the first page was saved
+        self.start_time = time.monotonic()
+        self.first_page_time = None
+
+        # Adaptive concurrency limits (see throttle.py) for API listings, wiki listings and page scraping
+        self.api_limiter = AdaptiveLimiter('api', settings.API_CONCURRENCY_INITIAL,
+                                           maximum=settings.API_CONCURRENCY_MAX,
+                                           latency_target=settings.API_LATENCY_TARGET,
+                                           logger=self.debug_logger)
+        self.wiki_limiter = AdaptiveLimiter('wiki', settings.WIKI_CONCURRENCY_INITIAL,
+                                            maximum=settings.API_CONCURRENCY_MAX,
+                                            latency_target=settings.API_LATENCY_TARGET,
+                                            logger=self.debug_logger)
+        self.page_limiter = AdaptiveLimiter('pages', settings.PAGE_CONCURRENCY_INITIAL,
+                                            minimum=settings.PAGE_CONCURRENCY_MIN,
+                                            maximum=settings.PAGE_CONCURRENCY_MAX,
+                                            latency_target=settings.PAGE_LATENCY_TARGET,
+                                            logger=self.debug_logger)
+        for limiter in [self.api_limiter, self.wiki_limiter, self.page_limiter]:
+            metrics.REGISTRY.set('rosie_in_flight', lambda limiter=limiter: limiter.in_flight, limiter=limiter.name)
+            metrics.REGISTRY.set('rosie_concurrency_limit', lambda limiter=limiter: limiter.limit,
+                                 limiter=limiter.name)
+        # Cost of the page types, learnt while scraping; the page scrape is scheduled on it, see scheduler.py
+        self.page_stats = PageStats()
+
+        # Thread pool writing the scraped pages to the mirror, see writer.py. Pages whose content did not change
+        # since the last scrape are not written again, and the new and changed ones are listed in <task>.changed
+        self.writer = PageWriter(compress=compress,
+                                 digest_store=digests.DigestStore(settings.DIGEST_STORE_FILENAME),
+                                 changes_file=os.path.splitext(db.name)[0] + '.changed' if db is not None else None)
+        if dictionary is not None and dictionary.get('page_changes'):
+            self.writer.changes.update(dictionary['page_changes'])
+
+        # ETag / Last-Modified of earlier responses, for conditional page and wiki requests, see httpcache.py
+        self.validators = ValidatorCache(settings.VALIDATOR_CACHE_FILENAME)
+
+        # Long-lived aiohttp sessions keyed by host (osf.io, api.osf.io), created on first use by _get_session()
+        self._sessions = {}
+
+        # Checks of the received pages (--validate), None not to check them
+        self.page_validator = verifier.PageValidator() if validate else None
+
+        # Cassette the responses are recorded to or played back from (cli.py --record, --replay), see cassette.py
+        self.cassette = cassette.current()
+
+    def _get_session(self, url):
+        """
+        Returns the shared aiohttp session for the host of url, creating it on first use.
+        Every request to a host goes through the same pooled connector, so TCP/TLS connections are kept alive
+        and reused instead of being opened again for every page.
+        :param url: url about to be requested
+        """
+        host = urllib.parse.urlsplit(url).netloc
+        session = self._sessions.get(host)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit=settings.CONNECTION_LIMIT_PER_HOST,
+                                             keepalive_timeout=settings.KEEPALIVE_TIMEOUT,
+                                             use_dns_cache=settings.USE_DNS_CACHE)
+            session = aiohttp.ClientSession(connector=connector)
+            self._sessions[host] = session
+        return session
+
+    async def _fetch(self, url, headers=None, limiter=None, phase=None, kind=''):
+        """
+        Asynchronous method that GETs url through the shared session of its host.
+        The connection is released back to the pool (not closed) once the body is read.
+        :param url: url to request
+        :param headers: extra request headers
+        :param limiter: AdaptiveLimiter the request holds a slot of, and reports its outcome to
+        :param phase: phase of the request in the metrics, e.g. 'pages', the name of the limiter by default
+        :param kind: page type of the request in the metrics, see scheduler.page_type()
+        :return: FetchResult(status, headers, body)
+        """
+        if phase is None:
+            phase = limiter.name if limiter is not None else 'other'
+        if limiter is None:
+            return await self._measured_get(url, headers, phase, kind)
+        async with limiter.slot() as slot:
+            response = await self._measured_get(url, headers, phase, kind)
+            slot.status = response.status
+            return response
+
+    async def _measured_get(self, url, headers, phase, kind):
+        started = time.monotonic()
+        try:
+            response = await self._get(url, headers)
+        except Exception:
+            metrics.REGISTRY.inc('rosie_responses_total', phase=phase, status='error')
+            raise
+        metrics.REGISTRY.observe('rosie_request_seconds', time.monotonic() - started, phase=phase, type=kind)
+        metrics.REGISTRY.inc('rosie_responses_total', phase=phase, status=response.status)
+        metrics.REGISTRY.inc('rosie_downloaded_bytes_total', len(response.body), phase=phase)
+        return response
+
+    async def _get(self, url, headers):
+        if self.cassette is None:
+            return await self._request(url, headers)
+        if self.cassette.replaying:
+            return await self._replay(url)
+        started = time.monotonic()
+        try:
+            response = await self._request(url, headers)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.cassette.record(url, None, seconds=time.monotonic() - started, error=type(e).__name__)
+            raise
+        self.cassette.record(url, response.status, response.headers, response.body, time.monotonic() - started)
+        return response
+
+    async def _replay(self, url):
+        recording = self.cassette.play(url)
+        if recording.seconds:
+            await asyncio.sleep(recording.seconds)
+        if recording.error == 'TimeoutError':
+            raise asyncio.TimeoutError()
+        if recording.error is not None:
+            raise aiohttp.ClientError("Replayed {} : {}".format(recording.error, url))
+        return FetchResult(recording.status, recording.headers, recording.body)
+
+    async def _request(self, url, headers):
+        session = self._get_session(url)
+        response = await session.get(url, headers=headers)
+        try:
+            body = await response.read()
+        finally:
+            await response.release()
+        return FetchResult(response.status, response.headers, body)
+
+    def close(self):
+        """
+        Closes the shared sessions and their pooled connections, and the journal. Call once the crawler is no
+        longer needed.
+        """
+        loop = asyncio.get_event_loop()
+        for session in self._sessions.values():
+            closing = session.close()
+            if closing is not None:  # Newer aiohttp versions return an awaitable
+                loop.run_until_complete(closing)
+        self._sessions.clear()
+        self.writer.close()
+        self.validators.close()
+        if self.journal is not None:
+            self.journal.close()
+
     def _truncate_registration_url_tuples(self):
         """
         Called by crawl_registrations_api() to truncate self.registration_url_tuples according to
@@ -126,31 +291,15 @@ class Crawler:
     def crawl_nodes_api(self, page_limit=0):
         """
         The runner method that runs parse_nodes_api(), which will populate the list of self.node_url_tuples.
-        After self.node_url_tuples is populated, _truncate_node_url_tuples() will be called to truncate the list
-        according to self.date_modified_marker.
+        Only nodes modified after self.date_modified_marker are requested from the API.
         :param page_limit: Number of pages of API to crawl. If page_limit=0, then crawl all pages.
         """
-        sem = asyncio.BoundedSemaphore(value=10)
-
         self.debug_logger.info("\nStart crawling nodes API pages")
-
-        # Request number of pages in nodes API
-        with requests.Session() as s:
-            response = s.get(self.api_base + 'nodes/' + '?filter[date_modified][gte]=' + self.date_modified_marker.isoformat(sep='T'))
-            j = response.json()
-            num_pages = math.ceil(j['links']['meta']['total'] / j['links']['meta']['per_page'])
-            if num_pages < page_limit or page_limit == 0:
-                page_limit = num_pages
-        tasks = []
-        for i in range(1, page_limit + 1):
-            tasks.append(asyncio.ensure_future(self.parse_nodes_api(
-                self.api_base + 'nodes/' + '?filter[date_modified][gte]=' +
-                self.date_modified_marker.isoformat(sep='T') +
-                '&page=' + str(i),
-                sem
-            )))
         loop = asyncio.get_event_loop()
-        loop.run_until_complete(self._wait_with_progress_bar(tasks))
+        loop.run_until_complete(self.parse_nodes_api(
+            self.api_base + 'nodes/' + '?filter[date_modified][gte]=' + self.date_modified_marker.isoformat(sep='T'),
+            page_limit
+        ))
         self.debug_logger.info("Finished crawling nodes API pages")
 
     def crawl_registrations_api(self, page_limit=0):
@@ -161,31 +310,10 @@ class Crawler:
         the list according to self.date_modified_marker.
         :param page_limit: Number of pages of API to crawl. If page_limit=0, then crawl all pages.
         """
-        self.debug_logger.info("Start crawling registration API pages")
-        # Setting a semaphore for rate limiting
-        sem = asyncio.BoundedSemaphore(value=10)
-
         self.debug_logger.info("\nStart crawling registrations API pages")
-
-        # Request number of pages in nodes API
-        with requests.Session() as s:
-            response = s.get(self.api_base + 'registrations/')
-            j = response.json()
-            num_pages = math.ceil(j['links']['meta']['total'] / j['links']['meta']['per_page'])
-            if j['links']['meta']['total'] == 0:
-                print("No registrations.")
-                return
-            if num_pages < page_limit or page_limit == 0:
-                page_limit = num_pages
-        tasks = []
-        for i in range(1, page_limit + 1):
-            tasks.append(asyncio.ensure_future(self.parse_registrations_api(
-                self.api_base + 'registrations/?page=' + str(i),
-                sem
-            )))
         loop = asyncio.get_event_loop()
-        loop.run_until_complete(self._wait_with_progress_bar(tasks))
-        self.debug_logger.info("Start crawling registration API pages")
+        loop.run_until_complete(self.parse_registrations_api(self.api_base + 'registrations/', page_limit))
+        self.debug_logger.info("Finished crawling registration API pages")
         self._truncate_registration_url_tuples()
 
     def crawl_users_api(self, page_limit=0):
@@ -193,28 +321,9 @@ class Crawler:
         The runner method that runs parse_users_api(), which will populate the list of self.user_urls.
         :param page_limit: Number of pages of API to crawl. If page_limit=0, then crawl all pages.
         """
-        self.debug_logger.info("Start crawling user API pages")
-        # Setting a semaphore for rate limiting
-        sem = asyncio.BoundedSemaphore(value=10)
-
         self.debug_logger.info("\nStart crawling users API pages")
-
-        # Request number of pages in nodes API
-        with requests.Session() as s:
-            response = s.get(self.api_base + 'users/')
-            j = response.json()
-            num_pages = math.ceil(j['links']['meta']['total'] / j['links']['meta']['per_page'])
-            if num_pages < page_limit or page_limit == 0:
-                page_limit = num_pages
-        tasks = []
-        for i in range(1, page_limit + 1):
-            tasks.append(asyncio.ensure_future(self.parse_users_api(
-                self.api_base + 'users/?page=' + str(i),
-                sem
-            )))
         loop = asyncio.get_event_loop()
-
-        loop.run_until_complete(self._wait_with_progress_bar(tasks))
+        loop.run_until_complete(self.parse_users_api(self.api_base + 'users/', page_limit))
         self.debug_logger.info("Finished crawling user API pages")
 
     def crawl_institutions_api(self, page_limit=0):
@@ -222,132 +331,117 @@ class Crawler:
         The runner method that runs parse_institutions_api(), which will populate the list of self.institution_urls.
         :param page_limit: Number of pages of API to crawl. If page_limit=0, then crawl all pages.
         """
-        self.debug_logger.info("Start crawling institution API pages")
-        # Setting a semaphore for rate limiting
-        sem = asyncio.BoundedSemaphore(value=10)
-
         self.debug_logger.info('\nStart crawling institution API pages')
-
-        # Request number of pages in nodes API
-        with requests.Session() as s:
-            response = s.get(self.api_base + 'institutions/')
-            j = response.json()
-            num_pages = math.ceil(j['links']['meta']['total'] / j['links']['meta']['per_page'])
-            if j['links']['meta']['total'] == 0:
-                print("No institutions.")
-                return
-            if num_pages < page_limit or page_limit == 0:
-                page_limit = num_pages
-        tasks = []
-        for i in range(1, page_limit + 1):
-            tasks.append(asyncio.ensure_future(self.parse_institutions_api(
-                self.api_base + 'institutions/?page=' + str(i),
-                sem
-            )))
         loop = asyncio.get_event_loop()
-        loop.run_until_complete(self._wait_with_progress_bar(tasks))
+        loop.run_until_complete(self.parse_institutions_api(self.api_base + 'institutions/', page_limit))
         self.debug_logger.info("Finished crawling institution API pages")
 
+    def _pager(self, api_url, page_limit=0):
+        """
+        Returns an ApiPager over the listing at api_url that reports its progress on a tqdm bar.
+        :param api_url: url of the first page of the listing
+        :param page_limit: Number of pages of API to crawl. If page_limit=0, then crawl all pages.
+        """
+        return ApiPager(self, api_url, page_limit=page_limit, progress=tqdm.tqdm(unit=' records'))
+
 # API Scraping
 
-    async def parse_nodes_api(self, api_url, sem):
+    async def parse_nodes_api(self, api_url, page_limit=0):
         """
-        Asynchronous scraping method that scrapes the V2 Nodes API for list of public facing nodes
+        Asynchronous scraping method that streams the V2 Nodes API for list of public facing nodes
         (excluding registrations). Called by crawl_nodes_api(), which is the runner method for crawling the nodes API.
         Compiles a list of self.node_url_tuples that stores tuples as list elements in the format of (url, datetime)
         e.g. ('http://osf.io/mst3k', datetime.datetime(2016, 6, 24, 9, 13, 59, 254173))
         self.node_url_tuples will be sorted in ascending order according to the datetime object in the tuple.
-        (The tuple that contains earliest datetime object comes first)
-        :param api_url: list of V2 Nodes API endpoints to scrape
-        :param sem: rate limiting semaphore
-        """
-        async with sem:
-            async with aiohttp.ClientSession() as s:
-                self.debug_logger.info("Crawling nodes api, url = " + api_url)
-                response = await s.get(api_url)
-                body = await response.read()
-                response.close()
-                json_body = json.loads(body.decode('utf-8'))
-                data = json_body['data']
-                for element in data:
-                    date_str = element['attributes']['date_modified']
-                    if '.' in date_str:
-                        date = datetime.datetime.strptime(date_str, "%Y-%m-%dT%H:%M:%S.%f")
-                    else:
-                        date = datetime.datetime.strptime(date_str, "%Y-%m-%dT%H:%M:%S")
-                    self.node_url_tuples.append((self.http_base + element['id'] + '/', date))
-                    self.node_url_tuples.sort(key=lambda x: x[1])
-
-    async def parse_registrations_api(self, api_url, sem):
-        """
-        Asynchronous scraping method that scrapes the V2 Registrations API for list of registrations
+        (The tuple that contains earliest datetime object comes first). Records are collected in sorted runs
+        that are merged into self.node_url_tuples once the listing is exhausted.
+        :param api_url: V2 Nodes API endpoint to stream, links.next is followed from there
+        :param page_limit: Number of pages of API to crawl. If page_limit=0, then crawl all pages.
+        """
+        self.debug_logger.info("Crawling nodes api, url = " + api_url)
+        node_runs = SortedRuns(key=lambda x: x[1])
+        async for element in self._pager(api_url, page_limit):
+            node_runs.append(self._node_tuple(element))
+        self.node_url_tuples = node_runs.merge(self.node_url_tuples)
+
+    async def parse_registrations_api(self, api_url, page_limit=0):
+        """
+        Asynchronous scraping method that streams the V2 Registrations API for list of registrations
         Called by crawl_registrations_api(), which is the runner method for crawling the Registrations API.
         Compiles a list of self.registration_url_tuples that stores tuples as list elements in the format of
         (url, datetime) e.g. ('http://osf.io/mst3k', datetime.datetime(2016, 6, 24, 9, 13, 59, 254173))
         self.registration_url_tuples will be sorted in ascending order according to the datetime object in the tuple.
-        (The tuple that contains earliest datetime object comes first)
-        :param api_url: list of V2 Registrations API endpoints to scrape
-        :param sem: rate limiting semaphore
-        """
-        async with sem:
-            async with aiohttp.ClientSession() as s:
-                self.debug_logger.info("Crawling registrations api, url = " + api_url)
-                response = await s.get(api_url)
-                body = await response.read()
-                response.close()
-                json_body = json.loads(body.decode('utf-8'))
-                data = json_body['data']
-                for element in data:
-                    date_str = element['attributes']['date_modified']
-                    # TODO: probably not a good long term solution. should change this
-                    if date_str is None:
-                        date_str = element['attributes']['date_registered']
-                    if '.' in date_str:
-                        date = datetime.datetime.strptime(date_str, "%Y-%m-%dT%H:%M:%S.%f")
-                    else:
-                        date = datetime.datetime.strptime(date_str, "%Y-%m-%dT%H:%M:%S")
-                    self.registration_url_tuples.append((self.http_base + element['id'] + '/', date))
-                    self.registration_url_tuples.sort(key=lambda x: x[1])
-
-    async def parse_users_api(self, api_url, sem):
-        """
-        Asynchronous scraping method that scrapes the V2 Users API for list of users.
-        Called by crawl_users_api(), which is the runner method for crawling the Users API.
-        Compiles a list of self.user_urls.
-        Note: self.user_urls does not persist any order.
-        :param api_url: list of V2 Users API endpoints to scrape
-        :param sem: rate limiting semaphore
-        """
-        async with sem:
-            async with aiohttp.ClientSession() as s:
-                self.debug_logger.info("Crawling users api, url = " + api_url)
-                response = await s.get(api_url)
-                body = await response.read()
-                response.close()
-                json_body = json.loads(body.decode('utf-8'))
-                data = json_body['data']
-                for element in data:
-                    self.user_urls.append(self.http_base + element['id'] + '/')
-
-    async def parse_institutions_api(self, api_url, sem):
-        """
-        Asynchronous scraping method that scrapes the V2 Users API for list of users.
+        (The tuple that contains earliest datetime object comes first). Records are collected in sorted runs
+        that are merged into self.registration_url_tuples once the listing is exhausted.
+        :param api_url: V2 Registrations API endpoint to stream, links.next is followed from there
+        :param page_limit: Number of pages of API to crawl. If page_limit=0, then crawl all pages.
+        """
+        self.debug_logger.info("Crawling registrations api, url = " + api_url)
+        registration_runs = SortedRuns(key=lambda x: x[1])
+        pager = self._pager(api_url, page_limit)
+        async for element in pager:
+            registration_runs.append(self._registration_tuple(element))
+        self.registration_url_tuples = registration_runs.merge(self.registration_url_tuples)
+        if pager.total == 0:
+            print("No registrations.")
+
+    async def parse_users_api(self, api_url, page_limit=0):
+        """
+        Asynchronous scraping method that streams the V2 Users API for list of users.
         Called by crawl_users_api(), which is the runner method for crawling the Users API.
         Compiles a list of self.user_urls.
         Note: self.user_urls does not persist any order.
-        :param api_url: list of V2 Users API endpoints to scrape
-        :param sem: rate limiting semaphore
-        """
-        async with sem:
-            async with aiohttp.ClientSession() as s:
-                self.debug_logger.info("Crawling institutions api, url = " + api_url)
-                response = await s.get(api_url)
-                body = await response.read()
-                response.close()
-                json_body = json.loads(body.decode('utf-8'))
-                data = json_body['data']
-                for element in data:
-                    self.institution_urls.append(self.http_base + element['id'] + '/')
+        :param api_url: V2 Users API endpoint to stream, links.next is followed from there
+        :param page_limit: Number of pages of API to crawl. If page_limit=0, then crawl all pages.
+        """
+        self.debug_logger.info("Crawling users api, url = " + api_url)
+        async for element in self._pager(api_url, page_limit):
+            self.user_urls.append(self.http_base + element['id'] + '/')
+
+    async def parse_institutions_api(self, api_url, page_limit=0):
+        """
+        Asynchronous scraping method that streams the V2 Institutions API for list of institutions.
+        Called by crawl_institutions_api(), which is the runner method for crawling the Institutions API.
+        Compiles a list of self.institution_urls.
+        Note: self.institution_urls does not persist any order.
+        :param api_url: V2 Institutions API endpoint to stream, links.next is followed from there
+        :param page_limit: Number of pages of API to crawl. If page_limit=0, then crawl all pages.
+        """
+        self.debug_logger.info("Crawling institutions api, url = " + api_url)
+        pager = self._pager(api_url, page_limit)
+        async for element in pager:
+            self.institution_urls.append(self.http_base + element['id'] + '/')
+        if pager.total == 0:
+            print("No institutions.")
+
+    def _node_tuple(self, element):
+        """
+        (url, datetime) tuple of a record of the V2 Nodes API
+        """
+        return self.http_base + element['id'] + '/', parse_date(element['attributes']['date_modified'])
+
+    def _registration_tuple(self, element):
+        """
+        (url, datetime) tuple of a record of the V2 Registrations API
+        """
+        date_str = element['attributes']['date_modified']
+        # TODO: probably not a good long term solution. should change this
+        if date_str is None:
+            date_str = element['attributes']['date_registered']
+        return self.http_base + element['id'] + '/', parse_date(date_str)
+
+    async def list_api_ids(self, endpoint):
+        """
+        Asynchronous method that streams a whole API listing and returns the ids of its records.
+        Used by the CLI to compile the list of active nodes, users and registrations.
+        :param endpoint: listing relative to the API base, e.g. 'nodes/'
+        :return: list of ids (GUIDs)
+        """
+        self.debug_logger.info("Listing ids of " + endpoint)
+        ids = []
+        async for element in self._pager(self.api_base + endpoint):
+            ids.append(element['id'])
+        return ids
 
 # Generating URLs for Nodes and Registrations
 
@@ -377,25 +471,34 @@ class Crawler:
                                " registrations = " + str(registrations) +
                                " forks = " + str(forks))
 
-        url_list = [x[0] for x in self.node_url_tuples]
-
-        for base_url in url_list:
-            if dashboard:
-                self.node_urls.append(base_url)
-            if files:
-                self.node_urls.append(base_url + 'files/')
-            if wiki:
-                wiki_name_list = self._node_wikis_by_parent_guid[base_url.strip("/").split("/")[-1]]
-                wiki_url_list = [base_url + 'wiki/' + x + '/' for x in wiki_name_list]
-                self.node_urls += wiki_url_list
-
-                # the strip split -1 bit returns the last section of the base_url, which is the GUId
-            if analytics:
-                self.node_urls.append(base_url + 'analytics/')
-            if registrations:
-                self.node_urls.append(base_url + 'registrations/')
-            if forks:
-                self.node_urls.append(base_url + 'forks/')
+        for base_url in [x[0] for x in self.node_url_tuples]:
+            self.node_urls += self.node_page_urls(base_url, dashboard=dashboard, files=files, wiki=wiki,
+                                                  analytics=analytics, registrations=registrations, forks=forks)
+
+    def node_page_urls(self, base_url, dashboard=False, files=False,
+                       wiki=False, analytics=False, registrations=False, forks=False):
+        """
+        Returns the urls of the requested pages of one node, in the order they are scraped.
+        Wiki pages come from self._node_wikis_by_parent_guid, so the node's wikis must have been crawled first.
+        :param base_url: url of the node, e.g. 'https://osf.io/mst3k/'
+        :return: list of page urls
+        """
+        urls = []
+        if dashboard:
+            urls.append(base_url)
+        if files:
+            urls.append(base_url + 'files/')
+        if wiki:
+            # the strip split -1 bit returns the last section of the base_url, which is the GUId
+            wiki_name_list = self._node_wikis_by_parent_guid[base_url.strip("/").split("/")[-1]]
+            urls += [base_url + 'wiki/' + x + '/' for x in wiki_name_list]
+        if analytics:
+            urls.append(base_url + 'analytics/')
+        if registrations:
+            urls.append(base_url + 'registrations/')
+        if forks:
+            urls.append(base_url + 'forks/')
+        return urls
 
     def generate_registration_urls(self, all_pages=True, dashboard=False, files=False,
                                    wiki=False, analytics=False, forks=False):
@@ -423,22 +526,34 @@ class Crawler:
                                " forks = " + str(forks)
                                )
 
-        url_list = [x[0] for x in self.registration_url_tuples]
-
-        for base_url in url_list:
-            if all_pages or dashboard:
-                self.registration_urls.append(base_url)
-            if all_pages or files:
-                self.registration_urls.append(base_url + 'files/')
-            if all_pages or wiki:
-                # the strip split -1 bit returns the last section of the base_url, which is the GUId
-                wiki_name_list = self._registration_wikis_by_parent_guid[base_url.strip("/").split("/")[-1]]
-                wiki_url_list = [base_url + 'wiki/' + x + '/' for x in wiki_name_list]
-                self.registration_urls += wiki_url_list
-            if all_pages or analytics:
-                self.registration_urls.append(base_url + 'analytics/')
-            if all_pages or forks:
-                self.registration_urls.append(base_url + 'forks/')
+        for base_url in [x[0] for x in self.registration_url_tuples]:
+            self.registration_urls += self.registration_page_urls(base_url, all_pages=all_pages, dashboard=dashboard,
+                                                                  files=files, wiki=wiki, analytics=analytics,
+                                                                  forks=forks)
+
+    def registration_page_urls(self, base_url, all_pages=True, dashboard=False, files=False,
+                               wiki=False, analytics=False, forks=False):
+        """
+        Returns the urls of the requested pages of one registration, in the order they are scraped.
+        Wiki pages come from self._registration_wikis_by_parent_guid, so the registration's wikis must have been
+        crawled first.
+        :param base_url: url of the registration, e.g. 'https://osf.io/mst3k/'
+        :return: list of page urls
+        """
+        urls = []
+        if all_pages or dashboard:
+            urls.append(base_url)
+        if all_pages or files:
+            urls.append(base_url + 'files/')
+        if all_pages or wiki:
+            # the strip split -1 bit returns the last section of the base_url, which is the GUId
+            wiki_name_list = self._registration_wikis_by_parent_guid[base_url.strip("/").split("/")[-1]]
+            urls += [base_url + 'wiki/' + x + '/' for x in wiki_name_list]
+        if all_pages or analytics:
+            urls.append(base_url + 'analytics/')
+        if all_pages or forks:
+            urls.append(base_url + 'forks/')
+        return urls
 
     def crawl_node_wiki(self):
         """
@@ -447,37 +562,26 @@ class Crawler:
         """
         self.debug_logger.info("Start crawling node wiki API pages")
         tasks = []
-        sem = asyncio.BoundedSemaphore(value=5)
 
         self.debug_logger.info("\nCrawling node wiki API pages")
 
         for node_url in [x[0] for x in self.node_url_tuples]:
-            tasks.append(asyncio.ensure_future(self.get_node_wiki_names(node_url.strip('/').split('/')[-1], sem)))
+            tasks.append(asyncio.ensure_future(self.get_node_wiki_names(node_url.strip('/').split('/')[-1])))
         loop = asyncio.get_event_loop()
         loop.run_until_complete(self._wait_with_progress_bar(tasks))
         self.debug_logger.info("Finished crawling node wiki API pages")
 
-    async def get_node_wiki_names(self, parent_node, sem):
+    async def get_node_wiki_names(self, parent_node):
         """
         Asynchronous scraping method for scraping the V2 Node Wikis API.
+        Requests are limited by self.wiki_limiter.
         :param parent_node: list of parent nodes to which wiki pages are attached
-        :param sem: rate limiting semaphore
-        """
-        async with sem:
-            async with aiohttp.ClientSession() as s:
-                u = self.api_base + 'nodes/' + parent_node + '/wikis/'
-                # self.debug_logger.info("Crawling nodes api, url = " + u)
-                response = await s.get(u)
-                body = await response.read()
-                response.close()
-                if response.status <= 200:
-                    json_body = json.loads(body.decode('utf-8'))
-                    data = json_body['data']
-                    for datum in data:
-                        try:
-                            self._node_wikis_by_parent_guid[parent_node].append(datum['attributes']['name'])
-                        except KeyError:
-                            self.debug_logger.critical("Fail api call on " + u)
+        """
+        u = self.api_base + 'nodes/' + parent_node + '/wikis/'
+        # self.debug_logger.info("Crawling nodes api, url = " + u)
+        names = await self._fetch_wiki_names(u)
+        if names is not None:
+            self._node_wikis_by_parent_guid[parent_node].extend(names)
 
     def crawl_registration_wiki(self):
         """
@@ -487,37 +591,51 @@ class Crawler:
         """
         self.debug_logger.info("Start crawling registration wiki API pages")
         tasks = []
-        sem = asyncio.BoundedSemaphore(value=5)
 
         self.debug_logger.info("\nCrawling registration wiki API pages")
 
         for node_url in [x[0] for x in self.registration_url_tuples]:
-            tasks.append(asyncio.ensure_future(self.get_registration_wiki_names(node_url.strip('/').split('/')[-1], sem)))
+            tasks.append(asyncio.ensure_future(self.get_registration_wiki_names(node_url.strip('/').split('/')[-1])))
         loop = asyncio.get_event_loop()
         loop.run_until_complete(self._wait_with_progress_bar(tasks))
         self.debug_logger.info("Finished crawling registration wiki API pages")
 
-    async def get_registration_wiki_names(self, parent_node, sem):
+    async def get_registration_wiki_names(self, parent_node):
         """
         Asynchronous scraping method for scraping the V2 Registrations Wikis API.
+        Requests are limited by self.wiki_limiter.
         :param parent_node: list of parent nodes to which wiki pages are attached
-        :param sem: rate limiting semaphore
-        """
-        async with sem:
-            async with aiohttp.ClientSession() as s:
-                u = self.api_base + 'registrations/' + parent_node + '/wikis/'
-                # self.debug_logger.info("Crawling registrations api, url = " + u)
-                response = await s.get(u)
-                body = await response.read()
-                response.close()
-                if response.status <= 200:
-                    json_body = json.loads(body.decode('utf-8'))
-                    data = json_body['data']
-                    for datum in data:
-                        try:
-                            self._registration_wikis_by_parent_guid[parent_node].append(datum['attributes']['name'])
-                        except:
-                            self.debug_logger.critical("Fail api call on " + u)
+        """
+        u = self.api_base + 'registrations/' + parent_node + '/wikis/'
+        # self.debug_logger.info("Crawling registrations api, url = " + u)
+        names = await self._fetch_wiki_names(u)
+        if names is not None:
+            self._registration_wikis_by_parent_guid[parent_node].extend(names)
+
+    async def _fetch_wiki_names(self, u):
+        """
+        Requests a wiki listing of the API, conditionally if it was seen before: on a 304 the wiki names stored
+        with its validators in self.validators are used. The dbm file of the validators is read and written in the
+        threads of self.writer, not on the event loop.
+        :param u: url of the wiki listing
+        :return: list of wiki names, None if the request failed
+        """
+        headers = await self.writer.run(self.validators.conditional_headers, u, 'wikis')
+        response = await self._fetch(u, headers=headers, limiter=self.wiki_limiter)
+        if response.status == 304:
+            self.validators.not_modified('wikis')
+            return await self.writer.run(self.validators.payload, u) or []
+        if response.status > 200:
+            return None
+        json_body = json.loads(response.body.decode('utf-8'))
+        names = []
+        for datum in json_body['data']:
+            try:
+                names.append(datum['attributes']['name'])
+            except KeyError:
+                self.debug_logger.critical("Fail api call on %s", u)
+        await self.writer.run(self.validators.store, u, response.headers, 'wikis', names)
+        return names
 
     def scrape_nodes(self, async=True):
         """
@@ -576,109 +694,513 @@ class Crawler:
         self._scrape_pages(self.general_urls)
         self.debug_logger.info("Finished scraping general pages")
 
-    def _scrape_pages(self, aspect_list, sem_value=5, osf_type=""):
+# Pipelined crawl and scrape
+
+    def pipeline_scrape(self, nodes=False, registrations=False, users=False, institutions=False, node_pages=None):
+        """
+        Runner method for the pipelined mode: the API crawls and the page scrape run at the same time.
+        Every API record is turned into its page urls as soon as it arrives (after its wikis are listed), the urls
+        are put on a bounded asyncio queue, and scraper workers consume them right away under self.page_limiter.
+        The urls are also appended to self.node_urls, self.registration_urls, self.user_urls and
+        self.institution_urls as they are found, so the task file keeps what is needed to resume.
+        General pages are scraped as well.
+        :param nodes: whether to crawl and scrape nodes
+        :param registrations: whether to crawl and scrape registrations (all pages)
+        :param users: whether to crawl and scrape users
+        :param institutions: whether to crawl and scrape institutions
+        :param node_pages: dict of generate_node_urls() flags choosing the node pages,
+                           e.g. {'dashboard': True, 'wiki': True}
+        """
+        self.debug_logger.info("Pipelined crawl and scrape, nodes = " + str(nodes) +
+                               " registrations = " + str(registrations) +
+                               " users = " + str(users) +
+                               " institutions = " + str(institutions))
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(self._pipeline(nodes, registrations, users, institutions, node_pages or {}))
+        self.debug_logger.info("Finished pipelined crawl and scrape")
+
+    async def _pipeline(self, nodes, registrations, users, institutions, node_pages):
+        queue = PageScheduler(self.page_stats, maxsize=settings.PIPELINE_QUEUE_SIZE)
+        metrics.REGISTRY.set('rosie_queue_depth', queue.qsize)
+        progress = tqdm.tqdm(unit=' pages')
+        workers = self._start_scrape_workers(queue, progress)
+
+        producers = []
+        if nodes:
+            producers.append(self._produce_node_pages(queue, node_pages))
+        if registrations:
+            producers.append(self._produce_registration_pages(queue))
+        if users:
+            producers.append(self._produce_pages(queue, 'users/', 'user_urls', 'profile'))
+        if institutions:
+            producers.append(self._produce_pages(queue, 'institutions/', 'institution_urls', 'institution'))
+        producers.append(self._enqueue(queue, self.general_urls, '', None))
+        await asyncio.gather(*producers)
+
+        for _ in workers:
+            await queue.put((None, None))
+        await asyncio.gather(*workers)
+        progress.close()
+
+    def _start_scrape_workers(self, queue, progress):
+        """
+        Starts the workers scraping the pages of a PageScheduler until they get a stop marker (None, None): enough
+        of them for the page limiter to reach its maximum, the limiter decides how many are fetching.
+        :return: list of the worker tasks
+        """
+        async def scrape_worker():
+            while True:
+                url, osf_type = await queue.get()
+                if url is None:
+                    return
+                try:
+                    await self.scrape_url(url, osf_type=osf_type)
+                except Exception:
+                    # One bad page must not stop a worker, or the queue would fill up and stall the scrape
+                    self.debug_logger.exception("Failed to scrape : %s", url)
+                progress.update()
+
+        return [asyncio.ensure_future(scrape_worker()) for _ in range(self.page_limiter.maximum)]
+
+    async def _enqueue(self, queue, urls, osf_type, list_name):
         """
-        Runner method that runs scrape_url() through _wait_with_progress_bar() wrapper
+        Puts page urls on the pipeline queue, recording them first in the url list named list_name (if given),
+        e.g. 'node_urls', and in the journal. Waits while the queue is full, which holds the API crawl back to the
+        pace of the scrape.
+        """
+        if list_name is not None:
+            getattr(self, list_name).extend(urls)
+            if self.journal is not None:
+                self.journal.record_found(list_name, urls)
+        for url in urls:
+            await queue.put((url, osf_type))
+
+    async def _produce_pages(self, queue, endpoint, list_name, osf_type):
+        async for element in ApiPager(self, self.api_base + endpoint):
+            await self._enqueue(queue, [self.http_base + element['id'] + '/'], osf_type, list_name)
+
+    @staticmethod
+    async def _start_emit(slots, pending, emit, base_url):
+        """
+        Starts emit(base_url) (the wiki lookup and _enqueue() of one API record) once one of slots is free. With as
+        many slots as the pipeline queue holds, the records blocked on a full queue use them all up, and the API crawl
+        waits here instead of piling up tasks.
+        :param slots: asyncio.Semaphore
+        :param pending: set of the emit tasks not finished, or failed (for the producer to gather at the end)
+        """
+        await slots.acquire()
+        task = asyncio.ensure_future(emit(base_url))
+        pending.add(task)
+
+        def done(task):
+            slots.release()
+            if task.cancelled() or task.exception() is None:
+                pending.discard(task)
+
+        task.add_done_callback(done)
+
+    async def _produce_node_pages(self, queue, node_pages):
+        node_runs = SortedRuns(key=lambda x: x[1])
+        slots = asyncio.Semaphore(settings.PIPELINE_QUEUE_SIZE)
+        pending = set()
+
+        async def emit(base_url):
+            if node_pages.get('wiki'):
+                await self.get_node_wiki_names(base_url.strip('/').split('/')[-1])
+            await self._enqueue(queue, self.node_page_urls(base_url, **node_pages), 'project', 'node_urls')
+
+        api_url = self.api_base + 'nodes/' + '?filter[date_modified][gte]=' + \
+            self.date_modified_marker.isoformat(sep='T')
+        async for element in ApiPager(self, api_url):
+            node_tuple = self._node_tuple(element)
+            node_runs.append(node_tuple)
+            await self._start_emit(slots, pending, emit, node_tuple[0])
+        await asyncio.gather(*pending)
+        self.node_url_tuples = node_runs.merge(self.node_url_tuples)
+
+    async def _produce_registration_pages(self, queue):
+        registration_runs = SortedRuns(key=lambda x: x[1])
+        slots = asyncio.Semaphore(settings.PIPELINE_QUEUE_SIZE)
+        pending = set()
+
+        async def emit(base_url):
+            await self.get_registration_wiki_names(base_url.strip('/').split('/')[-1])
+            await self._enqueue(queue, self.registration_page_urls(base_url), 'registration', 'registration_urls')
+
+        async for element in ApiPager(self, self.api_base + 'registrations/'):
+            registration_tuple = self._registration_tuple(element)
+            # Same cut off as _truncate_registration_url_tuples(), applied record by record
+            if registration_tuple[1] < self.date_modified_marker:
+                continue
+            registration_runs.append(registration_tuple)
+            await self._start_emit(slots, pending, emit, registration_tuple[0])
+        await asyncio.gather(*pending)
+        self.registration_url_tuples = registration_runs.merge(self.registration_url_tuples)
+
+    def _scrape_pages(self, aspect_list, osf_type=""):
+        """
+        Runner method that runs scrape_url() on every page of a list, with a progress bar.
+        The pages are handed out by a PageScheduler, which serves their types by cost rather than in list order.
+        How many pages are fetched at once is decided by self.page_limiter.
         :param aspect_list: list of url of pages to scrape
         """
-        sem = asyncio.BoundedSemaphore(value=sem_value)
-        tasks = []
-        for url in aspect_list:
-            tasks.append(asyncio.ensure_future(self.scrape_url(url, sem, osf_type=osf_type)))
-
         loop = asyncio.get_event_loop()
-        if len(tasks) > 0:
+        if len(aspect_list) > 0:
             self.debug_logger.info("\nScraping pages")
-            loop.run_until_complete(self._wait_with_progress_bar(tasks))
+            loop.run_until_complete(self._scrape_scheduled(aspect_list, osf_type))
         else:
             self.debug_logger.info("No pages to scrape")
 
-    async def scrape_url(self, url, sem, osf_type=""):
+    async def _scrape_scheduled(self, aspect_list, osf_type):
+        queue = PageScheduler(self.page_stats)
+        metrics.REGISTRY.set('rosie_queue_depth', queue.qsize)
+        for url in aspect_list:
+            queue.put_nowait((url, osf_type))
+        progress = tqdm.tqdm(total=len(aspect_list), unit=' pages')
+        workers = self._start_scrape_workers(queue, progress)
+        for _ in workers:
+            queue.put_nowait((None, None))
+        await asyncio.gather(*workers)
+        progress.close()
+
+    async def scrape_url(self, url, osf_type=""):
         """
-        Asynchronous method that scrape page. Calls save_html() to save scraped page to file.
-        Calls record_milestone() to save progress
+        Asynchronous method that scrape page. Calls save_html() to save scraped page to file, through self.writer.
+        Calls record_milestone() once the page is on disk, or record_failure(), to journal progress.
+        Requests are limited by self.page_limiter; a received page waits for room in self.writer to be saved.
+        Failed requests are retried on the spot according to self.retry_policy; urls that needed more than one
+        attempt or failed for good are recorded in self.attempts, and only the latter go to self.error_list.
         :param osf_type: registration, profile, project, institution, or blank for general
         :param url: url to scrape
-        :param sem: rate limiting semaphore.
-        :return:
+        :return: True if the page is saved (or was not modified), False if it failed for good
+        """
+        path = archive_path(osf_type, url)
+        # A 304 only means something while the saved copy of the page is still there
+        conditional = {}
+        if os.path.exists(self.writer.path(path)):
+            conditional = await self.writer.run(self.validators.conditional_headers, url, 'pages')
+        kind = page_type(url, osf_type)
+        started = time.monotonic()
+        response, status, attempt, seconds = await self._fetch_page(url, conditional, kind)
+        self.page_stats.record(kind, seconds, status in (200, 304), started)
+        metrics.REGISTRY.inc('rosie_pages_total', type=kind,
+                             outcome={200: 'saved', 304: 'not_modified'}.get(status, 'failed'))
+
+        if attempt > 1 or status not in (200, 304):
+            self.attempts[url] = {'attempts': attempt, 'status': status}
+            if self.dictionary is not None:
+                self.dictionary['attempts'] = self.attempts
+
+        if status == 304:
+            self.validators.not_modified('pages')
+            self.writer.changes[digests.UNCHANGED] += 1
+            self.debug_logger.debug("Not modified : %s", url)
+            self.record_milestone(url)
+            return True
+        elif status == 200:
+            # Only the save takes a place in the writer, not the requests and the waits between retries
+            async with self.writer.room():
+                await self.save_html(decode_body(response), osf_type, url)
+            await self.writer.run(self.validators.store, url, response.headers, 'pages')
+            self.debug_logger.debug("Finished : %s", url)
+            if self.first_page_time is None:
+                self.first_page_time = time.monotonic()
+            self.record_milestone(url)
+            return True
+        else:
+            self.debug_logger.debug("%s on : %s, giving up after %d attempts", status, url, attempt)
+            self.record_failure(url, status, attempt)
+            return False
+
+    def scrape_from_queue(self, work_queue, worker, batch_size=settings.QUEUE_BATCH_SIZE,
+                          lease_seconds=settings.QUEUE_LEASE_SECONDS):
+        """
+        Runner method of a worker of a distributed scrape: scrapes the urls it leases from a shared work queue
+        (see workqueue.py) with scrape_url(), and reports every one of them as completed or failed, until the
+        coordinator has loaded all the work and none is left. The leases of the urls in progress are renewed
+        regularly; if the worker dies, they expire and the urls go to another worker.
+        :param work_queue: workqueue.WorkQueue filled by the coordinator
+        :param worker: name of this worker in the queue, e.g. host-pid
+        :param batch_size: number of urls leased and in progress at once
+        :param lease_seconds: time after which an unreported url is queued again
+        """
+        self.debug_logger.info("Scraping from the work queue as " + worker)
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(self._work_from_queue(work_queue, worker, batch_size, lease_seconds))
+        self.debug_logger.info("Finished scraping from the work queue")
+
+    async def _work_from_queue(self, work_queue, worker, batch_size, lease_seconds):
+        progress = tqdm.tqdm(unit=' pages')
+        in_progress = {}
+        # The queue calls block on the database, up to its lock timeout while other workers write: they are made
+        # one at a time in a thread of their own, off the event loop
+        queue_thread = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        loop = asyncio.get_event_loop()
+
+        def call(method, *args):
+            return loop.run_in_executor(queue_thread, method, *args)
+
+        async def scrape(url, osf_type):
+            try:
+                saved = await self.scrape_url(url, osf_type=osf_type)
+            except Exception:
+                self.debug_logger.exception("Failed to scrape : %s", url)
+                saved = False
+            attempts = self.attempts.get(url, {})
+            if saved:
+                await call(work_queue.complete, worker, url, attempts.get('attempts', 1))
+            else:
+                await call(work_queue.fail, worker, url, attempts.get('status'), attempts.get('attempts', 1))
+            del in_progress[url]
+            progress.update()
+
+        renewer = asyncio.ensure_future(self._renew_leases(call, work_queue, worker, in_progress, lease_seconds))
+        try:
+            while True:
+                # Urls are leased as others finish, so one slow page never holds up a whole batch
+                if len(in_progress) < batch_size:
+                    claimed = await call(work_queue.claim, worker, batch_size - len(in_progress), lease_seconds)
+                    for url, osf_type in claimed:
+                        in_progress[url] = asyncio.ensure_future(scrape(url, osf_type))
+                if not in_progress:
+                    if await call(work_queue.is_finished):
+                        break
+                    await asyncio.sleep(settings.QUEUE_POLL_INTERVAL)
+                    continue
+                await asyncio.wait(list(in_progress.values()), timeout=settings.QUEUE_POLL_INTERVAL,
+                                   return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            renewer.cancel()
+            queue_thread.shutdown(wait=True)
+            progress.close()
+
+    async def _renew_leases(self, call, work_queue, worker, in_progress, lease_seconds):
+        """
+        :param call: call(method, *args) of _work_from_queue(), making a queue call in its thread
+        """
+        while True:
+            await asyncio.sleep(lease_seconds / 3)
+            if in_progress:
+                await call(work_queue.extend, worker, list(in_progress), lease_seconds)
+
+    async def _fetch_page(self, url, conditional=None, kind=''):
+        """
+        Requests a page under self.page_limiter, retrying on the spot according to self.retry_policy. With
+        self.page_validator, a page that fails validation is retried too, and comes back as INVALID if it never passed.
+        :param conditional: conditional request headers, see ValidatorCache.conditional_headers()
+        :param kind: page type, for the metrics and the validation
+        :return: (FetchResult or None if the last attempt raised, last status, number of attempts, seconds spent in
+                 the requests, not counting the waits for a slot of the limiter and between attempts)
+        """
+        headers = dict(self.headers, **conditional) if conditional else self.headers
+        attempt = 0
+        seconds = 0.0
+        while True:
+            attempt += 1
+            slot = self.page_limiter.slot()
+            try:
+                async with slot:
+                    response = await self._fetch(url, headers=headers, phase='pages', kind=kind)
+                    slot.status = status = response.status
+                    if status == 200 and self.page_validator is not None:
+                        rule = self.page_validator.validate(kind, response.body)
+                        if rule is not None:
+                            status = INVALID
+                            # Prerender timing out is a sign of overload, like a 504 of its own
+                            if rule == 'prerender 504':
+                                slot.status = 504
+                            self.debug_logger.debug("Invalid page (%s) : %s", rule, url)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                response, status = None, None
+                self.debug_logger.debug("%r on : %s", e, url)
+            finally:
+                if slot.started is not None:
+                    seconds += time.monotonic() - slot.started
+            if status == INVALID:
+                # Retried like a failed request, whatever statuses the policy retries
+                if attempt >= self.retry_policy.max_attempts:
+                    return response, status, attempt, seconds
+            elif status in (200, 304) or not self.retry_policy.should_retry(attempt, status):
+                return response, status, attempt, seconds
+            delay = self.retry_policy.delay(attempt, response.headers if response is not None else None)
+            self.debug_logger.debug("%s on : %s, attempt %d, retrying in %.1fs", status, url, attempt, delay)
+            await asyncio.sleep(delay)
+
+    async def save_html(self, html, osf_type, page):
+        """
+        Rewrites a scraped page for the mirror and saves it through self.writer, unless its content is the same as
+        when it was last saved (the mirror warning and its date do not count).
+        :param html: text of the page
+        :param osf_type: registration, profile, project, institution, or blank for general
+        :param page: url of the page
+        :return: digests.NEW, digests.CHANGED or digests.UNCHANGED
         """
-        async with sem:
-            async with aiohttp.ClientSession() as s:
-                response = await s.get(url, headers=self.headers)
-                body = await response.text()
-                response.close()
-                if response.status == 200:
-                    self.debug_logger.debug("Finished : " + url)
-                    self.record_milestone(url)
-                    save_html(body, osf_type, url)
-                else:
-                    self.debug_logger.debug(str(response.status) + " on : " + url)
-                    if self.database is not None:
-                        self.error_list.append(url)
-                        self.dictionary['error_list'] = self.error_list
-                        self.database.seek(0)
-                        self.database.truncate()
-                        json.dump(self.dictionary, self.database, indent=4)
-                        self.database.flush()
-
-# Method to record the milestone
+        return await self.writer.write(archive_path(osf_type, page), MIRROR_REWRITER.rewrite(html),
+                                       suffix=mirror_warning())
+
+# Methods to record progress
     def record_milestone(self, url):
         """
-        Called by scrape_url to keep track of progress.
+        Called by scrape_url to keep track of progress. Appends one line to the journal; the task file itself is
+        only rewritten by compact_journal().
         :param url: url of the page that finished
         """
-        if self.database is not None:
+        self.completed.add(url)
+        if self.journal is not None:
             self.dictionary['milestone'] = url
-            self.database.seek(0)
-            self.database.truncate()
-            json.dump(self.dictionary, self.database, indent=4)
-            self.database.flush()
+            self.journal.record(url, 200, self.attempts.get(url, {}).get('attempts', 1))
 
+    def record_failure(self, url, status, attempts):
+        """
+        Called by scrape_url when a page failed for good: adds it to self.error_list and journals it.
+        :param url: url of the page
+        :param status: its last status, None if the request raised
+        :param attempts: number of attempts made
+        """
+        self.completed.discard(url)
+        if self.journal is not None:
+            self.error_list.append(url)
+            self.dictionary['error_list'] = self.error_list
+            self.journal.record(url, status, attempts)
 
-def save_html(html, osf_type, page):
-    # Mirror warning
-    today = datetime.datetime.today().strftime("%B %d, %Y at %I:%M %p")
-    mirror_warning = """
-        <div style="position:fixed;    bottom:0;left:0;    border-top-right-radius: 8px;    color:  white;
-        background-color: red;  padding: .5em;">
-            This page is a read-only mirror of the OSF saved on {}. Some features may not be available.
-        </div>
-        """.format(today)
+    def record_api_failure(self, url, status, attempts):
+        """
+        Called by ApiPager when a page of an API listing failed for good: adds it to self.api_failures, and to the
+        task file, so an incomplete listing is not taken for the whole of it.
+        :param url: url of the listing page
+        :param status: its last status, None if the request raised
+        :param attempts: number of attempts made
+        """
+        self.debug_logger.error("%s on api page : %s, giving up after %d attempts", status, url, attempts)
+        self.api_failures.append(url)
+        if self.dictionary is not None:
+            self.dictionary['api_failures'] = self.api_failures
+
+    def compact_journal(self):
+        """
+        Rewrites the task file once from self.dictionary, which already holds everything the journal recorded
+        but the completed pages, then empties the journal. Called by the CLI when a phase of the scrape finishes.
+        """
+        if self.database is None:
+            return
+        self.dictionary['completed'] = completion.encode_store(self.dictionary, self.completed)
+        self.dictionary['page_changes'] = dict(self.writer.changes)
+        self.journal.sync()
+        self.database.seek(0)
+        self.database.truncate()
+        json.dump(self.dictionary, self.database, indent=4)
+        self.database.flush()
+        os.fsync(self.database.fileno())
+        self.journal.truncate()
+
+
+class SortedRuns:
+    """
+    Ordered accumulator for the (url, datetime) tuples of the API crawls.
+    Items are appended in any order and sorted in fixed-size runs as the runs fill up; the runs are merged once
+    by merge(). This replaces sorting the whole list again after every append.
+    """
+
+    def __init__(self, key, run_size=1000):
+        """
+        :param key: sort key, e.g. lambda x: x[1] for the datetime of a url tuple
+        :param run_size: number of items sorted together before they are set aside as one run
+        """
+        self.key = key
+        self.run_size = run_size
+        self._runs = []
+        self._run = []
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, item):
+        self._run.append(item)
+        self._count += 1
+        if len(self._run) >= self.run_size:
+            self._seal()
+
+    def _seal(self):
+        if self._run:
+            self._run.sort(key=self.key)
+            self._runs.append(self._run)
+            self._run = []
+
+    def merge(self, *sorted_lists):
+        """
+        Merges everything appended so far with lists that are already sorted by the same key, and empties the
+        accumulator. The merge is stable: equal keys keep the order of sorted_lists first, then of appending.
+        :param sorted_lists: lists already in ascending key order, e.g. the current self.node_url_tuples
+        :return: a new list in ascending key order
+        """
+        self._seal()
+        runs = [lst for lst in sorted_lists if lst] + self._runs
+        self._runs = []
+        self._count = 0
+        if len(runs) == 1:
+            return list(runs[0])
+        return list(heapq.merge(*runs, key=self.key))
 
-    # Footer we have vs. footer we want
-    old_footer = """<div id="footerSlideIn" style="display: block;">"""
-    new_footer = """<div id="footerSlideIn" style="display: none;">"""
 
-    old_search_button = """<!-- ko ifnot: onSearchPage -->
+def parse_date(date_str):
+    """
+    Parses an API V2 timestamp, with or without microseconds, e.g. '2016-06-24T09:13:59.254173'
+    """
+    if '.' in date_str:
+        return datetime.datetime.strptime(date_str, "%Y-%m-%dT%H:%M:%S.%f")
+    return datetime.datetime.strptime(date_str, "%Y-%m-%dT%H:%M:%S")
+
+
+def decode_body(response):
+    """
+    Decodes the body of a FetchResult to text using the charset of its Content-Type header (utf-8 if absent).
+    :param response: FetchResult returned by Crawler._fetch()
+    """
+    mimetype, params = cgi.parse_header(response.headers.get('Content-Type', ''))
+    return response.body.decode(params.get('charset', 'utf-8'), errors='replace')
+
+
+# Rewrites applied to every scraped page, in one pass (see rewriter.py)
+MIRROR_REWRITER = Rewriter([
+    # Footer we have vs. footer we want
+    Rule("""<div id="footerSlideIn" style="display: block;">""",
+         """<div id="footerSlideIn" style="display: none;">"""),
+    # Search button pointing at the static search page
+    Rule("""<!-- ko ifnot: onSearchPage -->
         <li class="hidden-xs" data-bind="click : toggleSearch, css: searchCSS">
             <a class="">
                 <span rel="tooltip" data-placement="bottom" title="Search OSF" class="fa fa-search fa-lg"></span>
             </a>
         </li>
-        <!-- /ko -->"""
-    new_search_button = """
+        <!-- /ko -->""",
+         """
         <li>
             <a href="/search.html" class="fa fa-search fa-lg" ></a>
         </li>
-        """
+        """),
+])
 
-    # Remove URL head from the page (https://osf.io/project/mst3k/files/ --> project/mst3k/files/)
-    page = page.split('//', 1)[1]
-    page = page.split('/', 1)[1]
-
-    page = '/'.join(['archive', osf_type, page, ''])
-
-    make_dirs(page)
-
-    html = html.replace(old_footer, new_footer).replace(old_search_button, new_search_button) + mirror_warning
 
-    f = open(page + 'index.html', 'w')
-    f.write(html)
-    f.close()
-    os.chdir(sys.path[0])
+def mirror_warning():
+    """
+    Read-only mirror warning appended to every saved page, dated now.
+    """
+    today = datetime.datetime.today().strftime("%B %d, %Y at %I:%M %p")
+    return """
+        <div style="position:fixed;    bottom:0;left:0;    border-top-right-radius: 8px;    color:  white;
+        background-color: red;  padding: .5em;">
+            This page is a read-only mirror of the OSF saved on {}. Some features may not be available.
+        </div>
+        """.format(today)
 
 
-def make_dirs(filename):
-    folder = os.path.dirname(filename)
-    if not os.path.exists(folder):
-        os.makedirs(folder)
+def archive_path(osf_type, page):
+    """
+    Path of the saved page of a url, relative to the mirror root, e.g.
+    ('project', 'https://osf.io/mst3k/files/') -> 'project/mst3k/files/index.html'
+    """
+    # Remove URL head from the page (https://osf.io/project/mst3k/files/ --> project/mst3k/files/)
+    page = page.split('//', 1)[1]
+    page = page.split('/', 1)[1]
+    return '/'.join(part.strip('/') for part in [osf_type, page, 'index.html'] if part.strip('/'))
@@ -0,0 +1,129 @@
+"""Content digests of the saved pages of the mirror, to skip rewriting pages that did not change"""
+
+import dbm
+import glob
+import hashlib
+import os
+import struct
+import threading
+
+# What a PageWriter did with a page
+NEW = 'new'
+CHANGED = 'changed'
+UNCHANGED = 'unchanged'
+
+
+def digest(data):
+    """
+    Digest of the content of a page, as bytes.
+    :param data: body of the page as saved, without the dated mirror warning
+    """
+    return hashlib.sha1(data).digest()
+
+
+# Identity of the file a digest was stored for: size, mtime_ns and inode
+FILE_IDENTITY = struct.Struct('>QqQ')
+
+
+def entry(page_digest, stat):
+    """
+    Value stored for a page: its digest, and the identity of the file that was written with it.
+    :param stat: os.stat() of the file just written
+    """
+    return page_digest + FILE_IDENTITY.pack(stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+
+def matches(value, page_digest, stat):
+    """
+    Whether a stored value says the file on disk already has the content of page_digest. A value stored for
+    another file (the page was written since by a process with another store: a shard of a run with another
+    number of --workers, a --worker, an unsharded run) does not count, as the file may hold anything.
+    :param value: stored value, None if there is none
+    :param stat: os.stat() of the file on disk
+    """
+    return value == entry(page_digest, stat)
+
+
+class DigestStore:
+    """
+    Persistent map from the path of a saved page (relative to the mirror root) to the digest of its content,
+    kept in a dbm file next to the mirror. The file is opened on first use. Safe to use from the writer threads.
+    A store with a base only writes to its own file, and reads the base for the paths it has nothing for: the
+    shared store of the mirror, read by the processes of a sharded scrape, that merge_store() updates afterwards.
+    """
+
+    def __init__(self, filename, base=None):
+        """
+        :param filename: file name of the dbm database, created if needed
+        :param base: file name of a dbm database only read, if it exists
+        """
+        self.filename = filename
+        self.base = base
+        self._db = None
+        self._base_db = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        if self._db is None:
+            self._db = dbm.open(self.filename, 'c')
+        return self._db
+
+    def get(self, path):
+        key = path.encode('utf-8')
+        with self._lock:
+            value = self._open().get(key)
+            if value is None and self.base is not None:
+                if self._base_db is None:
+                    self._base_db = open_readonly(self.base)
+                value = self._base_db.get(key)
+            return value
+
+    def set(self, path, value):
+        with self._lock:
+            self._open()[path.encode('utf-8')] = value
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+            if self._base_db is not None:
+                close_readonly(self._base_db)
+                self._base_db = None
+
+
+def open_readonly(filename):
+    """
+    :return: the dbm database of filename opened for reading, or an empty dict if there is none yet
+    """
+    if not dbm.whichdb(filename):
+        return {}
+    return dbm.open(filename, 'r')
+
+
+def close_readonly(db):
+    if not isinstance(db, dict):
+        db.close()
+
+
+def merge_store(filename, own_filename):
+    """
+    Folds the entries of a store that had filename as its base (see DigestStore, ValidatorCache) into the one of
+    filename, then deletes its files. An empty value is the mark of a key deleted, see ValidatorCache.store().
+    :return: number of entries merged
+    """
+    if not dbm.whichdb(own_filename):
+        return 0
+    merged = 0
+    with dbm.open(own_filename, 'r') as own, dbm.open(filename, 'c') as shared:
+        for key in own.keys():
+            value = own[key]
+            if value:
+                shared[key] = value
+            elif key in shared:
+                del shared[key]
+            merged += 1
+    for path in [own_filename] + glob.glob(glob.escape(own_filename) + '.*'):
+        if os.path.exists(path):
+            os.remove(path)
+    return merged
@@ -0,0 +1,127 @@
+"""Persistent cache of HTTP validators (ETag / Last-Modified) for conditional requests"""
+
+import collections
+import dbm
+import json
+import threading
+
+import digests
+
+
+class ValidatorCache:
+    """
+    Remembers the ETag and Last-Modified headers of the responses of the crawler, by url, in a dbm file, so that
+    the next run can ask for each url again with If-None-Match / If-Modified-Since and take a 304 Not Modified as
+    "already current". A payload can be kept with the validators for responses whose content is needed again on
+    a 304 (e.g. the wiki names of a wiki listing).
+    Statistics are kept by kind of request (e.g. 'pages', 'wikis'): responses with and without validators,
+    conditional requests sent and 304s received, see hit_rate().
+    With a base, like a DigestStore: only its own file is written, the base is read for the urls it has nothing
+    for, and the urls whose validators are forgotten are marked with an empty value, for digests.merge_store().
+    Safe to use from several threads, so the crawler can keep its dbm calls off the event loop (PageWriter.run).
+    """
+
+    def __init__(self, filename, base=None):
+        """
+        :param filename: file name of the dbm database, created on first use
+        :param base: file name of a dbm database only read, if it exists
+        """
+        self.filename = filename
+        self.base = base
+        self.stats = collections.defaultdict(collections.Counter)
+        self._db = None
+        self._base_db = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        if self._db is None:
+            self._db = dbm.open(self.filename, 'c')
+        return self._db
+
+    def _entry(self, url):
+        key = url.encode('utf-8')
+        value = self._open().get(key)
+        if value is None and self.base is not None:
+            if self._base_db is None:
+                self._base_db = digests.open_readonly(self.base)
+            value = self._base_db.get(key)
+        return json.loads(value.decode('utf-8')) if value else None
+
+    def conditional_headers(self, url, kind):
+        """
+        Request headers that make a request for url conditional, empty if nothing is known about it.
+        :param url: url about to be requested
+        :param kind: kind of request, for the statistics
+        """
+        with self._lock:
+            entry = self._entry(url)
+        headers = {}
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        if headers:
+            with self._lock:
+                self.stats[kind]['conditional'] += 1
+        return headers
+
+    def not_modified(self, kind):
+        """
+        Counts a 304 answer to a conditional request.
+        """
+        with self._lock:
+            self.stats[kind]['not_modified'] += 1
+
+    def store(self, url, headers, kind, payload=None):
+        """
+        Stores the validators of a 200 response, or forgets those of url if the response has none.
+        :param url: url that was requested
+        :param headers: headers of the response
+        :param kind: kind of request, for the statistics
+        :param payload: anything JSON-serializable to keep with the validators, see payload()
+        """
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        key = url.encode('utf-8')
+        with self._lock:
+            if etag is None and last_modified is None:
+                self.stats[kind]['without_validators'] += 1
+                if self.base is not None:
+                    self._open()[key] = b''
+                elif key in self._open():
+                    del self._db[key]
+                return
+            self.stats[kind]['with_validators'] += 1
+            entry = {'etag': etag, 'last_modified': last_modified, 'payload': payload}
+            self._open()[key] = json.dumps(entry).encode('utf-8')
+
+    def payload(self, url):
+        """
+        Payload stored with the validators of url, None if there is none.
+        """
+        with self._lock:
+            entry = self._entry(url)
+        return entry.get('payload') if entry is not None else None
+
+    def hit_rate(self, kind):
+        """
+        Share of the responses of a kind that were 304s, and share that came with validators at all: an origin
+        that sends no validators can never answer 304.
+        :return: (304s / responses, responses with validators / responses), None for a kind without responses
+        """
+        stats = self.stats[kind]
+        responses = stats['not_modified'] + stats['with_validators'] + stats['without_validators']
+        if not responses:
+            return None
+        return (stats['not_modified'] / responses,
+                (stats['not_modified'] + stats['with_validators']) / responses)
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+            if self._base_db is not None:
+                digests.close_readonly(self._base_db)
+                self._base_db = None
@@ -0,0 +1,189 @@
+"""Append-only progress journal of a scrape task"""
+
+import glob
+import json
+import os
+import time
+
+import completion
+import settings
+
+
+class Journal:
+    """
+    JSON-lines journal kept next to a task file, so that progress costs one appended line per page instead of a
+    rewrite of the whole task file. Each line is one of:
+        {"url": url, "status": 200, "attempts": 1}        a page finished (or failed, for any other status)
+        {"found": [url, ...], "list": "node_urls"}       urls added to a url list of the task (pipelined scrape)
+    Lines are flushed and fsync'ed in batches (JOURNAL_SYNC_EVERY lines or JOURNAL_SYNC_INTERVAL seconds).
+    load_task() rebuilds the task state from the task file and its journal; once the task file has been
+    rewritten with that state, truncate() empties the journal (compaction).
+    """
+
+    def __init__(self, path, sync_every=settings.JOURNAL_SYNC_EVERY, sync_interval=settings.JOURNAL_SYNC_INTERVAL):
+        """
+        :param path: file name of the journal, see journal_path()
+        :param sync_every: lines written between two fsyncs
+        :param sync_interval: seconds between two fsyncs while lines are being written
+        """
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self._file = open(path, 'a', encoding='utf-8')
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def record(self, url, status, attempts=1):
+        """
+        Journals the outcome of a page.
+        :param url: url of the page
+        :param status: final HTTP status, None if the request raised
+        :param attempts: number of attempts it took
+        """
+        self._write({'url': url, 'status': status, 'attempts': attempts})
+
+    def record_found(self, list_name, urls):
+        """
+        Journals urls appended to one of the url lists of the task.
+        :param list_name: key of the list in the task file, e.g. 'node_urls'
+        :param urls: the new urls
+        """
+        if urls:
+            self._write({'found': list(urls), 'list': list_name})
+
+    def _write(self, entry):
+        self._file.write(json.dumps(entry) + '\n')
+        self._unsynced += 1
+        if self._unsynced >= self.sync_every or time.monotonic() - self._last_sync >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        """
+        Flushes the journal and fsyncs it to disk.
+        """
+        if self._file.closed:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def truncate(self):
+        """
+        Empties the journal. Only call once everything it holds has been written to the task file.
+        """
+        self._file.seek(0)
+        self._file.truncate()
+        self.sync()
+
+    def close(self):
+        self.sync()
+        self._file.close()
+
+
+def journal_path(task_filename):
+    """
+    File name of the journal of a task file, e.g. 201606231548.json -> 201606231548.journal
+    """
+    return os.path.splitext(task_filename)[0] + '.journal'
+
+
+def shard_journal_path(task_filename, shard, workers):
+    """
+    File name of the journal of one shard of a sharded scrape (see shards.py), e.g.
+    201606231548.json -> 201606231548.shard2of4.journal
+    """
+    return '{}.shard{}of{}.journal'.format(os.path.splitext(task_filename)[0], shard + 1, workers)
+
+
+def shard_journal_paths(task_filename):
+    """
+    File names of the shard journals left next to a task file.
+    """
+    return sorted(glob.glob(glob.escape(os.path.splitext(task_filename)[0]) + '.shard*of*.journal'))
+
+
+def read_entries(path):
+    """
+    Yields the entries of a journal in order. A line cut short by a crash is skipped.
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, encoding='utf-8') as file:
+        for line in file:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+def apply_journal(store, path):
+    """
+    Replays a journal onto the dictionary of a task file: appends found urls to their lists, sets 'milestone' to
+    the last finished page, and updates 'completed' (see completion.py), 'error_list' and 'attempts' so the latest
+    outcome of every page wins.
+    :param store: dictionary loaded from the task file, updated in place
+    :param path: file name of the journal
+    :return: store
+    """
+    error_list = store.get('error_list') or []
+    errors = set(error_list)
+    attempts = store.get('attempts') or {}
+    entries = list(read_entries(path))
+    # Found urls first, so that the bitmaps are rebuilt over the complete lists
+    for entry in entries:
+        if 'found' in entry:
+            if store.get(entry['list']) is None:
+                store[entry['list']] = []
+            store[entry['list']].extend(entry['found'])
+    done = completion.completed_urls(store)
+    for entry in entries:
+        if 'found' in entry:
+            continue
+        url, status = entry['url'], entry['status']
+        if entry.get('attempts', 1) > 1 or status != 200:
+            attempts[url] = {'attempts': entry.get('attempts', 1), 'status': status}
+        if status == 200:
+            store['milestone'] = url
+            done.add(url)
+            errors.discard(url)
+        else:
+            done.discard(url)
+            if url not in errors:
+                errors.add(url)
+                error_list.append(url)
+    store['error_list'] = [url for url in error_list if url in errors]
+    store['attempts'] = attempts
+    store['completed'] = completion.encode_store(store, done)
+    return store
+
+
+def load_task(task_filename):
+    """
+    Loads a task file with its journal, and the journals of the shards of an interrupted sharded scrape, replayed
+    onto it, see apply_journal().
+    """
+    with open(task_filename, encoding='utf-8') as file:
+        store = json.load(file)
+    apply_journal(store, journal_path(task_filename))
+    for path in shard_journal_paths(task_filename):
+        apply_journal(store, path)
+    return store
+
+
+def discard_shard_journals(task_filename):
+    """
+    Deletes the shard journals of a task file, once their progress has been written to the task file.
+    """
+    for path in shard_journal_paths(task_filename):
+        os.remove(path)
+
+
+def discard_journal(task_filename):
+    """
+    Deletes the journals of a task file, once the task file has been rewritten with the state loaded by load_task().
+    """
+    path = journal_path(task_filename)
+    if os.path.exists(path):
+        os.remove(path)
+    discard_shard_journals(task_filename)
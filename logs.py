@@ -0,0 +1,102 @@
+"""Logging of the crawler: records are queued by the event loop thread and written to rotating files by a thread"""
+
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+
+import settings
+
+# Name of the logger of the crawler (Crawler.debug_logger)
+LOGGER_NAME = 'debug'
+
+_listener = None
+_handler = None
+_files = None
+_pid = None
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that leaves the formatting of the message (msg % args) to the writer thread. Only a traceback is
+    rendered right away, since it does not outlive the except block.
+    """
+
+    def prepare(self, record):
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def _rotating_handler(filename, level):
+    handler = logging.handlers.RotatingFileHandler(filename, maxBytes=settings.LOG_MAX_BYTES,
+                                                   backupCount=settings.LOG_BACKUP_COUNT, encoding='utf-8', delay=True)
+    handler.setLevel(level)
+    # Every run starts a new file, the one of the last run becomes .1
+    if os.path.exists(filename) and os.path.getsize(filename) > 0:
+        handler.doRollover()
+    return handler
+
+
+def setup(level=None, debug_filename=None, error_filename=None):
+    """
+    Sets the crawler logger up, once per process and set of files: the records at or above level go through a
+    queue to a background thread, which writes them to the debug log, the errors also to the error log, and the
+    critical ones to the console. Both logs rotate at LOG_MAX_BYTES. Called by every Crawler; called again with
+    other files (e.g. in a shard process), it switches to them.
+    :param level: name of the lowest level logged, e.g. 'INFO'. By default LOG_LEVEL of settings.py the first time,
+                  and the level set before afterwards
+    :param debug_filename: file of the debug log, DEBUG_LOG_FILENAME of settings.py by default
+    :param error_filename: file of the error log, ERROR_LOG_FILENAME of settings.py by default
+    :return: the logger
+    """
+    global _listener, _handler, _files, _pid
+    debug_filename = debug_filename or settings.DEBUG_LOG_FILENAME
+    error_filename = error_filename or settings.ERROR_LOG_FILENAME
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.propagate = 0
+    if level is not None or _handler is None:
+        logger.setLevel((level or settings.LOG_LEVEL).upper())
+    files = (debug_filename, error_filename)
+    if _handler is not None and _files == files and _pid == os.getpid():
+        return logger
+
+    if _handler is not None:
+        logger.removeHandler(_handler)
+        # A listener inherited from the parent process has no thread here
+        if _pid == os.getpid():
+            _listener.stop()
+            for handler in _listener.handlers:
+                handler.close()
+
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(logging.CRITICAL)
+    records = queue.Queue()
+    _handler = _DeferredQueueHandler(records)
+    _listener = logging.handlers.QueueListener(records, console_handler,
+                                               _rotating_handler(debug_filename, logging.DEBUG),
+                                               _rotating_handler(error_filename, logging.ERROR),
+                                               respect_handler_level=True)
+    _listener.start()
+    _files = files
+    _pid = os.getpid()
+    logger.addHandler(_handler)
+    return logger
+
+
+def shutdown():
+    """
+    Writes out the records still queued and stops the writer thread. Runs at exit.
+    """
+    global _listener, _handler, _files
+    if _handler is not None and _pid == os.getpid():
+        logging.getLogger(LOGGER_NAME).removeHandler(_handler)
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+    _listener = _handler = _files = None
+
+
+atexit.register(shutdown)
@@ -0,0 +1,254 @@
+"""Metrics of the crawl, scrape and verification, served as Prometheus text and written as JSON snapshots"""
+
+import bisect
+import http.server
+import json
+import os
+import socketserver
+import threading
+import time
+
+import settings
+
+# Metrics recorded by the crawler, the writer and the verifier: name -> (type, help)
+METRICS = {
+    'rosie_request_seconds': ('histogram', "Seconds per request, by phase (api, wiki, pages) and page type"),
+    'rosie_responses_total': ('counter', "Responses by phase and HTTP status ('error' if the request raised)"),
+    'rosie_downloaded_bytes_total': ('counter', "Bytes of response bodies, by phase"),
+    'rosie_written_bytes_total': ('counter', "Bytes written to the mirror, compressed siblings included"),
+    'rosie_pages_total': ('counter', "Pages scraped, by page type and outcome (saved, not_modified, failed)"),
+    'rosie_pages_per_second': ('gauge', "Pages scraped per second over the last snapshot interval"),
+    'rosie_queue_depth': ('gauge', "Pages waiting in the scrape queue"),
+    'rosie_in_flight': ('gauge', "Requests in flight, by limiter"),
+    'rosie_concurrency_limit': ('gauge', "Current concurrency limit, by limiter"),
+    'rosie_verified_pages_total': ('counter', "Pages checked by the verifier, by page type and result"),
+    'rosie_invalid_pages_total': ('counter', "Pages that failed validation (--validate), by page type and rule"),
+}
+
+
+class Metrics:
+    """
+    Counters, gauges and histograms with labels, safe to update from any thread.
+    A gauge can be set to a function, called whenever the metrics are read (e.g. the depth of a queue).
+    Usage:
+        REGISTRY.inc('rosie_responses_total', phase='pages', status=200)
+        REGISTRY.observe('rosie_request_seconds', 0.8, phase='pages', type='project/files')
+    """
+
+    def __init__(self, buckets=settings.METRICS_LATENCY_BUCKETS):
+        """
+        :param buckets: upper bounds of the histogram buckets, in seconds
+        """
+        self.buckets = sorted(buckets)
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets all the values, e.g. in a new process forked from one that recorded some.
+        """
+        self._lock = threading.Lock()
+        self._values = {}  # {(name, labels): number, function or [bucket counts, sum, count]}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """
+        :param value: number, or function returning the number
+        """
+        with self._lock:
+            self._values[self._key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._values.get(key)
+            if histogram is None:
+                histogram = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def total(self, name):
+        """
+        Sum of a counter over all its labels.
+        """
+        with self._lock:
+            return sum(value for (key_name, labels), value in self._values.items() if key_name == name)
+
+    def _read(self):
+        with self._lock:
+            items = sorted(self._values.items(), key=lambda item: item[0])
+            # Histograms are copied, so they can be read out of the lock
+            items = [(key, [list(value[0]), value[1], value[2]] if isinstance(value, list) else value)
+                     for key, value in items]
+        return [(key, value() if callable(value) else value) for key, value in items]
+
+    def render(self):
+        """
+        :return: the metrics in the Prometheus text exposition format
+        """
+        lines = []
+        described = set()
+        for (name, labels), value in self._read():
+            if name not in described and name in METRICS:
+                described.add(name)
+                lines.append('# HELP {} {}'.format(name, METRICS[name][1]))
+                lines.append('# TYPE {} {}'.format(name, METRICS[name][0]))
+            if isinstance(value, list):
+                cumulative = 0
+                for bound, count in zip(self.buckets, value[0]):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(name, _labels(labels + (('le', repr(bound)),)), cumulative))
+                lines.append('{}_bucket{} {}'.format(name, _labels(labels + (('le', '+Inf'),)), value[2]))
+                lines.append('{}_sum{} {}'.format(name, _labels(labels), value[1]))
+                lines.append('{}_count{} {}'.format(name, _labels(labels), value[2]))
+            else:
+                lines.append('{}{} {}'.format(name, _labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """
+        :return: the metrics as a JSON-serializable dictionary: {name: [{'labels': {...}, 'value': number} or
+                 {'labels': {...}, 'buckets': {upper bound: count}, 'sum': seconds, 'count': number}]}
+        """
+        metrics = {}
+        for (name, labels), value in self._read():
+            entry = {'labels': dict(labels)}
+            if isinstance(value, list):
+                entry['buckets'] = {repr(bound): count for bound, count in zip(self.buckets, value[0])}
+                entry['sum'] = value[1]
+                entry['count'] = value[2]
+            else:
+                entry['value'] = value
+            metrics.setdefault(name, []).append(entry)
+        return {'time': time.time(), 'metrics': metrics}
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                          for key, value in labels) + '}'
+
+
+# Metrics of this process
+REGISTRY = Metrics()
+
+
+class _Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Exporter:
+    """
+    Exposes a Metrics registry: serves it as Prometheus text on a local port (any path, e.g. /metrics), and/or
+    writes it every interval seconds as a JSON snapshot to a file (replaced atomically). Also keeps
+    rosie_pages_per_second up to date. Runs in daemon threads; stop() writes a last snapshot.
+    """
+
+    def __init__(self, registry=REGISTRY, port=None, filename=None, interval=settings.METRICS_INTERVAL):
+        """
+        :param port: port to serve the metrics on (on METRICS_HOST), None not to serve them
+        :param filename: file of the JSON snapshots, None not to write them
+        :param interval: seconds between two snapshots
+        """
+        self.registry = registry
+        self.port = port
+        self.filename = filename
+        self.interval = interval
+        self._server = None
+        self._stopped = threading.Event()
+        self._ticker = None
+        self._last = (time.monotonic(), 0)
+
+    def start(self):
+        if self.port is not None:
+            self._server = _Server((settings.METRICS_HOST, self.port), _Handler)
+            self._server.registry = self.registry
+            threading.Thread(target=self._server.serve_forever, name='metrics-server', daemon=True).start()
+        self._last = (time.monotonic(), self.registry.total('rosie_pages_total'))
+        self._ticker = threading.Thread(target=self._tick, name='metrics-snapshots', daemon=True)
+        self._ticker.start()
+        return self
+
+    def _tick(self):
+        while not self._stopped.wait(self.interval):
+            self.update()
+
+    def update(self):
+        """
+        Updates rosie_pages_per_second and writes a snapshot.
+        """
+        now, pages = time.monotonic(), self.registry.total('rosie_pages_total')
+        last_time, last_pages = self._last
+        if now > last_time:
+            self.registry.set('rosie_pages_per_second', (pages - last_pages) / (now - last_time))
+        self._last = (now, pages)
+        if self.filename is not None:
+            temporary = self.filename + '.tmp'
+            with open(temporary, 'w', encoding='utf-8') as file:
+                json.dump(self.registry.snapshot(), file, indent=4)
+            os.replace(temporary, self.filename)
+
+    def stop(self):
+        self._stopped.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        self.update()
+
+
+# Exporter of this process, see start()
+_exporter = None
+
+
+def start(port=None, filename=None):
+    """
+    Starts exporting the metrics of this process (see Exporter), unless neither a port nor a file is given.
+    :return: the Exporter, or None
+    """
+    global _exporter
+    if port is None and filename is None:
+        return None
+    _exporter = Exporter(port=port, filename=filename).start()
+    return _exporter
+
+
+def exporting():
+    """
+    :return: (port, file name) of the running exporter of this process, (None, None) if there is none
+    """
+    if _exporter is None:
+        return None, None
+    return _exporter.port, _exporter.filename
+
+
+def stop():
+    global _exporter
+    if _exporter is not None:
+        _exporter.stop()
+        _exporter = None
@@ -0,0 +1,181 @@
+"""Streaming pager for paginated OSF API V2 listings"""
+
+import asyncio
+import collections
+import json
+import urllib.parse
+
+import aiohttp
+
+import settings
+
+
+class ApiPager:
+    """
+    Asynchronous iterator over the records of a paginated API V2 listing, used by the Crawler in place of
+    counting pages up front.
+    Usage:
+        async for record in ApiPager(crawler, url):
+            ...
+    Pages are found by following links.next, so records are handed out as soon as the first page arrives.
+    Once links.next shows how pages are numbered, the following pages (up to links.last) are requested ahead so
+    that up to `window` pages are in flight at once, within the crawler's api_limiter. Records are yielded in page
+    order, and records that were already yielded (pages shifting while the listing is walked) are skipped.
+    A page that fails is retried according to the crawler's retry_policy; one that still fails is reported with
+    crawler.record_api_failure(), since its records are missing from the listing.
+    """
+
+    def __init__(self, crawler, url, window=settings.API_PREFETCH_WINDOW, page_limit=0, progress=None):
+        """
+        :param crawler: Crawler whose shared session is used for the requests
+        :param url: url of the first page of the listing
+        :param window: maximum number of pages in flight
+        :param page_limit: Number of pages of API to crawl. If page_limit=0, then crawl all pages.
+        :param progress: optional tqdm progress bar, updated once per record
+        """
+        self.crawler = crawler
+        self.url = url
+        self.window = max(1, window)
+        self.page_limit = page_limit
+        self.progress = progress
+
+        self.total = None  # links.meta.total, known once the first page arrives
+        self.pages_requested = 0
+        self.pages_fetched = 0
+
+        self._started = False
+        self._records = collections.deque()
+        self._pending = collections.deque()  # (url, task) in page order
+        self._requested = set()
+        self._seen_ids = set()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self._started:
+            self._started = True
+            self._request(self.url)
+        while not self._records:
+            if not self._pending:
+                self.close()
+                raise StopAsyncIteration
+            url, task = self._pending.popleft()
+            self._handle_page(await task)
+        if self.progress is not None:
+            self.progress.update()
+        return self._records.popleft()
+
+    def close(self):
+        """
+        Cancels pages still in flight. Called when the listing is exhausted, or by a consumer that stops early.
+        """
+        self._cancel_pending()
+        if self.progress is not None:
+            self.progress.close()
+            self.progress = None
+
+    def _request(self, url):
+        if self.page_limit and self.pages_requested >= self.page_limit:
+            return
+        key = _normalize(url)
+        if key in self._requested:
+            return
+        self._requested.add(key)
+        self.pages_requested += 1
+        self._pending.append((url, asyncio.ensure_future(self._get_page(url))))
+
+    async def _get_page(self, url):
+        """
+        :return: the JSON body of the page, None if it failed for good
+        """
+        self.crawler.debug_logger.info("Crawling api page, url = %s", url)
+        retry_policy = self.crawler.retry_policy
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                response = await self.crawler._fetch(url, limiter=self.crawler.api_limiter)
+                status = response.status
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                response, status = None, None
+                self.crawler.debug_logger.debug("%r on api page : %s", e, url)
+            if status == 200:
+                return json.loads(response.body.decode('utf-8'))
+            if not retry_policy.should_retry(attempt, status):
+                break
+            delay = retry_policy.delay(attempt, response.headers if response is not None else None)
+            self.crawler.debug_logger.debug("%s on api page : %s, attempt %d, retrying in %.1fs", status, url, attempt,
+                                            delay)
+            await asyncio.sleep(delay)
+        self.crawler.record_api_failure(url, status, attempt)
+        return None
+
+    def _handle_page(self, json_body):
+        self.pages_fetched += 1
+        if json_body is None:
+            return
+        links = json_body.get('links', {})
+        if self.total is None:
+            self.total = links.get('meta', {}).get('total')
+            if self.progress is not None:
+                self.progress.total = self.total
+        for element in json_body['data']:
+            if element['id'] not in self._seen_ids:
+                self._seen_ids.add(element['id'])
+                self._records.append(element)
+
+        next_url = links.get('next')
+        if next_url is None:
+            # Last page: anything requested ahead of it is past the end of the listing
+            self._cancel_pending()
+            return
+        self._request(next_url)
+        next_number = _page_number(next_url)
+        last_number = _page_number(links.get('last'))
+        if next_number is None or last_number is None:
+            return
+        # Request ahead following the numbering of links.next
+        number = next_number + 1
+        while len(self._pending) < self.window and number <= last_number:
+            self._request(_with_page(next_url, number))
+            number += 1
+
+    def _cancel_pending(self):
+        for url, task in self._pending:
+            task.cancel()
+        self._pending.clear()
+
+
+def _page_number(url):
+    """
+    The value of the page query parameter of url, or None
+    """
+    if url is None:
+        return None
+    pages = urllib.parse.parse_qs(urllib.parse.urlsplit(url).query).get('page')
+    try:
+        return int(pages[0])
+    except (TypeError, ValueError):
+        return None
+
+
+def _with_page(url, number):
+    """
+    url with its page query parameter set to number
+    """
+    parts = urllib.parse.urlsplit(url)
+    query = [(k, v) for k, v in urllib.parse.parse_qsl(parts.query, keep_blank_values=True) if k != 'page']
+    query.append(('page', str(number)))
+    return urllib.parse.urlunsplit(parts._replace(query=urllib.parse.urlencode(query)))
+
+
+def _normalize(url):
+    """
+    Key that compares equal for urls of the same page whatever the order and encoding of their parameters
+    """
+    parts = urllib.parse.urlsplit(url)
+    query = sorted(urllib.parse.parse_qsl(parts.query, keep_blank_values=True))
+    if not any(k == 'page' for k, v in query):
+        query = sorted(query + [('page', '1')])
+    return parts.netloc, parts.path, tuple(query)
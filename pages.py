@@ -14,9 +14,12 @@ class Page:
         self.path = self.get_path_from_url(url)
         # Set size attribute in KB, inherently checks if file exists
         try:
-            self.file_size = os.path.getsize(self.path) / 1000
+            stat = os.stat(self.path)
         except FileNotFoundError:
             raise FileNotFoundError
+        self.file_size = stat.st_size / 1000
+        # Tells whether the file changed since it was last verified, see verifycache.py
+        self.identity = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
 
     def __str__(self):
         return self.path
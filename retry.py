@@ -0,0 +1,77 @@
+"""Retry policy for the crawler's page and API listing requests"""
+
+import datetime
+import email.utils
+import random
+
+import settings
+
+
+class RetryPolicy:
+    """
+    Decides whether a failed page request is tried again on the spot, and how long to wait first.
+    The wait is exponential backoff with full jitter (a random delay up to base_delay * 2^(attempt - 1), capped
+    at max_delay), unless the response carries a Retry-After header, which is honoured up to max_delay.
+    A request that raised (connection reset, timeout) has no status and is always retryable.
+    """
+
+    def __init__(self, max_attempts=settings.RETRY_MAX_ATTEMPTS, base_delay=settings.RETRY_BASE_DELAY,
+                 max_delay=settings.RETRY_MAX_DELAY, retry_statuses=settings.RETRY_STATUSES):
+        """
+        :param max_attempts: attempts per url, including the first one
+        :param base_delay: backoff before the second attempt, in seconds
+        :param max_delay: longest wait between two attempts, in seconds
+        :param retry_statuses: statuses worth retrying, as ints (504) or classes ('5xx')
+        """
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_statuses = set(s for s in retry_statuses if isinstance(s, int))
+        self.retry_classes = set(int(s[0]) for s in retry_statuses if isinstance(s, str))
+
+    def is_retryable(self, status):
+        """
+        :param status: HTTP status of the response, None if the request raised
+        """
+        return status is None or status in self.retry_statuses or status // 100 in self.retry_classes
+
+    def should_retry(self, attempt, status):
+        """
+        :param attempt: number of the attempt that just failed, starting at 1
+        :param status: HTTP status of that attempt, None if the request raised
+        """
+        return attempt < self.max_attempts and self.is_retryable(status)
+
+    def delay(self, attempt, headers=None):
+        """
+        Seconds to wait before the attempt after `attempt`
+        :param attempt: number of the attempt that just failed, starting at 1
+        :param headers: headers of its response, if any
+        """
+        retry_after = parse_retry_after(headers)
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+def parse_retry_after(headers):
+    """
+    Seconds asked for by a Retry-After header, given either as a number of seconds or as an HTTP date.
+    :return: seconds, or None without a usable header
+    """
+    if not headers:
+        return None
+    value = headers.get('Retry-After')
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date is None:
+        return None
+    now = datetime.datetime.now(date.tzinfo) if date.tzinfo else datetime.datetime.utcnow()
+    return max(0.0, (date - now).total_seconds())
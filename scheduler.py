@@ -0,0 +1,164 @@
+"""Cost-aware scheduling of the page scrape: page types are served by weighted fair queuing on their learned cost"""
+
+import asyncio
+import collections
+import urllib.parse
+
+
+def page_type(url, osf_type=''):
+    """
+    Type of a page for scheduling and statistics, e.g. project/dashboard, project/files, registration/wiki, profile,
+    general.
+    :param url: url of the page
+    :param osf_type: registration, profile, project, institution, or blank for general (see Crawler.scrape_url)
+    """
+    if osf_type in ('project', 'registration'):
+        parts = urllib.parse.urlsplit(url).path.strip('/').split('/')
+        return osf_type + '/' + (parts[1] if len(parts) > 1 and parts[1] else 'dashboard')
+    return osf_type or 'general'
+
+
+class PageStats:
+    """
+    What the page types cost during a run: pages scraped and failed, seconds spent requesting them (retries
+    included, waiting for a free slot of the limiter excluded), and a smoothed cost per saved page that the
+    PageScheduler orders the types by.
+    """
+
+    def __init__(self, smoothing=0.2):
+        """
+        :param smoothing: weight of the newest page in the moving average of the cost of its type
+        """
+        self.smoothing = smoothing
+        # {page type: {'pages', 'failed', 'seconds', 'first', 'last'}}, first and last being time.monotonic()
+        # when the first request of the type started and when its last one ended
+        self.types = {}
+        self._latency = {}  # Exponentially weighted moving average of the seconds per page, by type
+        self._failure_rate = {}
+
+    def record(self, kind, seconds, saved, started):
+        """
+        :param kind: page type, see page_type()
+        :param seconds: seconds the requests of the page took
+        :param saved: whether the page was saved, False if it failed for good
+        :param started: time.monotonic() when its first request started
+        """
+        stats = self.types.setdefault(kind, {'pages': 0, 'failed': 0, 'seconds': 0.0, 'first': started,
+                                             'last': started})
+        stats['pages'] += 1
+        stats['failed'] += 0 if saved else 1
+        stats['seconds'] += seconds
+        stats['first'] = min(stats['first'], started)
+        stats['last'] = max(stats['last'], started + seconds)
+        failure = 0.0 if saved else 1.0
+        if kind not in self._latency:
+            self._latency[kind] = seconds
+            self._failure_rate[kind] = failure
+        else:
+            self._latency[kind] += self.smoothing * (seconds - self._latency[kind])
+            self._failure_rate[kind] += self.smoothing * (failure - self._failure_rate[kind])
+
+    def expected_cost(self, kind):
+        """
+        Expected seconds of requests per saved page of a type: its smoothed latency over its success rate.
+        A type not seen yet costs as much as the average type, so every type gets tried early.
+        """
+        if kind not in self._latency:
+            if not self._latency:
+                return 1.0
+            return sum(self.expected_cost(known) for known in self._latency) / len(self._latency)
+        return self._latency[kind] / max(1.0 - self._failure_rate[kind], 0.1)
+
+    def merge(self, types):
+        """
+        Adds up the statistics of another run, e.g. of a shard process.
+        :param types: the types attribute of another PageStats
+        """
+        for kind, other in types.items():
+            stats = self.types.setdefault(kind, dict(other, pages=0, failed=0, seconds=0.0))
+            stats['pages'] += other['pages']
+            stats['failed'] += other['failed']
+            stats['seconds'] += other['seconds']
+            stats['first'] = min(stats['first'], other['first'])
+            stats['last'] = max(stats['last'], other['last'])
+
+    def summary(self):
+        """
+        :return: list of (page type, pages, failed, mean seconds per page, pages per second while the type was
+                 being scraped), by type name
+        """
+        rows = []
+        for kind in sorted(self.types):
+            stats = self.types[kind]
+            span = stats['last'] - stats['first']
+            rows.append((kind, stats['pages'], stats['failed'], stats['seconds'] / stats['pages'],
+                         stats['pages'] / span if span > 0 else None))
+        return rows
+
+
+class _Lanes:
+    """
+    One FIFO lane of (url, osf_type) per page type, plus the stop markers (url None) handed out last.
+    """
+
+    def __init__(self):
+        self.lanes = collections.OrderedDict()
+        self.stops = collections.deque()
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for lane in self.lanes.values():
+            yield from lane
+        yield from self.stops
+
+
+class PageScheduler(asyncio.Queue):
+    """
+    Queue of the pages to scrape, of (url, osf_type) items, that hands the pages out by type instead of in the
+    order they were put: the types share the request time by weighted fair queuing on their expected cost
+    (see PageStats.expected_cost), so a type whose pages take ten times longer is served ten times less often.
+    Cheap pages (forks, analytics) are not stuck behind slow ones (dashboards with file trees), and no type starves.
+    Pages of one type keep their order. An item whose url is None (a stop marker for a worker) is handed out only
+    once no page is left.
+    """
+
+    def __init__(self, stats, maxsize=0):
+        """
+        :param stats: PageStats the costs of the page types are learnt in, shared with Crawler.scrape_url
+        :param maxsize: number of items after which put() waits, 0 for no limit
+        """
+        self.stats = stats
+        super().__init__(maxsize=maxsize)
+
+    def _init(self, maxsize):
+        self._queue = _Lanes()
+        self._virtual_time = {}
+        self._clock = 0.0
+
+    def _put(self, item):
+        url, osf_type = item
+        self._queue.count += 1
+        if url is None:
+            self._queue.stops.append(item)
+            return
+        kind = page_type(url, osf_type)
+        lane = self._queue.lanes.get(kind)
+        if lane is None:
+            lane = self._queue.lanes[kind] = collections.deque()
+        if not lane:
+            # A type that was idle starts from the current virtual time, it earns no credit for having been idle
+            self._virtual_time[kind] = max(self._virtual_time.get(kind, 0.0), self._clock)
+        lane.append(item)
+
+    def _get(self):
+        self._queue.count -= 1
+        busy = [kind for kind, lane in self._queue.lanes.items() if lane]
+        if not busy:
+            return self._queue.stops.popleft()
+        kind = min(busy, key=lambda busy_kind: self._virtual_time[busy_kind])
+        self._clock = self._virtual_time[kind]
+        self._virtual_time[kind] += self.stats.expected_cost(kind)
+        return self._queue.lanes[kind].popleft()
@@ -0,0 +1,253 @@
+"""
+End-to-end benchmark: runs the CLI against a local scripts.fake_osf server, in a scratch folder, step by step:
+    scrape          python cli.py --scrape
+    verify          python cli.py --verify --tf <task file>
+    index           python cli.py --index
+    compile_active  python cli.py --compile_active, after --deleted records disappeared from the fake OSF
+    delete          python cli.py --delete --ctf <active list>
+For every step it reports the wall-clock time, the items handled per second (pages scraped, pages verified, index
+entries, folders deleted), the p50 / p99 latency of the page requests (from the --metrics-file snapshot of the step),
+the peak RSS of the process, and the bytes it read from and wrote to disk.
+--save writes the results as JSON; --baseline compares with saved results and exits with status 1 if throughput
+dropped, or p99 latency, peak RSS or disk writes grew, by more than --tolerance.
+
+Usage: python -m scripts.bench_e2e --records 50 --latency 0.2 --latency_distribution lognormal --error_rate 0.02
+       python -m scripts.bench_e2e --save baseline.json
+       python -m scripts.bench_e2e --baseline baseline.json --tolerance 0.2
+"""
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from scripts.fake_osf import FakeOSF, LATENCY_DISTRIBUTIONS
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLI = os.path.join(REPOSITORY, 'cli.py')
+
+# Result fields that get worse when they go up, and those that get worse when they go down
+LOWER_IS_BETTER = ['p99', 'peak_rss_mb', 'written_mb']
+HIGHER_IS_BETTER = ['items_per_second']
+
+
+def histogram_quantile(quantile, entries):
+    """
+    Quantile of latency histograms from a metrics snapshot (see metrics.Metrics.snapshot), interpolated linearly
+    within the bucket it falls in, like Prometheus' histogram_quantile().
+    :param entries: histogram entries to add up, e.g. those of rosie_request_seconds with phase 'pages'
+    :return: seconds, None without observations
+    """
+    buckets = {}
+    count = 0
+    for entry in entries:
+        count += entry['count']
+        for bound, observations in entry['buckets'].items():
+            buckets[float(bound)] = buckets.get(float(bound), 0) + observations
+    if not count:
+        return None
+    rank = quantile * count
+    cumulative = 0
+    lower = 0.0
+    for bound in sorted(buckets):
+        if cumulative + buckets[bound] >= rank:
+            return lower + (bound - lower) * (rank - cumulative) / buckets[bound]
+        cumulative += buckets[bound]
+        lower = bound
+    return lower  # In the +Inf bucket: the highest finite bound is all that is known
+
+
+def run_step(name, arguments, folder, environment, timeout):
+    """
+    Runs the CLI with arguments in folder and measures it.
+    :return: dict of the measures, and the metrics snapshot of the step (None if it wrote none)
+    """
+    metrics_file = os.path.join(folder, name + '-metrics.json')
+    command = [sys.executable, CLI] + arguments + ['--metrics-file', metrics_file]
+    with open(os.path.join(folder, name + '.out'), 'w') as output:
+        start = time.monotonic()
+        process = subprocess.Popen(command, cwd=folder, env=environment, stdout=output, stderr=subprocess.STDOUT)
+        timer = threading.Timer(timeout, process.kill)
+        timer.start()
+        # wait4 gives the resource usage of this child alone
+        pid, status, usage = os.wait4(process.pid, 0)
+        timer.cancel()
+        elapsed = time.monotonic() - start
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+
+    snapshot = None
+    if os.path.exists(metrics_file):
+        with open(metrics_file, encoding='utf-8') as file:
+            snapshot = json.load(file)
+    return {
+        'step': name,
+        'status': process.returncode,
+        'seconds': elapsed,
+        'peak_rss_mb': usage.ru_maxrss / 1024,  # KB on Linux
+        'read_mb': usage.ru_inblock * 512 / 1e6,
+        'written_mb': usage.ru_oublock * 512 / 1e6,
+    }, snapshot
+
+
+def metric_total(snapshot, name):
+    if snapshot is None:
+        return 0
+    return sum(entry['value'] for entry in snapshot['metrics'].get(name, []))
+
+
+def page_latencies(snapshot):
+    if snapshot is None:
+        return None, None
+    entries = [entry for entry in snapshot['metrics'].get('rosie_request_seconds', [])
+               if entry['labels'].get('phase') == 'pages']
+    return histogram_quantile(0.5, entries), histogram_quantile(0.99, entries)
+
+
+def count_folders(folder):
+    return sum(len(os.listdir(path)) for path in glob.glob(os.path.join(folder, 'archive', '*'))
+               if os.path.isdir(path))
+
+
+def run_benchmark(args, folder):
+    osf = FakeOSF(records=args.records, per_page=args.per_page, page_size=args.page_size, latency=args.latency,
+                  latency_distribution=args.latency_distribution, dashboard_factor=args.dashboard_factor,
+                  error_rate=args.error_rate, seed=args.seed).start()
+    environment = dict(os.environ, ROSIEBOT_HTTP_BASE=osf.http_base, ROSIEBOT_API_BASE=osf.api_base,
+                       ROSIEBOT_ARCHIVE_ROOT=os.path.join(folder, 'archive'))
+    # --index copies the search assets from search/ into the mirror
+    os.symlink(os.path.join(REPOSITORY, 'search'), os.path.join(folder, 'search'))
+    results = []
+
+    def step(name, arguments, items):
+        result, snapshot = run_step(name, arguments, folder, environment, args.timeout)
+        count = items(snapshot)
+        result['items'] = count
+        result['items_per_second'] = count / result['seconds'] if result['seconds'] else None
+        result['p50'], result['p99'] = page_latencies(snapshot)
+        results.append(result)
+        if result['status'] != 0:
+            print('{} exited with status {}, see {}'.format(name, result['status'],
+                                                            os.path.join(folder, name + '.out')))
+        return result
+
+    try:
+        step('scrape', ['--scrape'] + args.cli_args, lambda snapshot: metric_total(snapshot, 'rosie_pages_total'))
+        task_files = sorted(path for path in glob.glob(os.path.join(folder, '*.json'))
+                            if not os.path.basename(path).startswith('activelist') and '-metrics' not in path)
+        if task_files:
+            task_file = os.path.basename(task_files[-1])
+            step('verify', ['--verify', '--tf', task_file, '--rn', '1'],
+                 lambda snapshot: metric_total(snapshot, 'rosie_verified_pages_total'))
+
+        def index_entries(snapshot):
+            path = os.path.join(folder, 'archive', 'static', 'js', 'search-index.json')
+            if not os.path.exists(path):
+                return 0
+            with open(path, encoding='utf-8') as file:
+                return len(json.load(file))
+
+        os.makedirs(os.path.join(folder, 'archive', 'static', 'js'), exist_ok=True)
+        step('index', ['--index'], index_entries)
+
+        # Records deleted on the fake OSF since the scrape
+        osf.records = max(0, args.records - args.deleted)
+        def active_ids(snapshot):
+            active_lists = sorted(glob.glob(os.path.join(folder, 'activelist-*.json')))
+            if not active_lists:
+                return 0
+            with open(active_lists[-1], encoding='utf-8') as file:
+                return sum(len(ids) for ids in json.load(file).values())
+
+        step('compile_active', ['--compile_active'], active_ids)
+        active_lists = sorted(glob.glob(os.path.join(folder, 'activelist-*.json')))
+        if active_lists:
+            before = count_folders(folder)
+            step('delete', ['--delete', '--ctf', os.path.basename(active_lists[-1])],
+                 lambda snapshot: before - count_folders(folder))
+    finally:
+        osf.stop()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    :return: list of regressions, as text
+    """
+    regressions = []
+    previous = {result['step']: result for result in baseline}
+    for result in results:
+        old = previous.get(result['step'])
+        if old is None:
+            continue
+        for field in HIGHER_IS_BETTER + LOWER_IS_BETTER:
+            new_value, old_value = result.get(field), old.get(field)
+            if not new_value or not old_value:
+                continue
+            change = (new_value - old_value) / old_value
+            if (field in HIGHER_IS_BETTER and change < -tolerance) or (field in LOWER_IS_BETTER and change > tolerance):
+                regressions.append('{} {}: {:.3g} -> {:.3g} ({:+.0%})'.format(result['step'], field, old_value,
+                                                                            new_value, change))
+    return regressions
+
+
+def print_results(results):
+    def number(value, precision):
+        return '-' if value is None else '{:.{}f}'.format(value, precision)
+
+    print('{:<15} {:>6} {:>8} {:>7} {:>9} {:>8} {:>8} {:>9} {:>8} {:>9}'.format(
+        'step', 'status', 'seconds', 'items', 'items/s', 'p50 s', 'p99 s', 'RSS MB', 'read MB', 'write MB'))
+    for result in results:
+        print('{:<15} {:>6} {:>8} {:>7} {:>9} {:>8} {:>8} {:>9} {:>8} {:>9}'.format(
+            result['step'], result['status'], number(result['seconds'], 2), result['items'],
+            number(result['items_per_second'], 1), number(result['p50'], 3), number(result['p99'], 3),
+            number(result['peak_rss_mb'], 1), number(result['read_mb'], 1), number(result['written_mb'], 1)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=50, help="Records in each API listing of the fake OSF")
+    parser.add_argument('--per_page', type=int, default=10, help="Records per API page")
+    parser.add_argument('--page_size', type=int, default=420,
+                        help="Size of the rendered pages in KB, above the verifier's minimum sizes by default")
+    parser.add_argument('--latency', type=float, default=0.05, help="Mean seconds a rendered page takes")
+    parser.add_argument('--latency_distribution', choices=LATENCY_DISTRIBUTIONS, default='lognormal')
+    parser.add_argument('--dashboard_factor', type=float, default=3.0, help="How much slower dashboards are")
+    parser.add_argument('--error_rate', type=float, default=0.02, help="Fraction of rendered pages that are 504s")
+    parser.add_argument('--deleted', type=int, default=5, help="Records deleted before --compile_active / --delete")
+    parser.add_argument('--seed', type=int, default=1, help="Seed of the latencies and errors of the fake OSF")
+    parser.add_argument('--timeout', type=float, default=1800, help="Seconds after which a step is killed")
+    parser.add_argument('--keep', action='store_true', help="Keep the scratch folder and print its path")
+    parser.add_argument('--save', default=None, help="Write the results to this JSON file")
+    parser.add_argument('--baseline', default=None, help="Results saved by an earlier run to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Relative change counted as a regression")
+    parser.add_argument('cli_args', nargs='*', help="Extra arguments of the scrape step, after --, e.g. -- --pipeline")
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp(prefix='rosie-bench-')
+    try:
+        results = run_benchmark(args, folder)
+    finally:
+        if args.keep:
+            print('Scratch folder:', folder)
+        else:
+            subprocess.call(['rm', '-rf', folder])
+    print_results(results)
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=4)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print('Regression:', regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
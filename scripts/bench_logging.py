@@ -0,0 +1,118 @@
+"""
+Micro-benchmark: how long logging blocks the event loop during a scrape.
+Many coroutines log one debug line per "page" like Crawler.scrape_url, while a watchdog coroutine measures how late
+its wake-ups are. Compares the old set-up (synchronous FileHandlers, messages built by concatenation) with
+logs.setup() (queue handler, files written by a background thread, deferred formatting), with the debug level on
+and off. --fsync makes every write of the file handlers durable, like a slow or network disk.
+
+Usage: python -m scripts.bench_logging --pages 20000 --fsync
+"""
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import tempfile
+import time
+
+import logs
+
+
+def fsync_on_flush(handler):
+    flush = handler.flush
+
+    def durable_flush():
+        flush()
+        if handler.stream is not None:
+            os.fsync(handler.stream.fileno())
+
+    handler.flush = durable_flush
+    return handler
+
+
+def old_logger(folder, level, fsync):
+    logger = logging.getLogger('bench-old')
+    logger.propagate = 0
+    logger.setLevel(logging.DEBUG)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    debug_handler = logging.FileHandler(os.path.join(folder, 'old_debug.txt'), mode='w')
+    debug_handler.setLevel(level)
+    error_handler = logging.FileHandler(os.path.join(folder, 'old_error.txt'), mode='w')
+    error_handler.setLevel(logging.ERROR)
+    for handler in [debug_handler, error_handler]:
+        logger.addHandler(fsync_on_flush(handler) if fsync else handler)
+    return logger
+
+
+def new_logger(folder, level, fsync):
+    logger = logs.setup(level=logging.getLevelName(level), debug_filename=os.path.join(folder, 'new_debug.txt'),
+                        error_filename=os.path.join(folder, 'new_error.txt'))
+    if fsync:
+        for handler in logs._listener.handlers:
+            if isinstance(handler, logging.FileHandler):
+                fsync_on_flush(handler)
+    return logger
+
+
+async def scrape(logger, pages, deferred, concurrency=50):
+    async def page_worker(worker):
+        for page in range(worker, pages, concurrency):
+            url = 'https://osf.io/{:05d}/files/'.format(page)
+            await asyncio.sleep(0)
+            if deferred:
+                logger.debug("Finished : %s", url)
+            else:
+                logger.debug("Finished : " + url)
+
+    await asyncio.gather(*[page_worker(worker) for worker in range(concurrency)])
+
+
+async def watchdog(done, lags, interval=0.001):
+    while not done.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+
+
+def run(logger, pages, deferred):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    lags = []
+
+    async def main():
+        done = asyncio.Event()
+        watcher = asyncio.ensure_future(watchdog(done, lags))
+        await scrape(logger, pages, deferred)
+        done.set()
+        await watcher
+
+    start = time.perf_counter()
+    loop.run_until_complete(main())
+    elapsed = time.perf_counter() - start
+    loop.close()
+    return elapsed, lags
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--pages', type=int, default=20000, help="Log lines, one per page")
+    parser.add_argument('--fsync', action='store_true', help="fsync the log files after every record")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        print('{} pages, fsync {}'.format(args.pages, 'on' if args.fsync else 'off'))
+        for level in [logging.DEBUG, logging.INFO]:
+            for name, make, deferred in [('FileHandler, concatenation', old_logger, False),
+                                         ('logs.setup(), deferred', new_logger, True)]:
+                logger = make(folder, level, args.fsync)
+                elapsed, lags = run(logger, args.pages, deferred)
+                if make is new_logger:
+                    logs.shutdown()
+                print('  level {:<5} {:<28} loop {:7.3f}s  lag mean {:6.2f}ms  max {:7.2f}ms'.format(
+                    logging.getLevelName(level), name, elapsed, statistics.mean(lags) * 1000 if lags else 0,
+                    max(lags) * 1000 if lags else 0))
+
+
+if __name__ == '__main__':
+    main()
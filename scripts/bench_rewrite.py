@@ -0,0 +1,81 @@
+"""
+Micro-benchmark: rewriting scraped pages for the mirror.
+Compares the old chained str.replace calls plus concatenation of the mirror warning with the single-pass
+Rewriter of crawler.MIRROR_REWRITER, on pages saved in archive/ (the rewrites they already went through are undone
+first). Without saved pages, synthetic pages with the same markup are used. --extra_rules adds literal link
+rewrites to both, to show how the cost grows with the number of rules.
+
+Usage: python -m scripts.bench_rewrite --pages 500 --extra_rules 5
+"""
+import argparse
+import glob
+import os
+import time
+
+import settings
+from crawler import MIRROR_REWRITER, mirror_warning
+from rewriter import Rewriter, Rule
+
+
+def load_pages(limit):
+    paths = sorted(glob.glob(os.path.join(settings.ARCHIVE_ROOT, '**', 'index.html'), recursive=True))[:limit]
+    pages = []
+    for path in paths:
+        with open(path, encoding='utf-8', errors='replace') as file:
+            html = file.read()
+        for rule in MIRROR_REWRITER.rules:
+            html = html.replace(rule.replacement, rule.pattern)
+        pages.append(html)
+    return pages
+
+
+def synthetic_pages(count, size_kb=300):
+    # One link to another OSF page per KB of text
+    filler = ''.join('<p><a href="https://osf.io/{}bcde/">link</a> {}</p>\n'.format(chr(ord('a') + i), 'x' * 970)
+                     for i in range(5))
+    body = ''.join(rule.pattern + '\n' + filler * (size_kb // 10) for rule in MIRROR_REWRITER.rules)
+    return ['<html><body>\n' + body + '</body></html>' for _ in range(count)]
+
+
+def chained_replace(pages, rules):
+    warning = mirror_warning()
+    for html in pages:
+        for rule in rules:
+            html = html.replace(rule.pattern, rule.replacement)
+        html + warning
+
+
+def single_pass(pages, rules):
+    rewriter = Rewriter(rules)
+    warning = mirror_warning()
+    for html in pages:
+        rewriter.rewrite(html, suffix=warning)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--pages', type=int, default=500, help="Saved pages to load at most")
+    parser.add_argument('--extra_rules', type=int, default=5, help="Literal rules added to the mirror rules")
+    args = parser.parse_args()
+
+    pages = load_pages(args.pages)
+    source = 'archive/'
+    if not pages:
+        pages = synthetic_pages(min(args.pages, 100))
+        source = 'synthetic'
+    megabytes = sum(len(html) for html in pages) / 1e6
+    print('{} pages from {}, {:.1f} MB'.format(len(pages), source, megabytes))
+
+    extra = [Rule('href="https://osf.io/{}'.format(chr(ord('a') + i)), 'href="/{}'.format(chr(ord('a') + i)))
+             for i in range(args.extra_rules)]
+    for rules in [MIRROR_REWRITER.rules, MIRROR_REWRITER.rules + extra]:
+        print('{} rules:'.format(len(rules)))
+        for name, function in [('chained str.replace', chained_replace), ('single pass', single_pass)]:
+            start = time.perf_counter()
+            function(pages, rules)
+            elapsed = time.perf_counter() - start
+            print('  {:<20} {:8.3f}s  {:8.1f} MB/s'.format(name, elapsed, megabytes / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Benchmark: requests/sec with a fresh aiohttp.ClientSession per request (the old behaviour of every Crawler fetch)
+against the Crawler's shared, pooled per-host session. Runs against a local scripts.fake_osf server.
+
+Usage: python -m scripts.bench_sessions --requests 2000 --concurrency 10
+"""
+import argparse
+import asyncio
+import time
+
+import aiohttp
+
+from crawler import Crawler
+from scripts.fake_osf import FakeOSF
+
+
+async def fresh_session_get(url, sem):
+    # What parse_*_api / scrape_url used to do for every single url
+    async with sem:
+        async with aiohttp.ClientSession() as s:
+            response = await s.get(url)
+            await response.read()
+            response.close()
+
+
+async def shared_session_get(crawler, url, sem):
+    async with sem:
+        await crawler._fetch(url)
+
+
+def run(label, coroutines):
+    loop = asyncio.get_event_loop()
+    start = time.monotonic()
+    loop.run_until_complete(asyncio.gather(*coroutines))
+    elapsed = time.monotonic() - start
+    print('{:<16} {:>6} requests in {:6.2f}s  {:8.1f} req/s'.format(label, len(coroutines), elapsed,
+                                                                   len(coroutines) / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--page_size', type=int, default=50, help="Size of the served pages in KB")
+    args = parser.parse_args()
+
+    osf = FakeOSF(page_size=args.page_size).start()
+    urls = [osf.http_base + osf.guid('nodes', i % osf.records) + '/' for i in range(args.requests)]
+    try:
+        sem = asyncio.BoundedSemaphore(args.concurrency)
+        run('fresh session', [fresh_session_get(url, sem) for url in urls])
+
+        rosie = Crawler()
+        sem = asyncio.BoundedSemaphore(args.concurrency)
+        run('shared session', [shared_session_get(rosie, url, sem) for url in urls])
+        rosie.close()
+    finally:
+        osf.stop()
+
+
+if __name__ == '__main__':
+    main()
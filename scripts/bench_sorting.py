@@ -0,0 +1,75 @@
+"""
+Micro-benchmark: ordering (url, datetime) tuples the way parse_nodes_api receives them, one API page at a time.
+Compares sorting the whole list after every append (the old behaviour) with the SortedRuns accumulator.
+The old approach is quadratic, so it is timed on smaller inputs and extrapolated to the full record count.
+
+Usage: python -m scripts.bench_sorting --records 1000000
+"""
+import argparse
+import datetime
+import random
+import time
+
+from crawler import SortedRuns
+
+BASE_DATE = datetime.datetime(2012, 1, 1)
+
+
+def make_records(n, per_page=10):
+    # Pages come back out of order, and records inside a page are not sorted by date either
+    records = [('https://osf.io/' + str(i).zfill(5) + '/', BASE_DATE + datetime.timedelta(seconds=i * 37))
+               for i in range(n)]
+    pages = [records[i:i + per_page] for i in range(0, n, per_page)]
+    random.shuffle(pages)
+    for page in pages:
+        random.shuffle(page)
+    return [record for page in pages for record in page]
+
+
+def sort_on_every_append(records):
+    tuples = []
+    for record in records:
+        tuples.append(record)
+        tuples.sort(key=lambda x: x[1])
+    return tuples
+
+
+def sorted_runs(records):
+    runs = SortedRuns(key=lambda x: x[1])
+    for record in records:
+        runs.append(record)
+    return runs.merge()
+
+
+def timed(function, records):
+    start = time.perf_counter()
+    result = function(records)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--records', type=int, default=1000000)
+    parser.add_argument('--old_sizes', type=int, nargs='+', default=[2000, 4000, 8000],
+                        help="Sizes the sort-on-every-append approach is timed on")
+    args = parser.parse_args()
+    random.seed(0)
+
+    print('sort on every append:')
+    for n in args.old_sizes:
+        records = make_records(n)
+        elapsed, result = timed(sort_on_every_append, records)
+        assert result == sorted(records, key=lambda x: x[1])
+        extrapolated = elapsed * (args.records / n) ** 2
+        print('  {:>9} records {:8.3f}s   (~{:,.0f}s extrapolated to {:,})'.format(n, elapsed, extrapolated,
+                                                                                 args.records))
+
+    records = make_records(args.records)
+    elapsed, result = timed(sorted_runs, records)
+    assert result == sorted(records, key=lambda x: x[1])
+    print('SortedRuns:')
+    print('  {:>9} records {:8.3f}s'.format(args.records, elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+"""
+Benchmark of the verifier's spot checks: pages per second, and per core, of
+    BeautifulSoup   Verifier.spot_check(), one page at a time with html.parser (the reference)
+    lxml, 1 process spotcheck.check_files() in this process
+    lxml, N         spotcheck.check_files() in a pool of N processes
+and whether every page gets the same result as with the reference. The corpus is either a scraped mirror (--mirror,
+its project pages, checked with the rules of their page type) or synthetic pages (--pages) in which each checked
+element is randomly filled, empty, missing, or replaced by its alternate. Exits with status 1 if a result differs.
+
+Usage: python -m scripts.bench_spot_check --pages 2000 --workers 4
+       python -m scripts.bench_spot_check --mirror archive
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+
+from bs4 import BeautifulSoup
+
+import settings
+import spotcheck
+import verifier
+
+# Verifiers of the project pages, by page type segment (see verifier.url_aspect)
+PROJECT_VERIFIERS = {
+    '': verifier.ProjectDashboardVerifier,
+    'files': verifier.ProjectFilesVerifier,
+    'wiki': verifier.ProjectWikiVerifier,
+    'analytics': verifier.ProjectAnalyticsVerifier,
+    'registrations': verifier.ProjectRegistrationsVerifier,
+    'forks': verifier.ProjectForksVerifier,
+}
+ASPECTS = sorted(PROJECT_VERIFIERS)
+
+
+def element_html(selector, content):
+    """
+    HTML matched by a simple CSS selector (tags, ids, classes, :nth-of-type, descendant and child combinators),
+    with content in its innermost element.
+    """
+    html = content
+    for compound in reversed(re.split(r'\s*>\s*|\s+', selector.strip())):
+        match = re.match(r'^([a-z0-9]*)((?:[#.][\w-]+)*)(?::nth-of-type\((\d+)\))?$', compound)
+        tag, qualifiers, nth = match.group(1) or 'div', match.group(2), int(match.group(3) or 1)
+        if tag == 'body':
+            continue
+        ids = re.findall(r'#([\w-]+)', qualifiers)
+        classes = re.findall(r'\.([\w-]+)', qualifiers)
+        attributes = (' id="{}"'.format(ids[0]) if ids else '') + \
+                     (' class="{}"'.format(' '.join(classes)) if classes else '')
+        html = '<{0}></{0}>'.format(tag) * (nth - 1) + '<{0}{1}>{2}</{0}>'.format(tag, attributes, html)
+    return html
+
+
+def synthetic_page(rules, rng, filler_size):
+    parts = []
+    for loader, final_element in rules.loading_elements:
+        if rng.random() < 0.1:
+            parts.append(element_html(loader, 'Loading'))
+        if rng.random() < 0.9:
+            parts.append(element_html(final_element, 'content'))
+    for element, alternate in rules.alternate_elements:
+        state = rng.random()
+        if state < 0.75:
+            parts.append(element_html(element, 'content'))
+        elif state < 0.85:
+            parts.append(element_html(element, ''))
+        elif alternate and state < 0.95:
+            parts.append(element_html(alternate, 'No content'))
+    rng.shuffle(parts)
+    return '<html><head><title>page</title></head><body>\n{}\n<p>{}</p></body></html>'.format(
+        '\n'.join(parts), 'x' * filler_size)
+
+
+def synthetic_corpus(folder, pages, filler_size, seed):
+    """
+    :return: list of (page type segment, url, path) of the pages written to folder
+    """
+    rng = random.Random(seed)
+    rule_sets = {aspect: PROJECT_VERIFIERS[aspect]().rules() for aspect in ASPECTS}
+    corpus = []
+    for number in range(pages):
+        aspect = ASPECTS[number % len(ASPECTS)]
+        url = '{}p{:05d}/{}'.format(settings.base_urls[0], number, aspect + '/' if aspect else '')
+        path = os.path.join(folder, 'p{:05d}-{}.html'.format(number, aspect or 'dashboard'))
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write(synthetic_page(rule_sets[aspect], rng, filler_size))
+        corpus.append((aspect, url, path))
+    return corpus
+
+
+def mirror_corpus(mirror):
+    corpus = []
+    for root, folders, files in os.walk(mirror):
+        if 'index.html' in files:
+            path = os.path.join(root, 'index.html')
+            url = settings.base_urls[0] + os.path.relpath(root, mirror).replace(os.sep, '/') + '/'
+            corpus.append((verifier.url_aspect(url), url, path))
+    return corpus
+
+
+def reference_results(corpus, rule_sets):
+    failures = {}
+    for aspect, url, path in corpus:
+        with open(path, encoding='utf-8', errors='replace') as file:
+            reason = spotcheck.check(spotcheck.SoupDocument(BeautifulSoup(file, 'html.parser')), rule_sets[aspect])
+        if reason is not None:
+            failures[url] = reason
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mirror', default=None, help="Check the pages of this mirror instead of synthetic ones")
+    parser.add_argument('--pages', type=int, default=2000, help="Number of synthetic pages")
+    parser.add_argument('--page_size', type=int, default=200, help="Size of the synthetic pages in KB")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="Processes of the pool")
+    parser.add_argument('--chunk_size', type=int, default=settings.VERIFY_CHUNK_SIZE)
+    args = parser.parse_args()
+    spotcheck.check_parser('lxml')
+
+    with tempfile.TemporaryDirectory() as folder:
+        if args.mirror:
+            corpus = mirror_corpus(args.mirror)
+        else:
+            corpus = synthetic_corpus(folder, args.pages, args.page_size * 1000, args.seed)
+        rule_sets = {aspect: PROJECT_VERIFIERS[aspect]().rules() for aspect in ASPECTS}
+        indexed_rules = [rule_sets[aspect] for aspect in ASPECTS]
+        items = [(ASPECTS.index(aspect), url, path) for aspect, url, path in corpus]
+        print('{} pages'.format(len(corpus)))
+
+        runs = [('BeautifulSoup', 1, lambda: reference_results(corpus, rule_sets)),
+                ('lxml, 1 process', 1,
+                 lambda: spotcheck.check_files(items, indexed_rules, 1, 'lxml', args.chunk_size)),
+                ('lxml, {} processes'.format(args.workers), args.workers,
+                 lambda: spotcheck.check_files(items, indexed_rules, args.workers, 'lxml', args.chunk_size))]
+        reference = None
+        mismatches = 0
+        for name, cores, run in runs:
+            start = time.perf_counter()
+            failures = run()
+            elapsed = time.perf_counter() - start
+            if reference is None:
+                reference = failures
+            differing = [url for url in set(reference) | set(failures) if reference.get(url) != failures.get(url)]
+            mismatches += len(differing)
+            print('  {:<22} {:8.1f} pages/s  {:8.1f} pages/s per core  {:5} failed  {} differ from the reference'
+                  .format(name, len(corpus) / elapsed, len(corpus) / elapsed / cores, len(failures), len(differing)))
+            for url in sorted(differing)[:5]:
+                print('    {}: {} / {}'.format(url, reference.get(url), failures.get(url)))
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+"""
+A local stand-in for the OSF and its API V2, built on aiohttp, for tests and benchmarks.
+
+The API lives under /v2/ (nodes/, registrations/, users/, institutions/, and the wikis/ listing of every node and
+registration) and every other path is answered with a synthetic rendered page, so a Crawler pointed at http_base /
+api_base never leaves the machine. Rendered pages take a random time drawn from --latency_distribution around
+--latency (dashboards --dashboard_factor times more), and --error_rate of them are 504s. With --etags, responses
+carry an ETag and conditional requests get 304s. To run the CLI against it, set ROSIEBOT_HTTP_BASE and
+ROSIEBOT_API_BASE (see settings.py), or see scripts/bench_e2e.py.
+
+:param --port in CLI: port to listen on (default 8000)
+Usage: python -m scripts.fake_osf --port 8000
+"""
+import argparse
+import asyncio
+import datetime
+import hashlib
+import json
+import math
+import random
+import threading
+import urllib.parse
+
+from aiohttp import web
+
+API_KINDS = ['nodes', 'registrations', 'users', 'institutions']
+
+# Distributions of the latency of the rendered pages, all with the given mean
+LATENCY_DISTRIBUTIONS = ['fixed', 'uniform', 'exponential', 'lognormal']
+
+
+class FakeOSF:
+    """
+    Serves the fake OSF from a background thread with its own event loop, so it can run next to a Crawler
+    in the same process. Init -> start() -> point the crawler at http_base / api_base -> stop()
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, records=100, per_page=10, page_size=50, latency=0.0,
+                 error_rate=0.0, etags=False, latency_distribution='fixed', dashboard_factor=1.0, seed=None):
+        """
+        :param host: interface to bind
+        :param port: port to bind, 0 picks a free one
+        :param records: number of records in each API listing
+        :param per_page: records per API page
+        :param page_size: size of the synthetic rendered pages in KB
+        :param latency: mean seconds a rendered page takes
+        :param error_rate: fraction of rendered pages answered with a 504, like an overloaded Prerender
+        :param etags: whether responses carry an ETag, and If-None-Match requests of unchanged content get a 304
+        :param latency_distribution: one of LATENCY_DISTRIBUTIONS; lognormal has a long tail like Prerender's
+        :param dashboard_factor: how many times longer dashboards (the slowest pages to render) take
+        :param seed: seed of the random latencies and errors, for repeatable runs
+        """
+        if latency_distribution not in LATENCY_DISTRIBUTIONS:
+            raise ValueError("Unknown latency distribution: " + latency_distribution)
+        self.host = host
+        self.port = port
+        self.records = records
+        self.per_page = per_page
+        self.page_size = page_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.etags = etags
+        self.latency_distribution = latency_distribution
+        self.dashboard_factor = dashboard_factor
+        self.random = random.Random(seed)
+
+        self.requests_served = 0
+        self.not_modified_served = 0
+        self._loop = None
+        self._thread = None
+        self._handler = None
+        self._server = None
+
+    @property
+    def http_base(self):
+        return 'http://{}:{}/'.format(self.host, self.port)
+
+    @property
+    def api_base(self):
+        return self.http_base + 'v2/'
+
+    def guid(self, kind, i):
+        """
+        Deterministic five character GUID of the i-th record of an API listing, e.g. 'n0042'
+        """
+        return kind[0] + str(i).zfill(4)
+
+    def record(self, kind, i):
+        date = (datetime.datetime(2016, 1, 1) + datetime.timedelta(minutes=i)).isoformat()
+        return {
+            'id': self.guid(kind, i),
+            'type': kind,
+            'attributes': {
+                'name': 'home',
+                'date_modified': date,
+                'date_registered': date,
+            }
+        }
+
+    async def api_listing(self, request):
+        kind = request.match_info['kind']
+        query = urllib.parse.parse_qs(request.query_string)
+        page = int(query.get('page', ['1'])[0])
+        last_page = max(1, -(-self.records // self.per_page))
+        start = (page - 1) * self.per_page
+        data = [self.record(kind, i) for i in range(start, min(start + self.per_page, self.records))]
+
+        def page_url(n):
+            return self.api_base + kind + '/?page=' + str(n)
+
+        body = {
+            'data': data,
+            'links': {
+                'first': page_url(1),
+                'last': page_url(last_page),
+                'prev': page_url(page - 1) if page > 1 else None,
+                'next': page_url(page + 1) if page < last_page else None,
+                'meta': {'total': self.records, 'per_page': self.per_page}
+            }
+        }
+        return self._respond(json.dumps(body), 'application/json', request)
+
+    async def wiki_listing(self, request):
+        body = {
+            'data': [{'id': request.match_info['guid'] + '-home', 'type': 'wikis', 'attributes': {'name': 'home'}}],
+            'links': {'first': None, 'last': None, 'prev': None, 'next': None,
+                      'meta': {'total': 1, 'per_page': self.per_page}}
+        }
+        return self._respond(json.dumps(body), 'application/json', request)
+
+    def page_latency(self, path):
+        """
+        Seconds the rendering of a page takes, drawn at random.
+        """
+        if not self.latency:
+            return 0.0
+        if self.latency_distribution == 'uniform':
+            seconds = self.random.uniform(0, 2 * self.latency)
+        elif self.latency_distribution == 'exponential':
+            seconds = self.random.expovariate(1 / self.latency)
+        elif self.latency_distribution == 'lognormal':
+            sigma = 1.0
+            seconds = self.random.lognormvariate(math.log(self.latency) - sigma ** 2 / 2, sigma)
+        else:
+            seconds = self.latency
+        if '/' not in path.strip('/'):
+            seconds *= self.dashboard_factor
+        return seconds
+
+    async def rendered_page(self, request):
+        path = request.match_info['path']
+        delay = self.page_latency(path)
+        if delay:
+            await asyncio.sleep(delay)
+        if self.random.random() < self.error_rate:
+            self.requests_served += 1
+            return web.Response(status=504, body=b'Gateway Timeout')
+        filler = '<p>' + 'x' * 1000 + '</p>\n'
+        # With the elements the indexer reads from dashboards and profiles
+        html = ('<html><head><title>{0}</title></head><body>\n'
+                '<div id="projectScope"><h2 id="nodeTitleEditable">{0}</h2></div>\n'
+                '<div id="social">{0}</div><div id="jobs"></div><div id="schools"></div>\n'
+                '{1}</body></html>').format(path, filler * self.page_size)
+        return self._respond(html, 'text/html', request)
+
+    def _respond(self, text, content_type, request):
+        self.requests_served += 1
+        body = text.encode('utf-8')
+        if not self.etags:
+            return web.Response(body=body, content_type=content_type)
+        etag = '"' + hashlib.sha1(body).hexdigest()[:16] + '"'
+        if request.headers.get('If-None-Match') == etag:
+            self.not_modified_served += 1
+            return web.Response(status=304, headers={'ETag': etag})
+        return web.Response(body=body, content_type=content_type, headers={'ETag': etag})
+
+    def _make_app(self):
+        app = web.Application(loop=self._loop)
+        app.router.add_route('GET', '/v2/{kind}/', self.api_listing)
+        app.router.add_route('GET', '/v2/{kind}/{guid}/wikis/', self.wiki_listing)
+        app.router.add_route('GET', '/{path:.*}', self.rendered_page)
+        return app
+
+    def start(self):
+        """
+        Starts serving in a background thread and returns once the socket is bound.
+        """
+        self._loop = asyncio.new_event_loop()
+        started = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(started,), daemon=True)
+        self._thread.start()
+        started.wait()
+        return self
+
+    def _run(self, started):
+        asyncio.set_event_loop(self._loop)
+        self._handler = self._make_app().make_handler()
+        self._server = self._loop.run_until_complete(self._loop.create_server(self._handler, self.host, self.port))
+        self.port = self._server.sockets[0].getsockname()[1]
+        started.set()
+        self._loop.run_forever()
+
+    def stop(self):
+        """
+        Stops the server and its thread.
+        """
+        def shutdown():
+            self._server.close()
+            self._loop.stop()
+        self._loop.call_soon_threadsafe(shutdown)
+        self._thread.join()
+        self._loop.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve a fake OSF for local testing")
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--records', type=int, default=100)
+    parser.add_argument('--per_page', type=int, default=10)
+    parser.add_argument('--page_size', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--error_rate', type=float, default=0.0)
+    parser.add_argument('--etags', action='store_true')
+    parser.add_argument('--latency_distribution', choices=LATENCY_DISTRIBUTIONS, default='fixed')
+    parser.add_argument('--dashboard_factor', type=float, default=1.0)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+    osf = FakeOSF(port=args.port, records=args.records, per_page=args.per_page, page_size=args.page_size,
+                  latency=args.latency, error_rate=args.error_rate, etags=args.etags,
+                  latency_distribution=args.latency_distribution, dashboard_factor=args.dashboard_factor,
+                  seed=args.seed).start()
+    print("Serving fake OSF at", osf.http_base, "API at", osf.api_base)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        osf.stop()
@@ -1,5 +1,80 @@
-# The OSF website URL, and the API
-base_urls = ['https://osf.io/', 'https://api.osf.io/v2/']
+import os
+
+# The OSF website URL, and the API. The ROSIEBOT_HTTP_BASE and ROSIEBOT_API_BASE environment variables point the
+# crawler somewhere else, e.g. at a local scripts/fake_osf.py server
+base_urls = [os.environ.get('ROSIEBOT_HTTP_BASE', 'https://osf.io/'),
+             os.environ.get('ROSIEBOT_API_BASE', 'https://api.osf.io/v2/')]
 
 DEBUG_LOG_FILENAME = 'debug_log.txt'
 ERROR_LOG_FILENAME = 'error_log.txt'
+
+# Connection pooling for the crawler's shared aiohttp sessions (one session per host)
+CONNECTION_LIMIT_PER_HOST = 100  # Simultaneous connections to one host, keep above the concurrency maximums below
+KEEPALIVE_TIMEOUT = 30  # Seconds an idle pooled connection is kept open
+USE_DNS_CACHE = True
+
+# API crawling
+API_PREFETCH_WINDOW = 10  # API pages kept in flight while streaming a listing
+
+# Pipelined scrape (cli.py --scrape --pipeline)
+PIPELINE_QUEUE_SIZE = 1000  # Page urls waiting for a worker before the API crawl is held back
+
+# Adaptive (AIMD) concurrency, see throttle.py. Limits start at the _INITIAL value and move between min and max.
+PAGE_CONCURRENCY_INITIAL = 5  # Prerender page requests in flight
+PAGE_CONCURRENCY_MIN = 1
+PAGE_CONCURRENCY_MAX = 40
+PAGE_LATENCY_TARGET = 30.0  # Seconds; a smoothed page latency above this cuts the limit
+API_CONCURRENCY_INITIAL = 10  # API listing requests in flight
+WIKI_CONCURRENCY_INITIAL = 5  # Wiki listing requests in flight
+API_CONCURRENCY_MAX = 40
+API_LATENCY_TARGET = 5.0
+
+# Inline retries of page and API listing requests, see retry.py
+RETRY_MAX_ATTEMPTS = 4  # Attempts per page, including the first
+RETRY_BASE_DELAY = 1.0  # Seconds before the second attempt; doubles every attempt, fully jittered
+RETRY_MAX_DELAY = 60.0  # Longest wait between attempts, also caps Retry-After
+RETRY_STATUSES = [429, '5xx']  # Statuses, or classes of statuses, worth retrying
+
+# Progress journal of a scrape task (journal.py): fsync after this many lines, or this many seconds
+JOURNAL_SYNC_EVERY = 100
+JOURNAL_SYNC_INTERVAL = 1.0
+
+# Writing the mirror (writer.py)
+# Folder of the static mirror, or the ROSIEBOT_ARCHIVE_ROOT environment variable
+ARCHIVE_ROOT = os.environ.get('ROSIEBOT_ARCHIVE_ROOT',
+                              os.path.join(os.path.dirname(os.path.abspath(__file__)), 'archive'))
+WRITER_THREADS = 4  # Threads writing pages to disk
+WRITER_MAX_PENDING = 200  # Pages waiting to be written before new requests are held back
+DIGEST_STORE_FILENAME = ARCHIVE_ROOT + '-digests'  # dbm file of the digests of the saved pages (digests.py)
+VALIDATOR_CACHE_FILENAME = ARCHIVE_ROOT + '-validators'  # dbm file of the ETags of the pages and wikis (httpcache.py)
+GZIP_LEVEL = 9  # Compression of the .gz siblings written with --compress gzip (compressor.py)
+BROTLI_QUALITY = 9  # Compression of the .br siblings written with --compress brotli, 11 is much slower
+
+# Sharded scrape (cli.py --workers N, shards.py)
+SHARD_PAGE_BUDGET = 40  # Page requests in flight across all the shard processes together
+SHARD_BUDGET_TIMEOUT = 1.0  # Seconds a thread waits for an exhausted budget before it starts waiting again
+
+# Distributed scrape (cli.py --queue, --worker, workqueue.py)
+QUEUE_BATCH_SIZE = 50  # Page urls a worker keeps leased and in progress at once
+QUEUE_LEASE_SECONDS = 300  # A url whose worker did not report it or renew its lease in this time is queued again
+QUEUE_POLL_INTERVAL = 5  # Seconds between two looks at the queue, of a coordinator or of a worker with no work
+
+# Metrics (cli.py --metrics-port, --metrics-file, metrics.py)
+METRICS_HOST = '127.0.0.1'  # Interface the Prometheus endpoint listens on
+METRICS_INTERVAL = 15  # Seconds between two JSON snapshots, also the window of rosie_pages_per_second
+METRICS_LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]  # Seconds, request latency histograms
+
+# Logging (logs.py). The logs are written by a background thread, and rotate at LOG_MAX_BYTES.
+LOG_LEVEL = 'DEBUG'  # Lowest level written to the debug log (DEBUG logs every page), also cli.py --log-level
+LOG_MAX_BYTES = 100 * 1024 * 1024
+LOG_BACKUP_COUNT = 5  # Rotated files kept: debug_log.txt.1 ... .5
+
+# Cassettes (cli.py --record, --replay, cassette.py)
+CASSETTE_COMPRESSION_LEVEL = 6  # zlib level of the recorded bodies
+CASSETTE_LATENCY_SCALE = 0.0  # Played responses take this times their recorded latency, also cli.py --replay-latency
+
+# Verification (verifier.py, spotcheck.py)
+VERIFY_WORKERS = None  # Processes spot-checking the saved pages, None for one per CPU, also cli.py --verify-workers
+VERIFY_PARSER = 'lxml'  # 'lxml' (pip install lxml cssselect), or BeautifulSoup's 'html.parser', used if lxml is missing
+VERIFY_CHUNK_SIZE = 64  # Pages handed to a spot check process at a time
+VERIFY_CACHE_FILENAME = ARCHIVE_ROOT + '-verified'  # dbm file of the verdicts of the verifier (verifycache.py)
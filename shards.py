@@ -0,0 +1,223 @@
+"""Sharded scrape: the page scrape of a task split across several processes (cli.py --workers N)"""
+
+import asyncio
+import glob
+import multiprocessing
+import os
+import queue
+import re
+import traceback
+import urllib.parse
+import zlib
+
+import completion
+import cassette
+import crawler
+import journal
+import logs
+import metrics
+import settings
+import digests
+from digests import DigestStore
+from httpcache import ValidatorCache
+
+# Url lists of the task file, the scrape method of the Crawler for each (also the flag of the task file saying
+# whether the task scrapes them) and the flag set once they are scraped
+PHASES = [
+    ('node_urls', 'scrape_nodes', 'nodes_finished'),
+    ('registration_urls', 'scrape_registrations', 'registrations_finished'),
+    ('user_urls', 'scrape_users', 'users_finished'),
+    ('institution_urls', 'scrape_institutions', 'institutions_finished'),
+]
+
+
+def url_guid(url):
+    """
+    GUID of the node, registration, user or institution a page url belongs to, e.g.
+    https://osf.io/mst3k/files/ -> mst3k
+    """
+    return urllib.parse.urlsplit(url).path.strip('/').split('/')[0]
+
+
+def shard_of(url, workers):
+    """
+    Shard a page url belongs to: all the pages of one GUID go to the same shard, run after run.
+    """
+    return zlib.crc32(url_guid(url).encode('utf-8')) % workers
+
+
+def partition(urls, workers):
+    """
+    Splits a url list into one list per shard, keeping the order of the urls.
+    """
+    shards = [[] for _ in range(workers)]
+    for url in urls:
+        shards[shard_of(url, workers)].append(url)
+    return shards
+
+
+def shard_filename(filename, shard, workers):
+    """
+    File name of the own copy of one shard of a file that processes cannot share, e.g.
+    archive-digests -> archive-digests.shard2of4, 201606231548.changed -> 201606231548.shard2of4.changed
+    """
+    root, extension = os.path.splitext(filename)
+    return '{}.shard{}of{}{}'.format(root, shard + 1, workers, extension)
+
+
+def scrape_in_shards(rosie, store, lists, workers):
+    """
+    Scrapes the pages of a task in `workers` processes, each with its own event loop, sessions and Crawler, and
+    its share of every url list (partitioned by GUID hash). The processes share one budget of concurrent page
+    requests (SHARD_PAGE_BUDGET) so that together they do not overload Prerender.
+    Each shard journals its progress to its own journal (see journal.shard_journal_path) and has its own list of
+    changed pages. The shards read the digest store and validator cache of the mirror, and write what they learn
+    to their own files, which are merged back into them afterwards (see merge_shard_stores()), so the next run
+    uses them whatever its number of workers. Once they are done, the shard journals are merged into the task
+    file, and the phases whose every shard finished are marked as finished.
+    Each shard writes its own debug and error logs (debug_log.shard1of4.txt, ...).
+    If the metrics are exported, each shard exports its own: on the next ports (shard 1 on port + 1, ...) and to
+    its own snapshot file.
+    :param rosie: Crawler of the task, holding the task file
+    :param store: dictionary of the task file
+    :param lists: {list name: urls to scrape}, e.g. {'node_urls': [...]}, in the order of PHASES
+    :param workers: number of processes
+    """
+    task_filename = rosie.database.name
+    budget = multiprocessing.BoundedSemaphore(settings.SHARD_PAGE_BUDGET)
+    results = multiprocessing.Queue()
+    metrics_port, metrics_file = metrics.exporting()
+    shard_lists = {list_name: partition(urls, workers) for list_name, urls in lists.items()}
+    # The shards only read the shared stores, which must not be open for writing meanwhile. What shards of an
+    # interrupted run learnt is folded in first
+    if rosie.writer.digest_store is not None:
+        rosie.writer.digest_store.close()
+    rosie.validators.close()
+    merge_shard_stores()
+    processes = []
+    for shard in range(workers):
+        own_lists = {list_name: shards[shard] for list_name, shards in shard_lists.items()}
+        process = multiprocessing.Process(target=_run_shard,
+                                          args=(task_filename, store, own_lists, shard, workers, budget, results,
+                                                metrics_port, metrics_file),
+                                          name='shard{}of{}'.format(shard + 1, workers))
+        process.start()
+        processes.append(process)
+
+    summaries = []
+    while len(summaries) < workers:
+        try:
+            summaries.append(results.get(timeout=1))
+        except queue.Empty:
+            if not any(process.is_alive() for process in processes) and results.empty():
+                break
+    for process in processes:
+        process.join()
+    merge_shard_stores()
+
+    finished = len(summaries) == workers and not any(summary.get('error') for summary in summaries)
+    for summary in summaries:
+        if summary.get('error'):
+            rosie.debug_logger.error("Shard %d failed:\n%s", summary['shard'] + 1, summary['error'])
+        rosie.writer.changes.update(summary['changes'])
+        for kind, stats in summary['validators'].items():
+            rosie.validators.stats[kind].update(stats)
+        rosie.page_stats.merge(summary['page_stats'])
+        if rosie.page_validator is not None:
+            rosie.page_validator.failures.update(summary['invalid_pages'])
+        if summary['first_page_time'] is not None and (rosie.first_page_time is None or
+                                                        summary['first_page_time'] < rosie.first_page_time):
+            rosie.first_page_time = summary['first_page_time']
+    _merge(rosie, store, task_filename, workers, lists, finished)
+    return finished
+
+
+def merge_shard_stores(filenames=None):
+    """
+    Folds the digest stores and validator caches of the shards, of any number of workers, into the shared ones.
+    :param filenames: file names of the shared stores, DIGEST_STORE_FILENAME and VALIDATOR_CACHE_FILENAME by default
+    :return: number of entries merged
+    """
+    merged = 0
+    for filename in filenames or [settings.DIGEST_STORE_FILENAME, settings.VALIDATOR_CACHE_FILENAME]:
+        # The files of a dbm database may have extensions of their own (.db, .dat, ...)
+        pattern = re.compile(re.escape(filename) + r'\.shard\d+of\d+')
+        shard_stores = {pattern.match(path).group(0) for path in glob.glob(glob.escape(filename) + '.shard*of*')
+                        if pattern.match(path)}
+        for shard_store in sorted(shard_stores):
+            merged += digests.merge_store(filename, shard_store)
+    return merged
+
+
+def _merge(rosie, store, task_filename, workers, lists, finished):
+    for shard in range(workers):
+        journal.apply_journal(store, journal.shard_journal_path(task_filename, shard, workers))
+    rosie.completed = completion.completed_urls(store)
+    rosie.error_list = store['error_list']
+    rosie.attempts = store['attempts']
+    if finished:
+        for list_name, method, flag in PHASES:
+            if list_name in lists:
+                store[flag] = True
+    rosie.compact_journal()
+    journal.discard_shard_journals(task_filename)
+
+    # The shards' lists of changed pages are appended to the one of the task
+    if rosie.writer.changes_file is not None:
+        with open(rosie.writer.changes_file, 'a', encoding='utf-8') as changed:
+            for shard in range(workers):
+                path = shard_filename(rosie.writer.changes_file, shard, workers)
+                if os.path.exists(path):
+                    with open(path, encoding='utf-8') as file:
+                        for line in file:
+                            changed.write(line)
+                    os.remove(path)
+
+
+def _run_shard(task_filename, store, lists, shard, workers, budget, results, metrics_port, metrics_file):
+    """
+    Body of a shard process, see scrape_in_shards().
+    """
+    summary = {'shard': shard, 'changes': {}, 'validators': {}, 'page_stats': {}, 'invalid_pages': {},
+               'first_page_time': None, 'error': None}
+    try:
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        # The metrics inherited from the parent are its own
+        metrics.REGISTRY.reset()
+        logs.setup(debug_filename=shard_filename(settings.DEBUG_LOG_FILENAME, shard, workers),
+                   error_filename=shard_filename(settings.ERROR_LOG_FILENAME, shard, workers))
+        metrics.start(metrics_port + shard + 1 if metrics_port is not None else None,
+                      shard_filename(metrics_file, shard, workers) if metrics_file is not None else None)
+        # A recording is written to one cassette per shard, that a CassettePlayer reads back together
+        tape = cassette.current()
+        if tape is not None and not tape.replaying:
+            cassette.start(record=shard_filename(tape.filename, shard, workers))
+        # The counts of changed pages of earlier runs stay with the parent, which adds up those of the shards
+        rosie = crawler.Crawler(dictionary=dict(store, page_changes=None), compress=store.get('compress') or (),
+                                validate=store.get('validate', False))
+        rosie.journal = journal.Journal(journal.shard_journal_path(task_filename, shard, workers))
+        rosie.writer.digest_store = DigestStore(shard_filename(settings.DIGEST_STORE_FILENAME, shard, workers),
+                                                base=settings.DIGEST_STORE_FILENAME)
+        rosie.writer.changes_file = shard_filename(os.path.splitext(task_filename)[0] + '.changed', shard, workers)
+        rosie.validators = ValidatorCache(shard_filename(settings.VALIDATOR_CACHE_FILENAME, shard, workers),
+                                          base=settings.VALIDATOR_CACHE_FILENAME)
+        rosie.page_limiter.budget = budget
+        rosie.page_limiter.budget_timeout = settings.SHARD_BUDGET_TIMEOUT
+        try:
+            for list_name, method, flag in PHASES:
+                if list_name in lists:
+                    setattr(rosie, list_name, lists[list_name])
+                    getattr(rosie, method)()
+        finally:
+            rosie.close()
+            summary['changes'] = dict(rosie.writer.changes)
+            summary['validators'] = {kind: dict(stats) for kind, stats in rosie.validators.stats.items()}
+            summary['page_stats'] = rosie.page_stats.types
+            if rosie.page_validator is not None:
+                summary['invalid_pages'] = dict(rosie.page_validator.failures)
+            summary['first_page_time'] = rosie.first_page_time
+            metrics.stop()
+            cassette.stop()
+    except Exception:
+        summary['error'] = traceback.format_exc()
+    results.put(summary)
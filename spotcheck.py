@@ -0,0 +1,170 @@
+"""Spot checks of saved pages: the elements a complete page has, looked for in a pool of processes"""
+
+import collections
+import multiprocessing
+import os
+
+from bs4 import BeautifulSoup
+
+import settings
+
+try:
+    import lxml.html
+    from lxml.cssselect import CSSSelector
+except ImportError:
+    lxml = None
+
+PARSERS = ['lxml', 'html.parser']
+
+# What a verifier looks for in its pages, see Verifier.rules():
+#     loading_elements    ((loader selector, selector of what it loads), ...)
+#     alternate_elements  ((selector, selector of the alternate or ''), ...)
+#     loader_is_container whether a loader may stay once its content is in place (dashboards), or means the page
+#                         was saved before it finished loading
+Rules = collections.namedtuple('Rules', ['loading_elements', 'alternate_elements', 'loader_is_container'])
+
+
+def check_parser(parser):
+    """
+    Raises ValueError if the parser is unknown or its modules are not installed.
+    :param parser: one of PARSERS
+    """
+    if parser not in PARSERS:
+        raise ValueError("Unknown parser: " + parser)
+    if parser == 'lxml' and lxml is None:
+        raise ValueError("The lxml parser needs the lxml and cssselect modules: pip install lxml cssselect")
+
+
+def default_parser():
+    """
+    :return: VERIFY_PARSER of settings.py, html.parser if it is lxml and lxml is not installed
+    """
+    if settings.VERIFY_PARSER == 'lxml' and lxml is None:
+        return 'html.parser'
+    return settings.VERIFY_PARSER
+
+
+class SoupDocument:
+    """
+    A page parsed by BeautifulSoup with html.parser, as Page.get_content() does.
+    """
+
+    def __init__(self, soup):
+        self.soup = soup
+
+    def select(self, selector):
+        return self.soup.select(selector)
+
+    @staticmethod
+    def is_empty(element):
+        return len(element.contents) == 0
+
+
+class LxmlDocument:
+    """
+    A page parsed by lxml, queried with selectors compiled beforehand (see compile_selectors()).
+    """
+
+    def __init__(self, html, selectors):
+        self.root = lxml.html.document_fromstring(html, parser=lxml.html.HTMLParser(encoding='utf-8'))
+        self.selectors = selectors
+
+    def select(self, selector):
+        return self.selectors[selector](self.root)
+
+    @staticmethod
+    def is_empty(element):
+        # No text and no child (comments included), like an empty .contents in BeautifulSoup
+        return not element.text and len(element) == 0
+
+
+def compile_selectors(rule_sets):
+    """
+    :return: {selector: compiled CSSSelector} of all the selectors of the rule sets
+    """
+    selectors = {}
+    for rules in rule_sets:
+        for pairs in (rules.loading_elements, rules.alternate_elements):
+            for element, other in pairs:
+                for selector in (element, other):
+                    if selector and selector not in selectors:
+                        selectors[selector] = CSSSelector(selector)
+    return selectors
+
+
+def check(document, rules):
+    """
+    Spot checks a page: a loader must not be left where content belongs, and every element of
+    alternate_elements, or else its alternate, must be present and non-empty.
+    :param document: SoupDocument or LxmlDocument of the page
+    :param rules: Rules of the page type
+    :return: None if the page passes, or why it fails
+    """
+    for loader, final_element in rules.loading_elements:
+        if document.select(loader):  # A loader is present
+            if not rules.loader_is_container:
+                return "existential: {} doesn't exist, loader {} present".format(final_element, loader)
+            if not document.select(final_element):  # Its container is, but what it loads isn't
+                return "existential: {} doesn't exist, loader {} present".format(final_element, loader)
+    for element, alternate in rules.alternate_elements:
+        result = document.select(element)
+        if len(result) == 0 or document.is_empty(result[0]):
+            # No results or empty results, without alternate
+            if alternate == '':
+                return "{} No alt.".format(element)
+            # Element's alternate has no or empty results
+            alternate_result = document.select(alternate)
+            if len(alternate_result) == 0 or document.is_empty(alternate_result[0]):
+                return "alternate: {}".format(alternate)
+    return None
+
+
+# State of a spot check process, set by _start_worker()
+_parser = None
+_rule_sets = None
+_selectors = None
+
+
+def _start_worker(parser, rule_sets):
+    global _parser, _rule_sets, _selectors
+    _parser = parser
+    _rule_sets = rule_sets
+    _selectors = compile_selectors(rule_sets) if parser == 'lxml' else None
+
+
+def _check_file(item):
+    rules_index, url, path = item
+    try:
+        with open(path, 'rb') as file:
+            html = file.read()
+    except OSError as e:
+        return url, "unreadable: {}".format(e)
+    if _parser == 'lxml':
+        document = LxmlDocument(html, _selectors)
+    else:
+        document = SoupDocument(BeautifulSoup(html.decode('utf-8', errors='replace'), 'html.parser'))
+    return url, check(document, _rule_sets[rules_index])
+
+
+def check_files(items, rule_sets, workers=settings.VERIFY_WORKERS, parser=None,
+                chunk_size=settings.VERIFY_CHUNK_SIZE):
+    """
+    Spot checks saved pages in a pool of processes, each of which compiles the selectors once.
+    :param items: list of (index of the page's rules in rule_sets, url, path of the saved file)
+    :param rule_sets: list of Rules
+    :param workers: number of processes, None for one per CPU; 1 checks the pages in this process
+    :param parser: one of PARSERS, default_parser() by default
+    :param chunk_size: pages handed to a process at a time
+    :return: {url: why it fails} of the pages that fail
+    """
+    parser = parser or default_parser()
+    check_parser(parser)
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(items) <= chunk_size:
+        _start_worker(parser, rule_sets)
+        results = map(_check_file, items)
+        return {url: reason for url, reason in results if reason is not None}
+    with multiprocessing.Pool(min(workers, -(-len(items) // chunk_size)), _start_worker,
+                              (parser, rule_sets)) as pool:
+        results = pool.imap_unordered(_check_file, items, chunk_size)
+        return {url: reason for url, reason in results if reason is not None}
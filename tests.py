@@ -1,9 +1,54 @@
 import unittest
-from crawler import Crawler
+from cassette import CassettePlayer, CassetteRecorder
+from crawler import Crawler, FetchResult
+from httpcache import ValidatorCache
+from journal import Journal, load_task, journal_path
+import completion
+from scripts.fake_osf import FakeOSF
+import shards
+import workqueue
+from retry import RetryPolicy
+from rewriter import Rewriter, Rule
+from scheduler import PageScheduler, PageStats, page_type
+from throttle import AdaptiveLimiter
+from verifycache import VerificationCache
+from writer import PageWriter, precompress_file
+import digests
+import logs
+import metrics
+import settings
+import spotcheck
+import verifier
+import asyncio
 import datetime
+import glob
+import gzip
+import json
+import os
+import tempfile
+import threading
+import time
 
 d = datetime.datetime.fromtimestamp(0)
 
+# Every Crawler sets the logs up and rolls them over: they go to a scratch folder, not the working directory
+_log_folder = None
+_log_filenames = None
+
+
+def setUpModule():
+    global _log_folder, _log_filenames
+    _log_folder = tempfile.TemporaryDirectory()
+    _log_filenames = settings.DEBUG_LOG_FILENAME, settings.ERROR_LOG_FILENAME
+    settings.DEBUG_LOG_FILENAME = os.path.join(_log_folder.name, 'debug_log.txt')
+    settings.ERROR_LOG_FILENAME = os.path.join(_log_folder.name, 'error_log.txt')
+
+
+def tearDownModule():
+    logs.shutdown()
+    settings.DEBUG_LOG_FILENAME, settings.ERROR_LOG_FILENAME = _log_filenames
+    _log_folder.cleanup()
+
 
 class test_crawler(unittest.TestCase):
 
@@ -94,6 +139,692 @@ class test_crawler(unittest.TestCase):
         # if there isn't one already
 
 
+class test_adaptive_limiter(unittest.TestCase):
+
+    def test_limit_grows_while_healthy(self):
+        limiter = AdaptiveLimiter('test', 5, maximum=20)
+        for _ in range(50):
+            limiter.in_flight = limiter.limit  # Limit fully used
+            limiter.release(200, 0.1)
+        self.assertGreater(limiter.limit, 5)
+        self.assertLessEqual(limiter.limit, 20)
+
+    def test_limit_cut_on_5xx_and_latency(self):
+        limiter = AdaptiveLimiter('test', 16, latency_target=1.0)
+        limiter.in_flight = 1
+        limiter.release(504, 0.1)
+        self.assertEqual(limiter.limit, 8)
+        limiter.in_flight = 1
+        limiter.release(200, 10.0)
+        self.assertEqual(limiter.limit, 4)
+
+    def test_scrape_backs_off_on_504s(self):
+        osf = FakeOSF(error_rate=1.0).start()
+        try:
+            c = Crawler(d)
+            c.http_base = osf.http_base
+            start = c.page_limiter.limit
+            c._scrape_pages([osf.http_base + osf.guid('nodes', i) + '/' for i in range(20)])
+            self.assertLess(c.page_limiter.limit, start)
+            self.assertEqual(c.page_limiter.in_flight, 0)
+            c.close()
+        finally:
+            osf.stop()
+
+    def test_shared_budget_caps_requests(self):
+        limiter = AdaptiveLimiter('test', 8, budget=threading.BoundedSemaphore(2), budget_timeout=0.01)
+        running = []
+
+        async def request():
+            async with limiter.slot() as slot:
+                running.append(1)
+                self.assertLessEqual(len(running), 2)
+                await asyncio.sleep(0.01)
+                running.pop()
+                slot.status = 200
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(asyncio.gather(*[request() for _ in range(10)]))
+        self.assertEqual(limiter.in_flight, 0)
+        # Every unit of the budget was given back
+        self.assertTrue(limiter.budget.acquire(False) and limiter.budget.acquire(False))
+
+
+class test_shards(unittest.TestCase):
+
+    def test_pages_of_a_guid_share_a_shard(self):
+        urls = ['https://osf.io/{}/{}'.format(guid, page) for guid in ['mst3k', 'abcde', 'x1y2z']
+                for page in ['', 'files/', 'wiki/home/']]
+        partitions = shards.partition(urls, 4)
+        self.assertEqual(sorted(sum(partitions, [])), sorted(urls))
+        for partition in partitions:
+            self.assertEqual(len(partition) % 3, 0)
+        self.assertEqual(shards.url_guid('https://osf.io/mst3k/files/'), 'mst3k')
+
+    def test_shard_filenames(self):
+        self.assertEqual(shards.shard_filename('201606231548.changed', 1, 4), '201606231548.shard2of4.changed')
+        self.assertEqual(shards.shard_filename('archive-digests', 0, 2), 'archive-digests.shard1of2')
+
+    def test_shard_stores_are_merged_into_the_shared_ones(self):
+        with tempfile.TemporaryDirectory() as folder:
+            digest_store = os.path.join(folder, 'archive-digests')
+            validator_cache = os.path.join(folder, 'archive-validators')
+            shared = digests.DigestStore(digest_store)
+            shared.set('a/index.html', b'old')
+            shared.close()
+            validators = ValidatorCache(validator_cache)
+            validators.store('https://osf.io/a/', {'ETag': '"1"'}, 'pages')
+            validators.close()
+            # A shard reads the shared stores and writes its own
+            shard = digests.DigestStore(shards.shard_filename(digest_store, 0, 2), base=digest_store)
+            self.assertEqual(shard.get('a/index.html'), b'old')
+            shard.set('b/index.html', b'new')
+            shard.close()
+            validators = ValidatorCache(shards.shard_filename(validator_cache, 1, 2), base=validator_cache)
+            self.assertEqual(validators.conditional_headers('https://osf.io/a/', 'pages'), {'If-None-Match': '"1"'})
+            validators.store('https://osf.io/a/', {}, 'pages')
+            self.assertEqual(validators.conditional_headers('https://osf.io/a/', 'pages'), {})
+            validators.close()
+
+            self.assertEqual(shards.merge_shard_stores([digest_store, validator_cache]), 2)
+            self.assertEqual(glob.glob(os.path.join(folder, '*.shard*')), [])
+            # An unsharded run sees what the shards learnt
+            shared = digests.DigestStore(digest_store)
+            self.assertEqual((shared.get('a/index.html'), shared.get('b/index.html')), (b'old', b'new'))
+            shared.close()
+            validators = ValidatorCache(validator_cache)
+            self.assertEqual(validators.conditional_headers('https://osf.io/a/', 'pages'), {})
+            validators.close()
+
+
+class test_work_queue(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.queue = workqueue.open_queue('sqlite://' + os.path.join(self.dir.name, 'queue.db'))
+
+    def tearDown(self):
+        self.queue.close()
+        self.dir.cleanup()
+
+    def test_expired_lease_is_claimed_again(self):
+        self.queue.put([('https://osf.io/mst3k/', 'project', 'node_urls'), ('https://osf.io/', '', None)])
+        self.queue.mark_loaded()
+        self.assertEqual(len(self.queue.claim('w1', 10, 0.05)), 2)
+        self.assertEqual(self.queue.claim('w2', 10, 60), [])
+        time.sleep(0.1)
+        # w1 died: its urls go to w2
+        self.assertEqual(len(self.queue.claim('w2', 10, 60)), 2)
+        self.queue.complete('w2', 'https://osf.io/mst3k/')
+        self.queue.fail('w2', 'https://osf.io/', 504, 3)
+        # A late report of w1 does not undo the page w2 saved
+        self.queue.fail('w1', 'https://osf.io/mst3k/', None, 1)
+        self.assertTrue(self.queue.is_finished())
+        self.assertEqual(sorted(self.queue.results()),
+                         [('https://osf.io/', None, 'failed', 504, 3),
+                          ('https://osf.io/mst3k/', 'node_urls', 'done', 200, 1)])
+
+    def test_requeue_expired(self):
+        self.queue.put([('https://osf.io/mst3k/', 'project', 'node_urls')])
+        self.queue.claim('w1', 10, 0.05)
+        self.assertFalse(self.queue.is_finished())
+        time.sleep(0.1)
+        self.assertEqual(self.queue.requeue_expired(), 1)
+        self.assertEqual(self.queue.counts(), {'queued': 1})
+
+    def test_new_task_does_not_inherit_done_urls(self):
+        self.queue.put([('https://osf.io/mst3k/', 'project', 'node_urls')])
+        self.queue.mark_loaded()
+        self.queue.claim('w1', 10, 60)
+        self.queue.complete('w1', 'https://osf.io/mst3k/')
+        # The next night's scrape queues the same url again
+        self.queue.clear()
+        self.assertFalse(self.queue.is_loaded())
+        self.queue.put([('https://osf.io/mst3k/', 'project', 'node_urls')])
+        self.assertEqual(self.queue.counts(), {'queued': 1})
+        self.assertEqual(list(self.queue.results()), [])
+
+    def test_worker_calls_the_queue_off_the_loop(self):
+        queue = self.queue
+
+        class SlowQueue:
+            def __getattr__(self, name):
+                return getattr(queue, name)
+
+            def claim(self, worker, count, lease_seconds):
+                time.sleep(0.3)  # Waiting for the lock of another worker
+                return queue.claim(worker, count, lease_seconds)
+
+        queue.put([('https://osf.io/mst3k/', 'project', 'node_urls')])
+        queue.mark_loaded()
+        c = Crawler(d)
+        ticks = []
+
+        async def scrape_url(url, osf_type=''):
+            return True
+
+        async def heartbeat():
+            while len(ticks) < 40:
+                ticks.append(time.monotonic())
+                await asyncio.sleep(0.01)
+
+        async def work():
+            await asyncio.sleep(0.05)  # Once the heartbeat is going
+            await c._work_from_queue(SlowQueue(), 'w1', 10, 60)
+
+        c.scrape_url = scrape_url
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(asyncio.gather(work(), heartbeat()))
+        c.close()
+        self.assertEqual(queue.counts(), {'done': 1})
+        self.assertLess(max(later - earlier for earlier, later in zip(ticks, ticks[1:])), 0.2)
+
+
+class test_page_scheduler(unittest.TestCase):
+
+    def test_page_types(self):
+        self.assertEqual(page_type('https://osf.io/mst3k/', 'project'), 'project/dashboard')
+        self.assertEqual(page_type('https://osf.io/mst3k/wiki/home/', 'registration'), 'registration/wiki')
+        self.assertEqual(page_type('https://osf.io/profile/mst3k/', 'profile'), 'profile')
+        self.assertEqual(page_type('https://osf.io/support/'), 'general')
+
+    def test_cheap_pages_are_not_stuck_behind_slow_ones(self):
+        stats = PageStats()
+        for _ in range(5):
+            stats.record('project/dashboard', 10.0, True, 0.0)
+            stats.record('project/forks', 1.0, True, 0.0)
+        self.assertAlmostEqual(stats.expected_cost('project/dashboard'), 10.0)
+        self.assertAlmostEqual(stats.expected_cost('project/analytics'), 5.5)
+
+        # The queue binds to the current loop; the default one is put back for the tests that follow
+        previous = asyncio.get_event_loop()
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            queue = PageScheduler(stats)
+            for guid in range(20):
+                for page in ['', 'forks/']:
+                    queue.put_nowait(('https://osf.io/{}/{}'.format(guid, page), 'project'))
+            queue.put_nowait((None, None))
+            order = [queue.get_nowait() for _ in range(41)]
+        finally:
+            asyncio.set_event_loop(previous)
+            loop.close()
+        # Every type is served, the cheap one ten times as often, and the stop marker comes last
+        types = [page_type(*item) for item in order[:40]]
+        self.assertEqual(set(types[:2]), {'project/dashboard', 'project/forks'})
+        self.assertEqual(types[:11].count('project/forks'), 10)
+        self.assertEqual(order[-1], (None, None))
+
+
+class test_metrics(unittest.TestCase):
+
+    def test_prometheus_text(self):
+        registry = metrics.Metrics(buckets=[0.5, 1])
+        registry.inc('rosie_responses_total', phase='pages', status=504)
+        registry.inc('rosie_responses_total', phase='pages', status=504)
+        for seconds in [0.2, 0.7, 3]:
+            registry.observe('rosie_request_seconds', seconds, phase='pages', type='project/files')
+        registry.set('rosie_queue_depth', lambda: 12)
+        text = registry.render()
+        self.assertIn('# TYPE rosie_request_seconds histogram', text)
+        self.assertIn('rosie_responses_total{phase="pages",status="504"} 2', text)
+        self.assertIn('rosie_request_seconds_bucket{phase="pages",type="project/files",le="1"} 2', text)
+        self.assertIn('rosie_request_seconds_bucket{phase="pages",type="project/files",le="+Inf"} 3', text)
+        self.assertIn('rosie_queue_depth 12', text)
+        snapshot = json.loads(json.dumps(registry.snapshot()))
+        self.assertEqual(snapshot['metrics']['rosie_request_seconds'][0]['count'], 3)
+        self.assertEqual(registry.total('rosie_responses_total'), 2)
+
+
+class test_logs(unittest.TestCase):
+
+    def test_records_are_written_by_the_background_thread(self):
+        with tempfile.TemporaryDirectory() as folder:
+            debug_log, error_log = os.path.join(folder, 'debug.txt'), os.path.join(folder, 'error.txt')
+            logger = logs.setup(level='DEBUG', debug_filename=debug_log, error_filename=error_log)
+            logger.debug("Finished : %s", 'https://osf.io/mst3k/')
+            try:
+                raise ValueError('bad page')
+            except ValueError:
+                logger.exception("Failed to scrape : %s", 'https://osf.io/abcde/')
+            logs.shutdown()
+            with open(debug_log) as file:
+                debug = file.read()
+            with open(error_log) as file:
+                error = file.read()
+        self.assertIn('Finished : https://osf.io/mst3k/', debug)
+        self.assertIn('Failed to scrape : https://osf.io/abcde/', error)
+        self.assertIn('ValueError: bad page', error)
+        self.assertNotIn('mst3k', error)
+
+
+class test_cassette(unittest.TestCase):
+
+    def record(self, filename, close=True):
+        recorder = CassetteRecorder(filename)
+        recorder.record('https://osf.io/mst3k/', 504, {'Retry-After': '1'}, b'', 30.0)
+        recorder.record('https://osf.io/mst3k/', 200, {'ETag': '"v1"'}, b'<html>mst3k</html>' * 100, 0.5)
+        recorder.record('https://osf.io/abcde/', None, seconds=10.0, error='TimeoutError')
+        if close:
+            recorder.close()
+
+    def test_responses_are_played_back_in_order(self):
+        with tempfile.TemporaryDirectory() as folder:
+            filename = os.path.join(folder, 'run.cassette')
+            self.record(filename)
+            player = CassettePlayer(filename, latency_scale=0.5)
+            first, second, third = [player.play('https://osf.io/mst3k/') for _ in range(3)]
+            error = player.play('https://osf.io/abcde/')
+            missing = player.play('https://osf.io/zzzzz/')
+            player.close()
+        self.assertEqual((first.status, first.headers.get('retry-after'), first.seconds), (504, '1', 15.0))
+        self.assertEqual((second.status, second.headers['etag']), (200, '"v1"'))
+        self.assertEqual(second.body, b'<html>mst3k</html>' * 100)
+        self.assertEqual(third, second)
+        self.assertEqual((error.status, error.error), (None, 'TimeoutError'))
+        self.assertEqual(missing.status, 404)
+        self.assertEqual(player.stats['missed'], 1)
+
+    def test_unclosed_cassette_is_scanned(self):
+        with tempfile.TemporaryDirectory() as folder:
+            filename = os.path.join(folder, 'run.cassette')
+            self.record(filename, close=False)
+            with open(filename, 'ab') as file:
+                file.write(b'{"url": "https://osf.io/cut/", "size": 1000')
+            player = CassettePlayer(filename)
+            self.assertEqual(len(player), 3)
+            self.assertEqual(player.play('https://osf.io/mst3k/').status, 504)
+            player.close()
+
+
+class test_verifier(unittest.TestCase):
+
+    # The elements every project page type is spot checked for
+    COMPLETE_PAGE = (
+        '<html><body><h2 id="nodeTitleEditable">Title</h2>'
+        '<div id="contributors"><span class="date node-last-modified-date">2016-06-23</span></div>'
+        '<div id="contributorsList"><ol><li>Contributor</li></ol></div><div id="tb-tbody">File</div>'
+        '<div id="logScope"><div><div><div class="panel-body"><span><dl>Log</dl></span></div></div></div></div>'
+        '<div class="fg-file-links">Links</div><div id="wikiViewRender">Wiki</div>'
+        '<select id="viewVersionSelect"><option>Current</option></select>{}</body></html>')
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.folder = tempfile.TemporaryDirectory()
+        os.chdir(self.folder.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.folder.cleanup()
+
+    def save(self, url, size, html=COMPLETE_PAGE):
+        path = 'archive/' + url.replace(settings.base_urls[0], '') + 'index.html'
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as file:
+            file.write(html.format('x' * size))
+
+    def test_urls_are_classified_in_one_pass(self):
+        base = settings.base_urls[0]
+        urls = [base + 'mst3k/', base + 'mst3k/files/', base + 'mst3k/wiki/files/', base + 'mst3k/analytics/',
+                base + 'abcde/', base + 'abcde/files/', base + 'fghij/files/']
+        for url in urls[:4]:
+            self.save(url, 500 * 1000)
+        self.save(base + 'abcde/', 100)
+        self.save(base + 'fghij/files/', 500 * 1000, html='<html><body>{}</body></html>')
+        task = {'include_dashboard': True, 'include_files': True, 'include_wiki': True, 'include_analytics': False,
+                'include_registrations': False, 'include_forks': False, 'error_list': [base + 'abcde/files/'],
+                'node_urls': list(urls)}
+        failed = verifier.verify_nodes(task, 'node_urls', workers=1)
+        # A wiki page named "files" is a wiki page. The page that errored, the files page without file links and
+        # the small dashboard failed
+        self.assertEqual(failed, [base + 'abcde/files/', base + 'fghij/files/', base + 'abcde/'])
+        # The analytics page has no verifier and stays in the list
+        self.assertEqual(task['node_urls'], [base + 'mst3k/analytics/'])
+
+    def test_unchanged_pages_are_not_checked_again(self):
+        base = settings.base_urls[0]
+        urls = [base + 'mst3k/files/', base + 'abcde/files/']
+        self.save(urls[0], 500 * 1000)
+        self.save(urls[1], 500 * 1000, html='<html><body>{}</body></html>')
+        task = {'include_dashboard': False, 'include_files': True, 'include_wiki': False, 'include_analytics': False,
+                'include_registrations': False, 'include_forks': False, 'error_list': []}
+        cache = VerificationCache('verified')
+        self.assertEqual(verifier.verify_nodes(dict(task, node_urls=list(urls)), 'node_urls', 1, cache), urls[1:])
+        self.assertEqual(verifier.verify_nodes(dict(task, node_urls=list(urls)), 'node_urls', 1, cache), urls[1:])
+        self.assertEqual((cache.stats['hits'], cache.stats['misses']), (2, 2))
+        # Rescraped, complete this time
+        self.save(urls[1], 500 * 1000)
+        self.assertEqual(verifier.verify_nodes(dict(task, node_urls=list(urls)), 'node_urls', 1, cache), [])
+        self.assertEqual((cache.stats['hits'], cache.stats['misses']), (3, 3))
+        cache.close()
+
+    @unittest.skipIf(spotcheck.lxml is None, "needs lxml and cssselect")
+    def test_lxml_spot_checks_match_beautifulsoup(self):
+        rules = verifier.ProjectDashboardVerifier().rules()
+        pages = [self.COMPLETE_PAGE.format(''),
+                 self.COMPLETE_PAGE.format('<div id="containment"></div>'),
+                 self.COMPLETE_PAGE.format('<div id="containment"><div id="render-node"></div></div>'),
+                 self.COMPLETE_PAGE.replace('<dl>Log</dl>', '<dl></dl>').format('<div id="logFeed"><div>'
+                                                                                '<p>Unable</p></div></div>'),
+                 self.COMPLETE_PAGE.replace('Title', '').format('')]
+        items = []
+        for number, html in enumerate(pages):
+            with open('{}.html'.format(number), 'w') as file:
+                file.write(html)
+            items.append((0, str(number), '{}.html'.format(number)))
+        soup = spotcheck.check_files(items, [rules], workers=1, parser='html.parser')
+        self.assertEqual(sorted(soup), ['1', '4'])
+        self.assertEqual(spotcheck.check_files(items, [rules], workers=1, parser='lxml'), soup)
+        self.assertEqual(spotcheck.check_files(items, [rules], workers=2, parser='lxml', chunk_size=1), soup)
+
+    def test_pages_are_validated_before_they_are_saved(self):
+        validator = verifier.PageValidator(parser='html.parser')
+        complete = self.COMPLETE_PAGE.format('x' * 500 * 1000).encode('utf-8')
+        self.assertIsNone(validator.validate('project/files', complete))
+        timed_out = complete.replace(b'<body>', b'<meta name="prerender-status-code" content="504"><body>')
+        self.assertEqual(validator.validate('project/files', timed_out), 'prerender 504')
+        self.assertEqual(validator.validate('project/files', self.COMPLETE_PAGE.format('').encode('utf-8')), 'size')
+        self.assertEqual(validator.validate('project/files', complete.replace(b'Links', b'')), '.fg-file-links No alt.')
+        self.assertEqual(validator.validate('project/wiki', self.COMPLETE_PAGE.format('').encode('utf-8')), 'size')
+        self.assertIsNone(validator.validate('file', b'<html></html>'))
+        self.assertEqual(validator.summary(), [('project/files', '.fg-file-links No alt.', 1),
+                                               ('project/files', 'prerender 504', 1), ('project/files', 'size', 1),
+                                               ('project/wiki', 'size', 1)])
+
+
+class test_retry_policy(unittest.TestCase):
+
+    def test_retryable_statuses(self):
+        policy = RetryPolicy(max_attempts=3, retry_statuses=[429, '5xx'])
+        self.assertTrue(policy.should_retry(1, 504))
+        self.assertTrue(policy.should_retry(2, 429))
+        self.assertTrue(policy.should_retry(1, None))
+        self.assertFalse(policy.should_retry(1, 404))
+        self.assertFalse(policy.should_retry(3, 504))
+
+    def test_backoff_is_jittered_and_capped(self):
+        policy = RetryPolicy(base_delay=1.0, max_delay=5.0)
+        for attempt in range(1, 10):
+            delay = policy.delay(attempt)
+            self.assertGreaterEqual(delay, 0)
+            self.assertLessEqual(delay, min(5.0, 2 ** (attempt - 1)))
+
+    def test_retry_after(self):
+        policy = RetryPolicy(max_delay=30.0)
+        self.assertEqual(policy.delay(1, {'Retry-After': '7'}), 7.0)
+        self.assertEqual(policy.delay(1, {'Retry-After': '120'}), 30.0)
+        self.assertEqual(policy.delay(1, {'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}), 0.0)
+
+    def test_retried_pages_do_not_hold_the_writer(self):
+        root = tempfile.mkdtemp()
+        c = Crawler(d)
+        c.writer = PageWriter(root=root, max_pending=1)
+        c.validators = ValidatorCache(os.path.join(root, 'validators'))
+        backing_off = asyncio.Event()
+
+        async def fetch_page(url, conditional=None, kind=''):
+            if url.endswith('/slow/'):
+                backing_off.set()
+                await asyncio.sleep(0.5)  # Waiting between two attempts
+                return None, 504, 3, 0.0
+            await backing_off.wait()
+            return FetchResult(200, {}, b'<html>page</html>'), 200, 1, 0.0
+
+        c._fetch_page = fetch_page
+        loop = asyncio.get_event_loop()
+        # The only place in the writer is free for the page that is ready to be saved
+        saved, fast = loop.run_until_complete(asyncio.gather(
+            c.scrape_url('https://osf.io/slow/', 'project'),
+            asyncio.wait_for(c.scrape_url('https://osf.io/fast/', 'project'), 0.3)))
+        c.close()
+        self.assertEqual((saved, fast), (False, True))
+        self.assertTrue(os.path.exists(os.path.join(root, 'project', 'fast', 'index.html')))
+
+    def test_api_pages_are_retried_and_failures_recorded(self):
+        c = Crawler(d, retry_policy=RetryPolicy(max_attempts=3, base_delay=0.0))
+        first, second = c.api_base + 'nodes/', c.api_base + 'nodes/?page=2'
+        answers = {first: [asyncio.TimeoutError(), 503, 200], second: [500, 502, 504]}
+        requests = []
+
+        async def fetch(url, headers=None, limiter=None, phase=None, kind=''):
+            requests.append(url)
+            answer = answers[url].pop(0)
+            if isinstance(answer, Exception):
+                raise answer
+            body = {'data': [{'id': 'mst3k'}], 'links': {'next': second, 'meta': {'total': 2}}}
+            return FetchResult(answer, {}, json.dumps(body).encode('utf-8'))
+
+        c._fetch = fetch
+        loop = asyncio.get_event_loop()
+        ids = loop.run_until_complete(c.list_api_ids('nodes/'))
+        c.close()
+        self.assertEqual(ids, ['mst3k'])
+        self.assertEqual(requests, [first] * 3 + [second] * 3)
+        # The records of the second page are missing, and that is known
+        self.assertEqual(c.api_failures, [second])
+
+
+class test_journal(unittest.TestCase):
+
+    def test_replay_onto_task_file(self):
+        directory = tempfile.mkdtemp()
+        tf = os.path.join(directory, '201601010000.json')
+        with open(tf, 'w') as db:
+            json.dump({'node_urls': ['a'], 'error_list': ['b'], 'attempts': None, 'milestone': None}, db)
+        j = Journal(journal_path(tf), sync_every=2)
+        j.record_found('node_urls', ['b', 'c'])
+        j.record('c', 504, 4)
+        j.record('b', 200, 2)
+        j.record('a', 200)
+        j.close()
+        with open(journal_path(tf), 'a') as file:
+            file.write('{"url": "cut sh')  # Crash in the middle of a line
+        store = load_task(tf)
+        self.assertEqual(store['node_urls'], ['a', 'b', 'c'])
+        self.assertEqual(store['error_list'], ['c'])
+        self.assertEqual(store['milestone'], 'a')
+        self.assertEqual(store['attempts'], {'c': {'attempts': 4, 'status': 504},
+                                             'b': {'attempts': 2, 'status': 200}})
+        self.assertEqual(completion.completed_urls(store), {'a', 'b'})
+
+    def test_compaction_empties_journal(self):
+        directory = tempfile.mkdtemp()
+        tf = os.path.join(directory, '201601010000.json')
+        with open(tf, 'w') as db:
+            c = Crawler(d, db=db, dictionary={'error_list': None, 'milestone': None})
+            c.record_milestone('a')
+            c.record_failure('b', None, 4)
+            c.compact_journal()
+            self.assertEqual(os.path.getsize(journal_path(tf)), 0)
+            c.close()
+        store = load_task(tf)
+        self.assertEqual(store['milestone'], 'a')
+        self.assertEqual(store['error_list'], ['b'])
+
+
+class test_completion(unittest.TestCase):
+
+    def test_bitmap_round_trip(self):
+        urls = ['u' + str(i) for i in range(21)]
+        done = set(urls[::3])
+        self.assertEqual(completion.decode(urls, completion.encode(urls, done)), done)
+
+    def test_outstanding_after_lists_grow(self):
+        store = {'node_urls': ['a', 'b', 'c']}
+        store['completed'] = completion.encode_store(store, {'a', 'c'})
+        store['node_urls'] += ['d']  # Found after the bitmap was made
+        done = completion.completed_urls(store)
+        self.assertEqual(completion.outstanding(store['node_urls'], done), ['b', 'd'])
+
+
+class test_page_writer(unittest.TestCase):
+
+    def test_writes_pages_atomically(self):
+        root = tempfile.mkdtemp()
+        writer = PageWriter(root=root, threads=2, max_pending=2)
+
+        async def save(i):
+            async with writer.room():
+                await writer.write('project/n{}/files/index.html'.format(i % 3), 'page ' + str(i))
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(asyncio.gather(*[save(i) for i in range(9)]))
+        writer.close()
+        self.assertEqual(writer.pages_written, 9)
+        for i in range(3):
+            folder = os.path.join(root, 'project', 'n' + str(i), 'files')
+            self.assertEqual(os.listdir(folder), ['index.html'])  # No temporary file left behind
+            with open(os.path.join(folder, 'index.html')) as file:
+                self.assertTrue(file.read().startswith('page '))
+
+    def test_pages_get_the_permissions_open_gives(self):
+        root = tempfile.mkdtemp()
+        with open(os.path.join(root, 'plain'), 'w'):
+            pass
+        writer = PageWriter(root=root, compress=['gzip'])
+        asyncio.get_event_loop().run_until_complete(writer.write('a/index.html', 'page'))
+        writer.close()
+        mode = os.stat(os.path.join(root, 'plain')).st_mode
+        self.assertEqual(os.stat(os.path.join(root, 'a', 'index.html')).st_mode, mode)
+        self.assertEqual(os.stat(os.path.join(root, 'a', 'index.html.gz')).st_mode, mode)
+
+    def test_unchanged_pages_are_not_rewritten(self):
+        root = tempfile.mkdtemp()
+        changes_file = os.path.join(root, 'task.changed')
+        writer = PageWriter(root=root, digest_store=digests.DigestStore(os.path.join(root, 'digests')),
+                            changes_file=changes_file)
+        loop = asyncio.get_event_loop()
+        outcomes = [loop.run_until_complete(writer.write('a/index.html', text, suffix=banner))
+                    for text, banner in [('page', ' monday'), ('page', ' tuesday'), ('edited', ' tuesday')]]
+        writer.close()
+        self.assertEqual(outcomes, [digests.NEW, digests.UNCHANGED, digests.CHANGED])
+        self.assertEqual(writer.changes, {'new': 1, 'unchanged': 1, 'changed': 1})
+        with open(os.path.join(root, 'a', 'index.html')) as file:
+            self.assertEqual(file.read(), 'edited tuesday')
+        with open(changes_file) as file:
+            self.assertEqual(file.read().split(), ['a/index.html', 'a/index.html'])
+
+    def test_digests_of_another_store_are_not_trusted(self):
+        root = tempfile.mkdtemp()
+        loop = asyncio.get_event_loop()
+        # A shard of a run with another number of workers saved 'page' with its own store
+        shard = PageWriter(root=root, digest_store=digests.DigestStore(os.path.join(root, 'digests.shard1of2')))
+        loop.run_until_complete(shard.write('a/index.html', 'page'))
+        shard.close()
+        writer = PageWriter(root=root, digest_store=digests.DigestStore(os.path.join(root, 'digests')))
+        self.assertEqual(loop.run_until_complete(writer.write('a/index.html', 'page')), digests.CHANGED)
+        # Since then, an unsharded run saved 'edited': the shard store's digest of 'page' is out of date
+        loop.run_until_complete(writer.write('a/index.html', 'edited'))
+        writer.close()
+        shard = PageWriter(root=root, digest_store=digests.DigestStore(os.path.join(root, 'digests.shard1of2')))
+        self.assertEqual(loop.run_until_complete(shard.write('a/index.html', 'page')), digests.CHANGED)
+        self.assertEqual(loop.run_until_complete(shard.write('a/index.html', 'page')), digests.UNCHANGED)
+        shard.close()
+        with open(os.path.join(root, 'a', 'index.html')) as file:
+            self.assertEqual(file.read(), 'page')
+
+    def test_gzip_siblings(self):
+        root = tempfile.mkdtemp()
+        writer = PageWriter(root=root, compress=['gzip'])
+        asyncio.get_event_loop().run_until_complete(writer.write('a/index.html', 'page'))
+        writer.close()
+        with gzip.open(os.path.join(root, 'a', 'index.html.gz')) as file:
+            self.assertEqual(file.read(), b'page')
+        # Fresh siblings are not redone, stale ones are
+        path = os.path.join(root, 'a', 'index.html')
+        self.assertEqual(precompress_file(path, ['gzip']), 0)
+        os.utime(path, (time.time() + 10, time.time() + 10))
+        self.assertEqual(precompress_file(path, ['gzip']), 1)
+
+    def test_siblings_follow_the_page(self):
+        root = tempfile.mkdtemp()
+        store = os.path.join(root, 'digests')
+        loop = asyncio.get_event_loop()
+        sibling = os.path.join(root, 'a', 'index.html.gz')
+        writer = PageWriter(root=root, digest_store=digests.DigestStore(store))
+        loop.run_until_complete(writer.write('a/index.html', 'page'))
+        writer.close()
+        # --compress turned on over an unchanged mirror
+        writer = PageWriter(root=root, compress=['gzip'], digest_store=digests.DigestStore(store))
+        self.assertEqual(loop.run_until_complete(writer.write('a/index.html', 'page')), digests.CHANGED)
+        self.assertEqual(loop.run_until_complete(writer.write('a/index.html', 'page')), digests.UNCHANGED)
+        writer.close()
+        self.assertTrue(os.path.exists(sibling))
+        # Rewritten without --compress: the old sibling goes
+        writer = PageWriter(root=root, digest_store=digests.DigestStore(store))
+        loop.run_until_complete(writer.write('a/index.html', 'edited'))
+        writer.close()
+        self.assertFalse(os.path.exists(sibling))
+
+
+class test_rewriter(unittest.TestCase):
+
+    def test_literal_and_regex_rules(self):
+        rewriter = Rewriter([Rule('ab', 'X'), Rule(r'a(\d+)', r'N\1', regex=True), Rule('a', 'Y')])
+        self.assertEqual(rewriter.rewrite('ab a12 a abab', suffix='!'), 'X N12 Y XX!')
+
+    def test_replaced_text_is_not_rewritten_again(self):
+        rewriter = Rewriter([Rule('block', 'none'), Rule('none', 'block')])
+        self.assertEqual(rewriter.rewrite('display: block; display: none'), 'display: none; display: block')
+
+
+class test_conditional_requests(unittest.TestCase):
+
+    def test_second_run_gets_304s(self):
+        osf = FakeOSF(etags=True).start()
+        root = tempfile.mkdtemp()
+        try:
+            for run in range(2):
+                c = Crawler(d)
+                c.http_base, c.api_base = osf.http_base, osf.api_base
+                c.writer = PageWriter(root=root)
+                c.validators = ValidatorCache(os.path.join(root, 'validators'))
+                asyncio.get_event_loop().run_until_complete(c.get_node_wiki_names('n0001'))
+                c._scrape_pages([osf.http_base + osf.guid('nodes', i) + '/' for i in range(5)], osf_type='project')
+                c.close()
+                self.assertEqual(c._node_wikis_by_parent_guid['n0001'], ['home'])
+            self.assertEqual(osf.not_modified_served, 6)
+            self.assertEqual(c.validators.hit_rate('pages'), (1.0, 1.0))
+            self.assertEqual(c.writer.changes['unchanged'], 5)
+        finally:
+            osf.stop()
+
+    def test_validators_are_read_off_the_loop(self):
+        root = tempfile.mkdtemp()
+
+        class SlowValidatorCache(ValidatorCache):
+            def conditional_headers(self, url, kind):
+                time.sleep(0.3)  # A dbm file on a busy disk
+                return super().conditional_headers(url, kind)
+
+        c = Crawler(d)
+        c.writer = PageWriter(root=root)
+        c.validators = SlowValidatorCache(os.path.join(root, 'validators'))
+        os.makedirs(os.path.join(root, 'project', 'slow'))
+        open(os.path.join(root, 'project', 'slow', 'index.html'), 'w').close()
+        ticks = []
+
+        async def fetch_page(url, conditional=None, kind=''):
+            return FetchResult(200, {'ETag': '"1"'}, b'<html>page</html>'), 200, 1, 0.0
+
+        async def heartbeat():
+            while len(ticks) < 40:
+                ticks.append(time.monotonic())
+                await asyncio.sleep(0.01)
+
+        async def scrape():
+            await asyncio.sleep(0.05)  # Once the heartbeat is going
+            return await c.scrape_url('https://osf.io/slow/', 'project')
+
+        c._fetch_page = fetch_page
+        loop = asyncio.get_event_loop()
+        saved, _ = loop.run_until_complete(asyncio.gather(scrape(), heartbeat()))
+        c.close()
+        self.assertTrue(saved)
+        self.assertLess(max(later - earlier for earlier, later in zip(ticks, ticks[1:])), 0.2)
+
+
 def is_valid_url(url):
     if len(url) > 0:
         return True
@@ -0,0 +1,184 @@
+"""Adaptive (AIMD) concurrency limits for the crawler's requests"""
+
+import asyncio
+import collections
+import concurrent.futures
+import time
+
+
+class AdaptiveLimiter:
+    """
+    A concurrency limit that follows how well the server copes, used by the Crawler in place of a fixed
+    asyncio.BoundedSemaphore.
+        Additive increase: while responses are healthy, every `limit` completed requests raise the limit by one,
+        as long as the current limit is actually in use.
+        Multiplicative decrease: a 5xx or 429 response, a request that raised, or a smoothed latency above
+        latency_target multiplies the limit by decrease_factor. Requests that were started before the last cut
+        cannot cut it again, so one burst of 504s counts once.
+    Every change of the limit is written to the debug log with the concurrency at that moment and its reason.
+    A budget shared with other processes (a multiprocessing semaphore, see shards.py) can cap the requests of all
+    of them together: each unit of the limit then also takes a unit of the budget, waited for in a thread so that
+    the loop is not blocked.
+    Usage:
+        async with limiter.slot() as slot:
+            response = await fetch(url)
+            slot.status = response.status
+    """
+
+    def __init__(self, name, initial, minimum=1, maximum=50, latency_target=None, decrease_factor=0.5,
+                 logger=None, budget=None, budget_timeout=1.0):
+        """
+        :param name: name used in the log, e.g. 'pages'
+        :param initial: starting limit
+        :param minimum: the limit never drops below this
+        :param maximum: the limit never grows above this
+        :param latency_target: smoothed latency in seconds above which the limit is cut, None to ignore latency
+        :param decrease_factor: factor applied to the limit on a cut
+        :param logger: logger the changes of the limit are written to (debug level)
+        :param budget: semaphore shared with other processes, acquire(blocking, timeout) / release(), or None
+        :param budget_timeout: seconds a thread waits for an exhausted budget before it gives the wait up and starts
+                               another, so that no thread is left blocked for long once the loop is gone
+        """
+        self.name = name
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = min(max(initial, self.minimum), self.maximum)
+        self.latency_target = latency_target
+        self.decrease_factor = decrease_factor
+        self.logger = logger
+        self.budget = budget
+        self.budget_timeout = budget_timeout
+        self._budget_threads = None
+
+        self.in_flight = 0
+        self.latency = None  # Exponentially weighted moving average of the latency, in seconds
+        self.completed = 0
+        self.failed = 0
+
+        self._credit = 0.0
+        self._last_decrease = 0.0
+        self._waiters = collections.deque()
+
+    def slot(self):
+        """
+        Returns an asynchronous context manager holding one unit of concurrency for one request.
+        Set its status attribute to the HTTP status of the response before leaving it.
+        """
+        return _Slot(self)
+
+    async def acquire(self):
+        await self._acquire_local()
+        if self.budget is None:
+            return
+        if self.budget.acquire(False):
+            return
+        if self._budget_threads is None:
+            # One thread per unit that may be waiting
+            self._budget_threads = concurrent.futures.ThreadPoolExecutor(max_workers=self.maximum)
+        loop = asyncio.get_event_loop()
+        try:
+            while True:
+                wait = loop.run_in_executor(self._budget_threads, self.budget.acquire, True, self.budget_timeout)
+                try:
+                    if await asyncio.shield(wait):
+                        return
+                except asyncio.CancelledError:
+                    # The thread may still get the unit: give it back then
+                    wait.add_done_callback(lambda wait: self.budget.release()
+                                           if not wait.cancelled() and wait.result() else None)
+                    raise
+        except asyncio.CancelledError:
+            self.in_flight -= 1
+            self._wake()
+            raise
+
+    async def _acquire_local(self):
+        if self.in_flight < self.limit and not self._waiters:
+            self.in_flight += 1
+            return
+        waiter = asyncio.Future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The unit was handed over just as the wait was cancelled: give it back
+                self.in_flight -= 1
+                self._wake()
+            raise
+
+    def release(self, status=None, latency=None, started=None, record=True):
+        """
+        Gives back one unit of concurrency and adapts the limit to the outcome of the request.
+        :param status: HTTP status of the response, None if the request raised
+        :param latency: seconds the request took
+        :param started: time.monotonic() when the request started
+        :param record: False to release without judging the outcome (e.g. the request was cancelled)
+        """
+        self.in_flight -= 1
+        if self.budget is not None:
+            self.budget.release()
+        if record:
+            self._record(status, latency, started)
+        self._wake()
+
+    def _wake(self):
+        while self._waiters and self.in_flight < self.limit:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    def _record(self, status, latency, started):
+        self.completed += 1
+        if latency is not None:
+            self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+
+        if status is None or status >= 500 or status == 429:
+            self.failed += 1
+            if started is None or started >= self._last_decrease:
+                self._decrease(('status ' + str(status)) if status is not None else 'request failed')
+        elif self.latency_target is not None and self.latency is not None and self.latency > self.latency_target:
+            if started is None or started >= self._last_decrease:
+                self._decrease('latency {:.2f}s above target {:.2f}s'.format(self.latency, self.latency_target))
+        else:
+            self._credit += 1.0 / self.limit
+            # Only grow a limit that is in use, or a quiet phase would inflate it without any evidence
+            if self._credit >= 1 and self.limit < self.maximum and self.in_flight + 1 >= self.limit:
+                self._credit = 0.0
+                self._set_limit(self.limit + 1, 'healthy responses')
+
+    def _decrease(self, reason):
+        self._credit = 0.0
+        self._last_decrease = time.monotonic()
+        self._set_limit(max(self.minimum, int(self.limit * self.decrease_factor)), reason)
+
+    def _set_limit(self, limit, reason):
+        if limit == self.limit:
+            return
+        if self.logger is not None:
+            self.logger.debug("%s concurrency limit %d -> %d (in flight %d, latency %s): %s",
+                              self.name, self.limit, limit, self.in_flight,
+                              'n/a' if self.latency is None else '{:.2f}s'.format(self.latency), reason)
+        self.limit = limit
+
+
+class _Slot:
+    """
+    One unit of concurrency of an AdaptiveLimiter, see AdaptiveLimiter.slot()
+    """
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.status = None
+        self.started = None
+
+    async def __aenter__(self):
+        await self.limiter.acquire()
+        self.started = time.monotonic()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        cancelled = exc_type is not None and issubclass(exc_type, asyncio.CancelledError)
+        self.limiter.release(self.status, time.monotonic() - self.started, self.started, record=not cancelled)
+        return False
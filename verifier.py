@@ -1,13 +1,26 @@
+import collections
+import hashlib
 import json
 import codecs
+import journal
+import metrics
+import re
+import settings
+import spotcheck
+import urllib.parse
+from bs4 import BeautifulSoup
 from pages import ProjectDashboardPage, ProjectFilesPage, ProjectAnalyticsPage, \
     ProjectForksPage, ProjectRegistrationsPage, ProjectWikiPage, RegistrationDashboardPage, RegistrationFilesPage, \
     RegistrationAnalyticsPage, RegistrationForksPage, RegistrationWikiPage, UserProfilePage, InstitutionDashboardPage
-from crawler import Crawler
+import crawler
+from verifycache import VerificationCache
 
 
 # Verifier superclass
 class Verifier:
+    # Whether a loader in loading_elements may stay once what it loads is in place, see spotcheck.Rules
+    loader_is_container = False
+
     def __init__(self, min_size, pg_type, end):
         """
         :param min_size: File size minimum for a page. Anything below this couldn't possibly be a complete file.
@@ -28,6 +41,7 @@ class Verifier:
 
         self.pages = []  # All the page objects
         self.failed_pages = []
+        self.failure_reasons = {}  # Why the pages that failed a check failed, by URL
 
     # Populate self.pages with the relevant files
     def harvest_pages(self, json_dictionary, json_list):
@@ -36,81 +50,113 @@ class Verifier:
         :param json_list: The list in the json file of found URLs
         :return: Null, but self.pages is populated.
         """
-        if json_dictionary['error_list'] is not None:
-            for url in json_list[:]:
-                if self.url_end in url:
-                    print('rel: ', url)
-                    if url in json_dictionary['error_list']:
-                        self.failed_pages.append(url)
-                        print('error: ', url)
-                    else:
-                        try:
-                            obj = self.page_type(url)
-                            self.pages.append(obj)
-                        except FileNotFoundError:
-                            self.failed_pages.append(url)
-                    json_list.remove(url)
+        harvest_urls([self], json_dictionary, json_list)
+
+    def harvest_url(self, url, errors):
+        """
+        Makes the page object of one URL of this verifier's page type.
+        :param url: URL of the page
+        :param errors: set of the URLs that failed during the scrape
+        """
+        if url in errors:
+            self.failed_pages.append(url)
+            print('error: ', url)
+        else:
+            try:
+                obj = self.page_type(url)
+                self.pages.append(obj)
+            except FileNotFoundError:
+                self.failed_pages.append(url)
 
     # Compare page size to page-specific minimum that any fully-scraped page should have
     def size_comparison(self):
-        for page in self.pages[:]:
-            # print(page)
-            # print(page.file_size)
+        complete_pages = []
+        for page in self.pages:
             if not page.file_size > self.minimum_size:
                 print('Failed: size_comparison(): ', page, ' has size: ', page.file_size)
                 self.failed_pages.append(page.url)
-                self.pages.remove(page)
+                self.failure_reasons[page.url] = 'size: {}'.format(page.file_size)
+            else:
+                complete_pages.append(page)
+        self.pages = complete_pages
         return
 
     # Check that specified elements are supposed to exist and a loading bar isn't present instead
     # Check that specified elements or their alternates are present and non-empty in each page
     # Alternate: different elements appear if there isn't supposed to be content, so it has to check both
     # Format: Filled-in : Alternate
+    # One page at a time with BeautifulSoup, the reference for spot_check_pages()
     def spot_check(self):
-        for page in self.pages[:]:
-            soup = page.get_content()
-            # Existential crisis:
-            for element in self.loading_elements:
-                final_element = self.loading_elements[element]  # What is supposed to be there
-                loading_bar_result = soup.select(element)  # Is a loading bar present?
-                if len(loading_bar_result) > 0:  # A loading bar exists (so content does not exist completely)
-                    print("Failed: existential spot_check() ", page, final_element, " doesn't exist, loader ", element, " present.")
-                    self.failed_pages.append(page.url)
-                    self.pages.remove(page)
-                    break
+        passed_pages = []
+        for page in self.pages:
+            reason = spotcheck.check(spotcheck.SoupDocument(page.get_content()), self.rules())
+            if reason is None:
+                passed_pages.append(page)
             else:
-                # Alternate checker:
-                for element in self.alternate_elements:
-                    alt = self.alternate_elements[element]
-                    result = soup.select(element)
-                    # No results or empty results, with alternate
-                    if (len(result) == 0 or len(result[0].contents) == 0) and alt != '':
-                        alt_result = soup.select(alt)
-
-                        # Element's alternate has no or empty results
-                        if len(alt_result) == 0 or len(alt_result[0].contents) == 0:
-                            print("Failed: alternate spot_check(): ", page, alt, '\n')
-                            self.failed_pages.append(page.url)
-                            self.pages.remove(page)
-                            break
-
-                    # Element has no alternate and no results or empty results
-                    elif (len(result) == 0 or len(result[0].contents) == 0) and alt == '':
-                        print('Failed: spot_check(): ', page, element, "No alt.", '\n')
-                        self.failed_pages.append(page.url)
-                        self.pages.remove(page)
-                        break
+                print('Failed: spot_check(): ', page, reason)
+                self.failed_pages.append(page.url)
+                self.failure_reasons[page.url] = reason
+        self.pages = passed_pages
         return
 
-    def run_verifier(self, json_filename, json_list):
+    def rules(self):
+        """
+        :return: the spotcheck.Rules of the page type
+        """
+        return spotcheck.Rules(tuple(self.loading_elements.items()), tuple(self.alternate_elements.items()),
+                               self.loader_is_container)
+
+    def fingerprint(self):
+        """
+        :return: a digest of the minimum size and the rules, which a cached verdict must have been reached with
+        """
+        rules = self.rules()
+        checks = [self.minimum_size, sorted(rules.loading_elements), sorted(rules.alternate_elements),
+                  rules.loader_is_container]
+        return hashlib.sha1(json.dumps(checks).encode('utf-8')).hexdigest()
+
+    def take_cached(self, cache):
+        """
+        Takes the pages whose verdict is cached out of self.pages: those that failed go to self.failed_pages.
+        :param cache: VerificationCache
+        :return: the pages that passed
+        """
+        fingerprint = self.fingerprint()
+        unchecked_pages = []
+        passed_pages = []
+        for page in self.pages:
+            entry = cache.get(page.path, page.identity, fingerprint)
+            if entry is None:
+                unchecked_pages.append(page)
+            elif entry['reason'] is None:
+                passed_pages.append(page)
+            else:
+                print('Failed (cached): ', page, entry['reason'])
+                self.failed_pages.append(page.url)
+                self.failure_reasons[page.url] = entry['reason']
+        self.pages = unchecked_pages
+        return passed_pages
+
+    def store_verdicts(self, cache, checked_pages):
+        """
+        Caches the verdicts of pages that were just checked.
+        :param checked_pages: the pages, passed and failed
+        """
+        fingerprint = self.fingerprint()
+        for page in checked_pages:
+            cache.store(page.path, page.identity, fingerprint, self.failure_reasons.get(page.url))
+
+    def run_verifier(self, json_filename, json_list, workers=settings.VERIFY_WORKERS):
         self.harvest_pages(json_filename, json_list)
-        self.size_comparison()
-        # self.spot_check()
+        check_pages([self], workers)
 
 
 # Verifier subclasses
 
 class ProjectDashboardVerifier(Verifier):
+    # The loader for loading_elements is still supposed to exist
+    loader_is_container = True
+
     def __init__(self):
         super().__init__(410, ProjectDashboardPage, '')
         self.loading_elements = {
@@ -126,50 +172,6 @@ class ProjectDashboardVerifier(Verifier):
             # Activity / "Unable to retrieve at this time"
         }
 
-    # Override: the loader for loading_elements is still supposed to exist
-    # Check that specified elements are supposed to exist and a loading bar isn't present instead
-    # Check that specified elements or their alternates are present and non-empty in each page
-    # Alternate: different elements appear if there isn't supposed to be content, so it has to check both
-    # Format: Filled-in : Alternate
-    def spot_check(self):
-        for page in self.pages[:]:
-            soup = page.get_content()
-            # Existential crisis:
-            for element in self.loading_elements:
-                final_element = self.loading_elements[element]  # What is supposed to be there
-                loading_bar_result = soup.select(element)
-                if len(loading_bar_result) > 0:  # Container div is present
-                    final_result = soup.select(final_element)
-                    if len(final_result) == 0:  # Final element isn't in place
-                        print("Failed: existential spot_check() ", page, final_element, " doesn't exist, loader ", element,
-                              " present.")
-                        self.failed_pages.append(page.url)
-                        self.pages.remove(page)
-                        break
-            else:
-                # Alternate checker:
-                for element in self.alternate_elements:
-                    alt = self.alternate_elements[element]
-                    result = soup.select(element)
-                    # No results or empty results, with alternate
-                    if (len(result) == 0 or len(result[0].contents) == 0) and alt != '':
-                        alt_result = soup.select(alt)
-
-                        # Element's alternate has no or empty results
-                        if len(alt_result) == 0 or len(alt_result[0].contents) == 0:
-                            print("Failed: alternate spot_check(): ", page, alt, '\n')
-                            self.failed_pages.append(page.url)
-                            self.pages.remove(page)
-                            break
-
-                    # Element has no alternate and no results or empty results
-                    elif (len(result) == 0 or len(result[0].contents) == 0) and alt == '':
-                        print('Failed: spot_check(): ', page, element, "No alt.", '\n')
-                        self.failed_pages.append(page.url)
-                        self.pages.remove(page)
-                        break
-        return
-
 
 class ProjectFilesVerifier(Verifier):
     def __init__(self):
@@ -217,6 +219,9 @@ class ProjectForksVerifier(Verifier):
 
 
 class RegistrationDashboardVerifier(Verifier):
+    # The loader for loading_elements is still supposed to exist
+    loader_is_container = True
+
     def __init__(self):
         super().__init__(410, RegistrationDashboardPage, "")
         self.loading_elements = {
@@ -231,50 +236,6 @@ class RegistrationDashboardVerifier(Verifier):
             # Activity / "Unable to retrieve at this time"
         }
 
-    # Override: the loader for loading_elements is still supposed to exist
-    # Check that specified elements are supposed to exist and a loading bar isn't present instead
-    # Check that specified elements or their alternates are present and non-empty in each page
-    # Alternate: different elements appear if there isn't supposed to be content, so it has to check both
-    # Format: Filled-in : Alternate
-    def spot_check(self):
-        for page in self.pages[:]:
-            soup = page.get_content()
-            # Existential crisis:
-            for element in self.loading_elements:
-                final_element = self.loading_elements[element]  # What is supposed to be there
-                loading_bar_result = soup.select(element)
-                if len(loading_bar_result) > 0:  # Container div is present
-                    final_result = soup.select(final_element)
-                    if len(final_result) == 0:  # Final element isn't in place
-                        print("Failed: existential spot_check() ", page, final_element, " doesn't exist, loader ", element,
-                              " present.")
-                        self.failed_pages.append(page.url)
-                        self.pages.remove(page)
-                        break
-            else:
-                # Alternate checker:
-                for element in self.alternate_elements:
-                    alt = self.alternate_elements[element]
-                    result = soup.select(element)
-                    # No results or empty results, with alternate
-                    if (len(result) == 0 or len(result[0].contents) == 0) and alt != '':
-                        alt_result = soup.select(alt)
-
-                        # Element's alternate has no or empty results
-                        if len(alt_result) == 0 or len(alt_result[0].contents) == 0:
-                            print("Failed: alternate spot_check(): ", page, alt, '\n')
-                            self.failed_pages.append(page.url)
-                            self.pages.remove(page)
-                            break
-
-                    # Element has no alternate and no results or empty results
-                    elif (len(result) == 0 or len(result[0].contents) == 0) and alt == '':
-                        print('Failed: spot_check(): ', page, element, "No alt.", '\n')
-                        self.failed_pages.append(page.url)
-                        self.pages.remove(page)
-                        break
-        return
-
 
 class RegistrationFilesVerifier(Verifier):
     def __init__(self):
@@ -334,94 +295,219 @@ class InstitutionDashboardVerifier(Verifier):
         }
 
 
+# The verifiers whose checks the pages of each page type of the crawler (see scheduler.page_type) must pass
+PAGE_TYPE_VERIFIERS = {
+    'project/dashboard': ProjectDashboardVerifier,
+    'project/files': ProjectFilesVerifier,
+    'project/wiki': ProjectWikiVerifier,
+    'project/analytics': ProjectAnalyticsVerifier,
+    'project/registrations': ProjectRegistrationsVerifier,
+    'project/forks': ProjectForksVerifier,
+    'registration/dashboard': RegistrationDashboardVerifier,
+    'registration/files': RegistrationFilesVerifier,
+    'registration/wiki': RegistrationWikiVerifier,
+    'registration/analytics': RegistrationAnalyticsVerifier,
+    'registration/forks': RegistrationForksVerifier,
+    'profile': UserProfileVerifier,
+    'institution': InstitutionDashboardVerifier,
+}
+
+# Put in a page by osf.conf when Prerender gave up rendering it
+PRERENDER_TIMEOUT = re.compile(rb'<meta\s+name=["\']prerender-status-code["\']\s+content=["\']504["\']')
+
+
+class PageValidator:
+    """
+    Verify-on-write (cli.py --validate): the checks of the verifier, run by Crawler.scrape_url on a page as it is
+    received, so that a half-rendered page is retried on the spot and never saved. A page fails if it carries the
+    prerender-status-code 504 meta tag, or if it fails the size check or the spot checks of the verifier of its page
+    type (the size is that of the page as received, a little less than once saved with the mirror warning).
+    Counts the failures by page type and rule.
+    """
+
+    def __init__(self, parser=None):
+        """
+        :param parser: one of spotcheck.PARSERS, spotcheck.default_parser() by default
+        """
+        self.parser = parser or spotcheck.default_parser()
+        spotcheck.check_parser(self.parser)
+        self.failures = collections.Counter()  # {(page type, rule): pages}
+        self._checks = {}  # {page type: (minimum size in KB, spotcheck.Rules)}
+        for kind, verifier_class in PAGE_TYPE_VERIFIERS.items():
+            verifier = verifier_class()
+            self._checks[kind] = (verifier.minimum_size, verifier.rules())
+        self._selectors = None
+        if self.parser == 'lxml':
+            self._selectors = spotcheck.compile_selectors([rules for size, rules in self._checks.values()])
+
+    def validate(self, kind, body):
+        """
+        :param kind: page type, see scheduler.page_type()
+        :param body: the page as received, bytes
+        :return: None if the page may be saved, or the rule it fails
+        """
+        rule = self._failed_rule(kind, body)
+        if rule is not None:
+            self.failures[(kind, rule)] += 1
+            metrics.REGISTRY.inc('rosie_invalid_pages_total', type=kind, rule=rule)
+        return rule
+
+    def _failed_rule(self, kind, body):
+        if PRERENDER_TIMEOUT.search(body):
+            return 'prerender 504'
+        if kind not in self._checks:
+            return None
+        minimum_size, rules = self._checks[kind]
+        if not len(body) / 1000 > minimum_size:
+            return 'size'
+        if self.parser == 'lxml':
+            document = spotcheck.LxmlDocument(body, self._selectors)
+        else:
+            document = spotcheck.SoupDocument(BeautifulSoup(body.decode('utf-8', errors='replace'), 'html.parser'))
+        return spotcheck.check(document, rules)
+
+    def summary(self):
+        """
+        :return: list of (page type, rule, pages that failed it), by page type and rule
+        """
+        return [(kind, rule, pages) for (kind, rule), pages in sorted(self.failures.items())]
+
+
+# Path segments after the GUID that name a page type in node and registration URLs, e.g. https://osf.io/mst3k/files/
+PAGE_ASPECTS = {'files', 'wiki', 'analytics', 'registrations', 'forks'}
+
+
+def url_aspect(url):
+    """
+    :return: the page type segment of a URL (see PAGE_ASPECTS), '' for a dashboard, a profile or an institution
+    """
+    parts = urllib.parse.urlsplit(url).path.strip('/').split('/')
+    aspect = parts[1] if len(parts) > 1 else ''
+    return aspect if aspect in PAGE_ASPECTS else ''
+
+
+def harvest_urls(verifiers, json_dictionary, json_list):
+    """
+    Hands each URL of json_list to the verifier of its page type, in one pass over the list. The URLs of a type
+    without a verifier are left in json_list, the others are taken out.
+    :param verifiers: the verifiers to fill, at most one per page type; the one whose url_end is '' takes the
+                      dashboards (or the profiles, the institutions)
+    :param json_dictionary: The dictionary created from the json file
+    :param json_list: The list in the json file of found URLs
+    """
+    if json_dictionary['error_list'] is None:
+        return
+    errors = set(json_dictionary['error_list'])
+    by_aspect = {verifier.url_end.strip('/'): verifier for verifier in verifiers}
+    unclaimed = []
+    for url in json_list:
+        verifier = by_aspect.get(url_aspect(url))
+        if verifier is None:
+            unclaimed.append(url)
+        else:
+            verifier.harvest_url(url, errors)
+    json_list[:] = unclaimed
+
+
+def spot_check_pages(verifiers, workers=settings.VERIFY_WORKERS):
+    """
+    Spot checks the pages of the verifiers (see Verifier.spot_check) all together, in a pool of processes.
+    :param workers: number of processes, None for one per CPU
+    """
+    rule_sets = [verifier.rules() for verifier in verifiers]
+    items = [(index, page.url, page.path) for index, verifier in enumerate(verifiers) for page in verifier.pages]
+    failures = spotcheck.check_files(items, rule_sets, workers)
+    for verifier in verifiers:
+        passed_pages = []
+        for page in verifier.pages:
+            if page.url in failures:
+                print('Failed: spot_check(): ', page, failures[page.url])
+                verifier.failed_pages.append(page.url)
+                verifier.failure_reasons[page.url] = failures[page.url]
+            else:
+                passed_pages.append(page)
+        verifier.pages = passed_pages
+
+
+def check_pages(verifiers, workers=settings.VERIFY_WORKERS, cache=None):
+    """
+    Checks the harvested pages of the verifiers, size first, and counts the results.
+    :param cache: VerificationCache of the verdicts, only the pages it has none for (or an outdated one) are checked
+    """
+    cached_pages = [verifier.take_cached(cache) if cache is not None else [] for verifier in verifiers]
+    checked_pages = [list(verifier.pages) for verifier in verifiers]
+    for verifier in verifiers:
+        verifier.size_comparison()
+    spot_check_pages(verifiers, workers)
+    for verifier, checked, cached in zip(verifiers, checked_pages, cached_pages):
+        if cache is not None:
+            verifier.store_verdicts(cache, checked)
+        verifier.pages += cached
+        kind = verifier.page_type.__name__
+        metrics.REGISTRY.inc('rosie_verified_pages_total', len(verifier.pages), type=kind, result='ok')
+        metrics.REGISTRY.inc('rosie_verified_pages_total', len(verifier.failed_pages), type=kind, result='failed')
+
+
+def run_verifiers(verifiers, verification_dictionary, list_name, workers=settings.VERIFY_WORKERS, cache=None):
+    """
+    Harvests the URLs of a list for all the verifiers at once, then checks their pages.
+    :param workers: number of spot check processes, None for one per CPU
+    :param cache: VerificationCache, see check_pages()
+    :return: the failed pages of all the verifiers, in the order of the verifiers
+    """
+    harvest_urls(verifiers, verification_dictionary, verification_dictionary[list_name])
+    check_pages(verifiers, workers, cache)
+    failed_pages = []
+    for verifier in verifiers:
+        failed_pages += verifier.failed_pages
+    return failed_pages
+
+
 # Called when json file had scrape_nodes = true
 # Checks for all the components of a project and if they were scraped
 # Verifies them and returns a list of the failed pages
-def verify_nodes(verification_dictionary, list_name):
-    nodes_list_verified = []
+def verify_nodes(verification_dictionary, list_name, workers=settings.VERIFY_WORKERS, cache=None):
+    verifiers = []
     if verification_dictionary['include_files']:
-        project_files_verifier = ProjectFilesVerifier()
-        project_files_verifier.run_verifier(verification_dictionary, verification_dictionary[list_name])
-        project_files = project_files_verifier.failed_pages
-        nodes_list_verified += project_files
+        verifiers.append(ProjectFilesVerifier())
     if verification_dictionary['include_wiki']:
-        project_wiki_verifier = ProjectWikiVerifier()
-        project_wiki_verifier.run_verifier(verification_dictionary, verification_dictionary[list_name])
-        project_wiki = project_wiki_verifier.failed_pages
-        nodes_list_verified += project_wiki
+        verifiers.append(ProjectWikiVerifier())
     if verification_dictionary['include_analytics']:
-        project_analytics_verifier = ProjectAnalyticsVerifier()
-        project_analytics_verifier.run_verifier(verification_dictionary, verification_dictionary[list_name])
-        project_analytics = project_analytics_verifier.failed_pages
-        nodes_list_verified += project_analytics
+        verifiers.append(ProjectAnalyticsVerifier())
     if verification_dictionary['include_registrations']:
-        project_registrations_verifier = ProjectRegistrationsVerifier()
-        project_registrations_verifier.run_verifier(verification_dictionary, verification_dictionary[list_name])
-        project_registrations = project_registrations_verifier.failed_pages
-        nodes_list_verified += project_registrations
+        verifiers.append(ProjectRegistrationsVerifier())
     if verification_dictionary['include_forks']:
-        project_forks_verifier = ProjectForksVerifier()
-        project_forks_verifier.run_verifier(verification_dictionary, verification_dictionary[list_name])
-        project_forks = project_forks_verifier.failed_pages
-        nodes_list_verified += project_forks
-    if verification_dictionary['include_dashboard']:  # This must go last because its URLs don't have a specific ending.
-        project_dashboards_verifier = ProjectDashboardVerifier()
-        project_dashboards_verifier.run_verifier(verification_dictionary, verification_dictionary[list_name])
-        project_dashboards = project_dashboards_verifier.failed_pages
-        nodes_list_verified += project_dashboards
-    return nodes_list_verified
+        verifiers.append(ProjectForksVerifier())
+    if verification_dictionary['include_dashboard']:
+        verifiers.append(ProjectDashboardVerifier())
+    return run_verifiers(verifiers, verification_dictionary, list_name, workers, cache)
 
 
 # Called when json file had scrape_registrations = true
 # Verifies the components of a registration and returns a list of the failed pages
-def verify_registrations(verification_dictionary, list_name):
+def verify_registrations(verification_dictionary, list_name, workers=settings.VERIFY_WORKERS, cache=None):
     # Must run all page types automatically
-    registration_files_verifier = RegistrationFilesVerifier()
-    registration_files_verifier.run_verifier(verification_dictionary, verification_dictionary[list_name])
-    registration_files = registration_files_verifier.failed_pages
-
-    registration_wiki_verifier = RegistrationWikiVerifier()
-    registration_wiki_verifier.run_verifier(verification_dictionary, verification_dictionary[list_name])
-    registration_wiki = registration_wiki_verifier.failed_pages
-
-    registration_analytics_verifier = RegistrationAnalyticsVerifier()
-    registration_analytics_verifier.run_verifier(verification_dictionary, verification_dictionary[list_name])
-    registration_analytics = registration_analytics_verifier.failed_pages
-
-    registration_forks_verifier = RegistrationForksVerifier()
-    registration_forks_verifier.run_verifier(verification_dictionary, verification_dictionary[list_name])
-    registration_forks = registration_forks_verifier.failed_pages
-
-    registration_dashboards_verifier = RegistrationDashboardVerifier()
-    registration_dashboards_verifier.run_verifier(verification_dictionary, verification_dictionary[list_name])
-    registration_dashboards = registration_dashboards_verifier.failed_pages
-
-    registrations_list_verified = registration_files + registration_wiki + registration_analytics + \
-        registration_forks + registration_dashboards
-    return registrations_list_verified
+    verifiers = [RegistrationFilesVerifier(), RegistrationWikiVerifier(), RegistrationAnalyticsVerifier(),
+                 RegistrationForksVerifier(), RegistrationDashboardVerifier()]
+    return run_verifiers(verifiers, verification_dictionary, list_name, workers, cache)
 
 
 # Called when json file had scrape_users = true
 # Verifies all user profile pages and returns a list of the failed pages
-def verify_users(verification_dictionary, list_name):
-    user_profiles_verifier = UserProfileVerifier()
-    user_profiles_verifier.run_verifier(verification_dictionary, verification_dictionary[list_name])
-    user_profiles = user_profiles_verifier.failed_pages
-    return user_profiles
+def verify_users(verification_dictionary, list_name, workers=settings.VERIFY_WORKERS, cache=None):
+    return run_verifiers([UserProfileVerifier()], verification_dictionary, list_name, workers, cache)
 
 
 # Called when json file had scrape_institutions = true
 # Verifies all user profile pages and returns a list of the failed pages
-def verify_institutions(verification_dictionary, list_name):
-    institution_dashboards_verifier = InstitutionDashboardVerifier()
-    institution_dashboards_verifier.run_verifier(verification_dictionary, verification_dictionary[list_name])
-    institution_dashboards = institution_dashboards_verifier.failed_pages
-    return institution_dashboards
+def verify_institutions(verification_dictionary, list_name, workers=settings.VERIFY_WORKERS, cache=None):
+    return run_verifiers([InstitutionDashboardVerifier()], verification_dictionary, list_name, workers, cache)
 
 
 def call_rescrape(json_dictionary, verification_json_dictionary):
     print("Called rescrape.")
-    second_chance = Crawler()
+    second_chance = crawler.Crawler(compress=json_dictionary.get('compress') or (),
+                                    validate=json_dictionary.get('validate', False))
     if json_dictionary['scrape_nodes']:
         second_chance.node_urls = verification_json_dictionary['node_urls_failed_verification']
         second_chance.scrape_nodes(async=True)
@@ -434,75 +520,84 @@ def call_rescrape(json_dictionary, verification_json_dictionary):
     if json_dictionary['scrape_institutions']:
         second_chance.institution_urls = verification_json_dictionary['institution_urls_failed_verification']
         second_chance.scrape_institutions()
+    second_chance.close()
 
 
-def setup_verification(json_dictionary, verification_json_dictionary, first_scrape):
+def setup_verification(json_dictionary, verification_json_dictionary, first_scrape, workers=settings.VERIFY_WORKERS):
     print("Check verification")
-    if json_dictionary['scrape_nodes']:
-        if first_scrape:
-            list_name = 'node_urls'
-        else:
-            list_name = 'node_urls_failed_verification'
-        verification_json_dictionary['node_urls_failed_verification'] = verify_nodes(json_dictionary, list_name)
-    if json_dictionary['scrape_registrations']:
-        if first_scrape:
-            list_name = 'registration_urls'
-        else:
-            list_name = 'registration_urls_failed_verification'
-        verification_json_dictionary['registration_urls_failed_verification'] = verify_registrations(json_dictionary,
-                                                                                                     list_name)
-    if json_dictionary['scrape_users']:
-        if first_scrape:
-            list_name = 'user_urls'
-        else:
-            list_name = 'user_urls_failed_verification'
-        verification_json_dictionary['user_urls_failed_verification'] = \
-            verify_users(json_dictionary, list_name)
-    if json_dictionary['scrape_institutions']:
-        if first_scrape:
-            list_name = 'institution_urls'
-        else:
-            list_name = 'institution_urls_failed_verification'
-        verification_json_dictionary['institution_urls_failed_verification'] = verify_institutions(json_dictionary,
-                                                                                                   list_name)
-
-
-def run_verification(json_file, i):
-    with codecs.open(json_file, mode='r', encoding='utf-8') as failure_file:
-        run_info = json.load(failure_file)
-    with codecs.open(json_file, mode='r', encoding='utf-8') as failure_file:
-        run_copy = json.load(failure_file)
+    # Verdicts of the earlier rounds, for the pages that were not rescraped since
+    cache = VerificationCache(settings.VERIFY_CACHE_FILENAME)
+    try:
+        if json_dictionary['scrape_nodes']:
+            if first_scrape:
+                list_name = 'node_urls'
+            else:
+                list_name = 'node_urls_failed_verification'
+            verification_json_dictionary['node_urls_failed_verification'] = verify_nodes(json_dictionary, list_name,
+                                                                                       workers, cache)
+        if json_dictionary['scrape_registrations']:
+            if first_scrape:
+                list_name = 'registration_urls'
+            else:
+                list_name = 'registration_urls_failed_verification'
+            verification_json_dictionary['registration_urls_failed_verification'] = \
+                verify_registrations(json_dictionary, list_name, workers, cache)
+        if json_dictionary['scrape_users']:
+            if first_scrape:
+                list_name = 'user_urls'
+            else:
+                list_name = 'user_urls_failed_verification'
+            verification_json_dictionary['user_urls_failed_verification'] = \
+                verify_users(json_dictionary, list_name, workers, cache)
+        if json_dictionary['scrape_institutions']:
+            if first_scrape:
+                list_name = 'institution_urls'
+            else:
+                list_name = 'institution_urls_failed_verification'
+            verification_json_dictionary['institution_urls_failed_verification'] = \
+                verify_institutions(json_dictionary, list_name, workers, cache)
+    finally:
+        cache.close()
+    print(cache.summary())
+
+
+def run_verification(json_file, i, workers=settings.VERIFY_WORKERS):
+    # The task file as of its last compaction, with the journaled progress of the scrape replayed onto it
+    run_info = journal.load_task(json_file)
+    run_copy = journal.load_task(json_file)
     if i == 0:
         print("Begun 1st run")
         if run_info['scrape_finished']:
-            setup_verification(run_info, run_copy, True)
+            setup_verification(run_info, run_copy, True, workers)
             run_copy['1st_verification_finished'] = True
             with codecs.open(json_file, mode='w', encoding='utf-8') as file:
                 json.dump(run_copy, file, indent=4)
                 print("Dumped json run_copy 1st verify")
+            journal.discard_journal(json_file)
         call_rescrape(run_info, run_copy)
     else:
         print("Begun next run")
-        setup_verification(run_copy, run_copy, False)
+        setup_verification(run_copy, run_copy, False, workers)
         # truncates json and dumps new lists
         with codecs.open(json_file, mode='w', encoding='utf-8') as file:
             json.dump(run_copy, file, indent=4)
+        journal.discard_journal(json_file)
         call_rescrape(run_copy, run_copy)
 
 
-def resume_verification(json_filename):
-        with codecs.open(json_filename, mode='r', encoding='utf-8') as failure_file:
-            run_copy = json.load(failure_file)
-        print("Resumed verification.")
-        setup_verification(run_copy, run_info, False)
-        # truncates json and dumps new lists
-        with codecs.open(json_filename, mode='w', encoding='utf-8') as file:
-            json.dump(run_copy, file, indent=4)
-        call_rescrape(run_copy, run_copy)
+def resume_verification(json_filename, workers=settings.VERIFY_WORKERS):
+    run_copy = journal.load_task(json_filename)
+    print("Resumed verification.")
+    setup_verification(run_copy, run_copy, False, workers)
+    # truncates json and dumps new lists
+    with codecs.open(json_filename, mode='w', encoding='utf-8') as file:
+        json.dump(run_copy, file, indent=4)
+    journal.discard_journal(json_filename)
+    call_rescrape(run_copy, run_copy)
 
 
-def main(json_filename, num_retries):
+def main(json_filename, num_retries, workers=settings.VERIFY_WORKERS):
     # For testing:
     # num_retries = 2
     # call two verification/scraping methods depending on num retries
-    run_verification(json_filename, num_retries)
+    run_verification(json_filename, num_retries, workers)
@@ -0,0 +1,59 @@
+"""Persistent cache of the verdicts of the verifier, for saved pages that did not change since they were checked"""
+
+import collections
+import dbm
+import json
+
+
+class VerificationCache:
+    """
+    Remembers, by path of a saved page, the identity of the file when it was verified (size, mtime_ns, inode) and
+    the verdict: passed, or why it failed (e.g. which spot check selector found nothing). A page whose file has the
+    same identity, checked by the same rules (see Verifier.fingerprint()), is not read again. Rescraped pages are
+    written to a new file (writer.write_atomic), so they always miss. Kept in a dbm file next to the mirror.
+    """
+
+    def __init__(self, filename):
+        """
+        :param filename: file name of the dbm database, created on first use
+        """
+        self.filename = filename
+        self.stats = collections.Counter()
+        self._db = None
+
+    def _open(self):
+        if self._db is None:
+            self._db = dbm.open(self.filename, 'c')
+        return self._db
+
+    def get(self, path, identity, fingerprint):
+        """
+        :param path: path of the saved page
+        :param identity: (size, mtime_ns, inode) of the file now, see Page
+        :param fingerprint: fingerprint of the rules the page is checked by
+        :return: {'reason': None if the page passed, or why it failed}, None if it has to be checked
+        """
+        value = self._open().get(path.encode('utf-8'))
+        if value is not None:
+            entry = json.loads(value.decode('utf-8'))
+            if entry['identity'] == list(identity) and entry['fingerprint'] == fingerprint:
+                self.stats['hits'] += 1
+                return entry
+        self.stats['misses'] += 1
+        return None
+
+    def store(self, path, identity, fingerprint, reason=None):
+        """
+        :param reason: why the page failed, None if it passed
+        """
+        entry = {'identity': list(identity), 'fingerprint': fingerprint, 'reason': reason}
+        self._open()[path.encode('utf-8')] = json.dumps(entry).encode('utf-8')
+
+    def summary(self):
+        return 'Verification cache: {} pages unchanged since they were checked, {} checked'.format(
+            self.stats['hits'], self.stats['misses'])
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
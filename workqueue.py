@@ -0,0 +1,219 @@
+"""Lease-based work queue of page urls for a scrape distributed across machines (cli.py --queue, --worker)"""
+
+import sqlite3
+import time
+
+# Page type (osf_type of Crawler.scrape_url) of the urls of each url list of a task file
+OSF_TYPES = {
+    'node_urls': 'project',
+    'registration_urls': 'registration',
+    'user_urls': 'profile',
+    'institution_urls': 'institution',
+}
+
+# States of a url in the queue
+QUEUED = 'queued'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class WorkQueue:
+    """
+    Interface of a work queue backend. A coordinator put()s the urls of a task; workers claim() batches of them
+    under a lease, scrape them and report each one with complete() or fail(). A url whose lease expires before it
+    is reported (the worker died or hangs) becomes available again to the next claim(): no page is lost.
+    Reports are accepted even after a lease expired, and a url that is done stays done.
+    """
+
+    def put(self, items):
+        """
+        Adds work, ignoring urls already in the queue (so a restarted coordinator keeps the progress made).
+        :param items: iterable of (url, osf_type, list_name), list_name being the url list of the task file the url
+                      comes from, or None
+        """
+        raise NotImplementedError
+
+    def clear(self):
+        """
+        Removes all the work, done or not, and the mark of mark_loaded(), before the urls of a new task are put.
+        """
+        raise NotImplementedError
+
+    def mark_loaded(self):
+        """
+        Tells the workers that all the work has been put, so that an empty queue means the task is done.
+        """
+        raise NotImplementedError
+
+    def is_loaded(self):
+        raise NotImplementedError
+
+    def claim(self, worker, count, lease_seconds):
+        """
+        Leases up to count queued urls, or urls whose lease expired, to a worker.
+        :return: list of (url, osf_type)
+        """
+        raise NotImplementedError
+
+    def extend(self, worker, urls, lease_seconds):
+        """
+        Renews the lease of a worker on urls it is still working on.
+        """
+        raise NotImplementedError
+
+    def complete(self, worker, url, attempts=1):
+        raise NotImplementedError
+
+    def fail(self, worker, url, status, attempts):
+        """
+        Reports a url that failed for good (after the retries of the worker).
+        """
+        raise NotImplementedError
+
+    def requeue_expired(self):
+        """
+        Puts the urls whose lease expired back in the queue.
+        :return: number of urls re-queued
+        """
+        raise NotImplementedError
+
+    def counts(self):
+        """
+        :return: {state: number of urls}
+        """
+        raise NotImplementedError
+
+    def is_finished(self):
+        """
+        Whether all the work has been put and every url is done or failed.
+        """
+        counts = self.counts()
+        return self.is_loaded() and not counts.get(QUEUED) and not counts.get(LEASED)
+
+    def results(self):
+        """
+        Yields (url, list_name, state, status, attempts) for every url that is done or failed.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SQLiteWorkQueue(WorkQueue):
+    """
+    WorkQueue in a SQLite database file, for a coordinator and workers on one machine (or sharing a local disk;
+    SQLite locking is not reliable over network file systems).
+    """
+
+    def __init__(self, filename, timeout=30.0):
+        """
+        :param filename: file name of the database, created if needed
+        :param timeout: seconds to wait for a lock held by another process
+        """
+        self.filename = filename
+        # A worker makes its calls from a thread of its own (see Crawler._work_from_queue), one at a time
+        self._db = sqlite3.connect(filename, timeout=timeout, isolation_level=None, check_same_thread=False)
+        # Every report is its own transaction: with a write-ahead log they do not each wait for a full sync
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS work (url TEXT PRIMARY KEY, osf_type TEXT, list_name TEXT, "
+                         "state TEXT, worker TEXT, lease_expires REAL, status INTEGER, attempts INTEGER)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS work_state ON work (state, lease_expires)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    def put(self, items):
+        with self._transaction():
+            self._db.executemany("INSERT OR IGNORE INTO work (url, osf_type, list_name, state, attempts) "
+                                 "VALUES (?, ?, ?, ?, 0)",
+                                 ((url, osf_type, list_name, QUEUED) for url, osf_type, list_name in items))
+
+    def clear(self):
+        with self._transaction():
+            self._db.execute("DELETE FROM work")
+            self._db.execute("DELETE FROM meta")
+
+    def mark_loaded(self):
+        self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('loaded', '1')")
+
+    def is_loaded(self):
+        return self._db.execute("SELECT 1 FROM meta WHERE key = 'loaded'").fetchone() is not None
+
+    def claim(self, worker, count, lease_seconds):
+        now = time.time()
+        with self._transaction():
+            rows = self._db.execute("SELECT url, osf_type FROM work WHERE state = ? OR (state = ? AND lease_expires < ?) "
+                                    "LIMIT ?", (QUEUED, LEASED, now, count)).fetchall()
+            self._db.executemany("UPDATE work SET state = ?, worker = ?, lease_expires = ? WHERE url = ?",
+                                 ((LEASED, worker, now + lease_seconds, url) for url, osf_type in rows))
+        return rows
+
+    def extend(self, worker, urls, lease_seconds):
+        expires = time.time() + lease_seconds
+        with self._transaction():
+            self._db.executemany("UPDATE work SET lease_expires = ? WHERE url = ? AND state = ? AND worker = ?",
+                                 ((expires, url, LEASED, worker) for url in urls))
+
+    def complete(self, worker, url, attempts=1):
+        self._db.execute("UPDATE work SET state = ?, worker = ?, status = 200, attempts = ? WHERE url = ?",
+                         (DONE, worker, attempts, url))
+
+    def fail(self, worker, url, status, attempts):
+        self._db.execute("UPDATE work SET state = ?, worker = ?, status = ?, attempts = ? "
+                         "WHERE url = ? AND state != ?", (FAILED, worker, status, attempts, url, DONE))
+
+    def requeue_expired(self):
+        cursor = self._db.execute("UPDATE work SET state = ?, worker = NULL WHERE state = ? AND lease_expires < ?",
+                                  (QUEUED, LEASED, time.time()))
+        return cursor.rowcount
+
+    def counts(self):
+        return dict(self._db.execute("SELECT state, COUNT(*) FROM work GROUP BY state").fetchall())
+
+    def results(self):
+        cursor = self._db.execute("SELECT url, list_name, state, status, attempts FROM work WHERE state IN (?, ?)",
+                                  (DONE, FAILED))
+        for row in cursor:
+            yield row
+
+    def close(self):
+        self._db.close()
+
+    def _transaction(self):
+        return _Transaction(self._db)
+
+
+class _Transaction:
+    """
+    BEGIN IMMEDIATE ... COMMIT (or ROLLBACK), so that two workers can never claim the same urls.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute("BEGIN IMMEDIATE")
+
+    def __exit__(self, exc_type, exc, tb):
+        self.db.execute("ROLLBACK" if exc_type is not None else "COMMIT")
+        return False
+
+
+# Backends by scheme of the queue url given to the CLI (--queue)
+BACKENDS = {
+    'sqlite': SQLiteWorkQueue,
+}
+
+
+def open_queue(queue_url):
+    """
+    Opens a work queue from its url, e.g. sqlite:///var/rosie/queue.db or sqlite://queue.db (relative path)
+    """
+    scheme, separator, location = queue_url.partition('://')
+    if not separator or scheme not in BACKENDS:
+        raise ValueError("Unknown work queue: {} (supported: {})".format(
+            queue_url, ', '.join(scheme + '://' for scheme in sorted(BACKENDS))))
+    if scheme == 'sqlite' and location.startswith('/') and location[1:].startswith('/'):
+        location = location[1:]
+    return BACKENDS[scheme](location)
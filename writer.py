@@ -0,0 +1,208 @@
+"""Writer stage of the scrape: saves pages to the mirror from a thread pool"""
+
+import asyncio
+import collections
+import concurrent.futures
+import os
+import tempfile
+import threading
+
+import compressor
+import digests
+import metrics
+import settings
+
+
+class PageWriter:
+    """
+    Writes pages to the mirror off the event loop, so a slow disk never stalls the network requests.
+        Files are written by a small thread pool, each one to a temporary file in its folder that is then renamed
+        over the page (os.replace), so a page on disk is always complete.
+        Paths are resolved against an absolute root; the process working directory is never changed.
+        Folders are created once per run.
+        With compress set, the compressed siblings of every page (index.html.gz, index.html.br) are written by the
+        same threads, see compressor.py. A page missing one of them is written even if it did not change, and
+        siblings of other encodings are removed whenever a page is written.
+        With a DigestStore, a page whose content (without the dated mirror warning, passed as suffix) has the
+        digest stored for its path is not written again, if the file on disk is still the one written with that
+        digest (see digests.matches). Pages are counted as new, changed or unchanged in
+        self.changes, and the paths of the new and changed ones are appended to changes_file, for the steps that
+        run after the scrape (indexer, sync).
+        At most max_pending pages may be in the stage at a time (waiting to be written): room() waits for a free
+        place, which holds the scrape workers, and so new requests, back while the disk catches up.
+    Usage:
+        html = await fetch(url)
+        async with writer.room():
+            await writer.write('project/mst3k/files/index.html', html, suffix=warning)
+    """
+
+    def __init__(self, root=settings.ARCHIVE_ROOT, threads=settings.WRITER_THREADS,
+                 max_pending=settings.WRITER_MAX_PENDING, compress=(), digest_store=None, changes_file=None):
+        """
+        :param root: folder of the mirror
+        :param threads: threads writing files
+        :param max_pending: pages allowed in the stage at a time
+        :param compress: encodings of the compressed siblings to write next to every page, e.g. ['gzip']
+        :param digest_store: DigestStore of the mirror, None to always write
+        :param changes_file: file name the paths of new and changed pages are appended to, if given
+        """
+        compressor.check_encodings(compress)
+        self.root = os.path.abspath(root)
+        self.compress = list(compress)
+        self.threads = threads
+        self.max_pending = max_pending
+        self.digest_store = digest_store
+        self.changes_file = changes_file
+        self.pages_written = 0
+        self.changes = collections.Counter()
+
+        self._executor = None
+        self._changes = None
+        self._changes_lock = threading.Lock()
+        self._room = None
+        self._folders = set()
+
+    def room(self):
+        """
+        Returns an asynchronous context manager holding one of the max_pending places of the stage.
+        """
+        if self._room is None:
+            self._room = asyncio.Semaphore(self.max_pending)
+        return self._room
+
+    def path(self, relative_path):
+        return os.path.join(self.root, relative_path)
+
+    async def write(self, relative_path, text, suffix=''):
+        """
+        Writes text and suffix (utf-8) to a file of the mirror in the thread pool and returns once it is on disk.
+        :param relative_path: path of the file, relative to the root of the mirror
+        :param text: content of the file that is compared with its stored digest
+        :param suffix: text written after it that does not count as a change (the dated mirror warning)
+        :return: digests.NEW, digests.CHANGED or digests.UNCHANGED (the file was left as it was)
+        """
+        outcome = await self.run(self._write_file, relative_path, text, suffix)
+        self.changes[outcome] += 1
+        if outcome != digests.UNCHANGED:
+            self.pages_written += 1
+        return outcome
+
+    async def run(self, function, *args):
+        """
+        Calls function in the thread pool, off the event loop, for the other blocking work of the scrape on the
+        disk of the mirror (e.g. the ValidatorCache lookups).
+        :return: what function returned
+        """
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.threads)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, function, *args)
+
+    def _write_file(self, relative_path, text, suffix):
+        path = self.path(relative_path)
+        data = text.encode('utf-8')
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            stat = None
+        outcome = digests.CHANGED if stat is not None else digests.NEW
+        if self.digest_store is not None:
+            new_digest = digests.digest(data)
+            if stat is not None and digests.matches(self.digest_store.get(relative_path), new_digest, stat) and \
+                    all(os.path.exists(compressor.sibling_path(path, encoding)) for encoding in self.compress):
+                return digests.UNCHANGED
+
+        folder = os.path.dirname(path)
+        if folder not in self._folders:
+            os.makedirs(folder, exist_ok=True)
+            self._folders.add(folder)
+        suffix_data = suffix.encode('utf-8')
+        write_atomic(path, data, suffix_data)
+        written = len(data) + len(suffix_data)
+        for encoding in compressor.ENCODINGS:
+            sibling = compressor.sibling_path(path, encoding)
+            if encoding in self.compress:
+                compressed = compressor.compress(data + suffix_data, encoding)
+                write_atomic(sibling, compressed)
+                written += len(compressed)
+            else:
+                # A sibling of the old content would still be served by nginx in place of the page
+                try:
+                    os.remove(sibling)
+                except FileNotFoundError:
+                    pass
+        metrics.REGISTRY.inc('rosie_written_bytes_total', written)
+
+        if self.digest_store is not None:
+            self.digest_store.set(relative_path, digests.entry(new_digest, os.stat(path)))
+        if self.changes_file is not None:
+            with self._changes_lock:
+                if self._changes is None:
+                    self._changes = open(self.changes_file, 'a', encoding='utf-8')
+                self._changes.write(relative_path + '\n')
+        return outcome
+
+    def close(self):
+        """
+        Waits for the writes still running, stops the thread pool and closes the digest store.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self._changes is not None:
+            self._changes.close()
+            self._changes = None
+        if self.digest_store is not None:
+            self.digest_store.close()
+            self.digest_store = None
+
+
+def _file_mode():
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+# Permissions of the files of the mirror, those open() would give them: temporary files are created 0600, and nginx
+# reads the mirror as another user
+FILE_MODE = _file_mode()
+
+
+def write_atomic(path, *chunks):
+    """
+    Writes bytes (one or more chunks, one after the other) to a temporary file in the folder of path and renames it
+    over path, so readers never see a partly written file. The file gets FILE_MODE.
+    """
+    file = tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix='.', suffix='.tmp', delete=False)
+    try:
+        with file:
+            for chunk in chunks:
+                file.write(chunk)
+            os.fchmod(file.fileno(), FILE_MODE)
+        os.replace(file.name, path)
+    except OSError:
+        if os.path.exists(file.name):
+            os.remove(file.name)
+        raise
+
+
+def precompress_file(path, encodings):
+    """
+    Writes the compressed siblings of a file of the mirror (e.g. search-index.json.gz), unless they are already
+    at least as recent as the file.
+    :param path: the file
+    :param encodings: e.g. ['gzip', 'brotli']
+    :return: number of siblings written
+    """
+    written = 0
+    data = None
+    for encoding in encodings:
+        sibling = compressor.sibling_path(path, encoding)
+        if os.path.exists(sibling) and os.path.getmtime(sibling) >= os.path.getmtime(path):
+            continue
+        if data is None:
+            with open(path, 'rb') as file:
+                data = file.read()
+        write_atomic(sibling, compressor.compress(data, encoding))
+        written += 1
+    return written